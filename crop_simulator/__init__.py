@@ -6,21 +6,48 @@ marcosoares.feq@gmail.com
 marco.soares@bayer.com
 """
 
+import os
 import numpy as np
 import pandas as pd
-import sklearn
-import tensorflow as tf
+# TensorFlow, scikit-learn and matplotlib are imported only when a model is loaded or a plot is created.
 
 # Now import other components
 
 from .core import (
-    ControlVars,
     run_simulation,
+    run_simulations,
     visualize_yield,
     download_excel_with_data
  )
 
-from .utils import update_control_vars
+from .utils import ControlVars, update_control_vars
+from .session import SimulationSession
+from .service import SimulationService, ServiceClient, MicroBatcher, serve
+from .aio import simulate, simulate_many, SimulationResult
+from .ensemble import run_ensemble, StreamingQuantiles
+from .results_store import ParquetResultsStore
+from .history import SessionHistory
+from .sweep import run_sweep, expand_grid, latin_hypercube, SweepResult
+from .backends import (
+    InferenceBackend,
+    KerasBackend,
+    XGBoostBackend,
+    TFLiteBackend,
+    TFFunctionBackend,
+    convert_to_tflite,
+    get_backend,
+    register_backend
+ )
+from .result_cache import ResultCache
+from .tracing import Tracer
+from .streaming import stream_simulation, run_streaming_simulation, CsvSink, ParquetSink
+from .registry import (
+    ModelRegistry,
+    model_registry,
+    get_model,
+    invalidate_models,
+    warm_up_models
+ )
 
 
 def cropsim_start_msg(PT = True):
@@ -138,4 +165,25 @@ def cropsim_start_msg(PT = True):
     print("\n")
     print(start_msg)
 
-cropsim_start_msg(PT = True)
+# The start message is opt-in: call cropsim_start_msg() or set the environment variable CROPSIM_SHOW_BANNER=1
+# to show it when the package is imported.
+if (os.environ.get('CROPSIM_SHOW_BANNER', '0').lower() in ('1', 'true', 'yes')):
+    cropsim_start_msg(PT = True)
+
+# Optional warm-up: set the environment variable CROPSIM_WARM_UP_MODELS=1 to load the KMeans and
+# LSTM models when the package is imported, instead of during the first simulation.
+if (os.environ.get('CROPSIM_WARM_UP_MODELS', '0').lower() in ('1', 'true', 'yes')):
+    from .utils import get_kmeans_centroids
+    if os.path.exists(ControlVars.cluster_model_path):
+        get_kmeans_centroids(ControlVars.cluster_model_path)
+    warm_up_models([ControlVars.lstm_model_path])
+
+
+def __getattr__(name):
+    # quantize_models is imported on first use: importing quantization (and benchmarks) with the package
+    # would make 'python -m crop_simulator.benchmarks' import the benchmarks module twice.
+    if (name == 'quantize_models'):
+        from .quantization import quantize_models
+        return quantize_models
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,153 @@
+"""asyncio API for the simulations.
+
+run_simulation blocks while the features are computed and the LSTM predicts, and it prints the
+report and displays the dataframe. The coroutines of this module run the simulation in a bounded
+executor, so the event loop stays free for other I/O, and return a SimulationResult instead of
+printing.
+
+e.g.
+    result = await simulate('2022-12-01', '2023-04-01', 'SUZY IPRO', 63.3, 43.0, 1.71, 3.7, 16.8, 156.7, seed = 1)
+    results = await simulate_many(scenarios, seed = 1)
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from .utils import SCENARIO_KEYS, get_session
+
+
+@dataclass
+class SimulationResult:
+  """Result of an asynchronous simulation."""
+
+  simulation_id: str # Sheet name of the simulation in the session (None if it was not registered)
+  data: pd.DataFrame # Simulated days, as returned from the prediction pipeline
+  inputs: dict # User defined parameters (keys of SCENARIO_KEYS)
+  seed: object = None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor (max_workers = None):
+  """
+  Return the executor shared by the coroutines, creating it on the first call.
+  max_workers (int): maximum number of simulations running at the same time. If None,
+    min(4, number of CPUs) is used. Only used when the executor is created.
+  """
+  global _executor
+
+  with _executor_lock:
+    if (_executor is None):
+      if (max_workers is None):
+        max_workers = min(4, (os.cpu_count() or 1))
+      _executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'crop_simulator')
+
+    return _executor
+
+def simulate_blocking (inputs, seed, cluster_model_path, lstm_model_path, language_pt, encoding_path, backend = None):
+  """
+  Generate the dataset and run the prediction pipeline without printing.
+  It only receives plain arguments, so it can also be submitted to a ProcessPoolExecutor.
+  Returns the simulated dataframe.
+  """
+  from .create import get_dataset
+  from .modelling import prediction_pipeline
+
+  df = get_dataset(*[inputs[key] for key in SCENARIO_KEYS], rng = seed)
+  return prediction_pipeline(df, cluster_model_path, lstm_model_path, language_pt, encoding_path, verbose = False, backend = backend)
+
+def lookup_result (session, inputs, seed):
+  """
+  Look up a simulation in the result_cache of the session (hashing the model files and reading the
+  disk tier may block). Returns (cache key, cached dataframe or None).
+  """
+  cache = session.result_cache
+  cache_key = cache.key(inputs, seed, session) if (cache is not None) else None
+  df = cache.get(cache_key) if (cache_key is not None) else None
+
+  return cache_key, df
+
+def store_and_register (session, inputs, seed, df, cache_key, register):
+  """
+  Store a computed simulation in the result_cache of the session and, if register is True, append it
+  and its report to the exported_tables (and to the results store) of the session, as run_simulation.
+  cache_key is None when the simulation was read from the cache or cannot be cached.
+  Returns the simulation id (None if it was not registered).
+  """
+  from .core import report_simulation
+
+  if ((cache_key is not None) and (session.result_cache is not None)):
+    session.result_cache.put(cache_key, df)
+
+  if (not register):
+    return None
+
+  with session.lock:
+    return report_simulation(df, False, session, inputs, seed)
+
+async def simulate (start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed = None, session = None,
+                    executor = None, register = True):
+  """
+  Run a simulation without blocking the event loop.
+  : params start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG: user defined parameters.
+  : param seed: integer seed for the random values (or a numpy SeedSequence).
+  : param session: SimulationSession with the language and model paths, where the simulation is
+    registered. If None, ControlVars is used. Seeded simulations are looked up in its result_cache, if any.
+  : param executor: concurrent.futures executor where the simulation runs. If None, the shared
+    thread pool of get_executor is used. The cache lookup and the registration also run in it, or in
+    the shared thread pool when executor is a ProcessPoolExecutor (the session stays in this process).
+  : param register: if True, the simulation and its report are appended to the exported_tables of
+    the session, as in run_simulation (nothing is printed).
+  Returns a SimulationResult.
+  """
+  session = get_session(session)
+  if (executor is None):
+    executor = get_executor()
+  # The blocking work on the session (cache I/O, report, results store) never runs in the event loop:
+  session_executor = get_executor() if isinstance(executor, ProcessPoolExecutor) else executor
+  loop = asyncio.get_running_loop()
+
+  inputs = dict(zip(SCENARIO_KEYS, [start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG]))
+  cache_key, df = await loop.run_in_executor(session_executor, lookup_result, session, inputs, seed)
+
+  if (df is None):
+    df = await loop.run_in_executor(executor, simulate_blocking, inputs, seed, session.cluster_model_path,
+                                    session.lstm_model_path, session.language_pt, session.encoding_path, session.backend)
+  else:
+    # Read from the cache: nothing to store
+    cache_key = None
+
+  simulation_id = await loop.run_in_executor(session_executor, store_and_register, session, inputs, seed, df, cache_key, register)
+
+  return SimulationResult(simulation_id = simulation_id, data = df, inputs = inputs, seed = seed)
+
+async def simulate_many (scenarios, seed = None, session = None, executor = None, register = True, max_concurrency = None):
+  """
+  Run several simulations concurrently.
+  : param scenarios: list of dictionaries (or tuples) with the user defined parameters, as in run_simulations.
+  : param seed: integer seed. An independent random stream is derived for each scenario with SeedSequence.spawn.
+  : param max_concurrency (int): maximum number of simulations submitted to the executor at the same time.
+    If None, only the executor limits them.
+  : params session, executor, register: same of simulate.
+  Returns the list of SimulationResult, in the same order as scenarios.
+  """
+  scenarios = [scenario if isinstance(scenario, dict) else dict(zip(SCENARIO_KEYS, scenario)) for scenario in scenarios]
+  seeds = np.random.SeedSequence(seed).spawn(len(scenarios))
+  semaphore = asyncio.Semaphore(max_concurrency) if (max_concurrency is not None) else None
+
+  async def run (scenario, scenario_seed):
+    arguments = [scenario[key] for key in SCENARIO_KEYS]
+    if (semaphore is None):
+      return await simulate(*arguments, seed = scenario_seed, session = session, executor = executor, register = register)
+
+    async with semaphore:
+      return await simulate(*arguments, seed = scenario_seed, session = session, executor = executor, register = register)
+
+  return list(await asyncio.gather(*[run(scenario, scenario_seed) for scenario, scenario_seed in zip(scenarios, seeds)]))
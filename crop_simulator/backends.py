@@ -0,0 +1,384 @@
+"""Inference backends.
+
+The prediction pipeline builds the (n, 33) feature matrix of transform.feature_eng_matrix and
+passes it to an inference backend, which loads a model file and returns the predictions of GY
+in log scale. The bundled models in models_and_encodings are:
+    - lstm.keras (default), simple_dense.keras, double_dense.keras, cnn.keras and
+      encoder_decoder.keras: KerasBackend (requires TensorFlow);
+    - xgb_model.json: XGBoostBackend, which runs the native booster with inplace_predict and does
+      not import TensorFlow.
+The Keras models may also run on compiled engines, which avoid the per-call overhead of
+model.predict (data adapters, callbacks, retracing) at small batch sizes:
+    - 'tflite': TFLiteBackend converts the model once into a TFLite flatbuffer with a fixed batch
+      size, cached on disk, and runs it with the TFLite interpreter. If the conversion fails, the
+      Keras model is used (with a warning).
+    - 'tf_function': TFFunctionBackend wraps the model in a tf.function with a fixed input signature.
+    - 'tflite_dynamic', 'tflite_float16', 'tflite_int8': post-training quantized TFLite variants
+      (see quantization.py for the calibration and the error report of each variant). They do not
+      fall back to the float Keras model: if the variant cannot be built, an error is raised.
+All of them were trained on the same 33 features, in the order of LSTM_COLUMNS (see the
+notebooks in 'notebooks/Modelling Workflow' and feature_importance_xgb.csv).
+
+The backend is selected per simulation with the model path (e.g. SimulationSession(lstm_model_path =
+'xgb_model.json')): the backend is inferred from the file extension, or given explicitly with the
+name of a registered backend (SimulationSession.backend, or the parameter backend of run_model).
+New backends are added with register_backend.
+"""
+
+import os
+import threading
+import warnings
+
+import numpy as np
+
+from .registry import get_model
+from .utils import (LSTM_COLUMNS, default_cache_directory, get_lstm_preds, load_lstm, model_file_hash,
+                    print_prediction_message)
+
+
+class InferenceBackend:
+  """
+  Interface of the inference backends.
+  Subclasses implement load (read the model file) and predict (predictions for the feature matrix).
+  Models are cached in the process-wide model registry, so each file is loaded only once.
+  """
+
+  name = None
+  columns = LSTM_COLUMNS # Features expected by the models, in order
+  variant = None # Name of the cached object in the model registry, when it is not the model file itself
+
+  def load (self, model_path):
+    """Load the model object from model_path."""
+    raise NotImplementedError
+
+  def predict (self, model_object, X, verbose = False, language_pt = None):
+    """
+    Return the 1-D array of predictions (GY in log scale).
+    X: float32 (n, 33) array with the columns of LSTM_COLUMNS.
+    """
+    raise NotImplementedError
+
+  def select_columns (self, X):
+    """Reorder the columns of the LSTM_COLUMNS matrix X for the models of this backend."""
+    if (list(self.columns) == list(LSTM_COLUMNS)):
+      return X
+
+    return X[:, [LSTM_COLUMNS.index(column) for column in self.columns]]
+
+  def run (self, model_path, X, verbose = False, language_pt = None):
+    """Load (or reuse) the model of model_path and predict X."""
+    model_object = get_model(model_path, loader = self.load, variant = self.variant)
+    return self.predict(model_object, self.select_columns(np.asarray(X)), verbose, language_pt)
+
+
+class KerasBackend (InferenceBackend):
+  """Keras models (.keras): the LSTM, the dense networks, the CNN and the encoder-decoder."""
+
+  name = 'keras'
+
+  def load (self, model_path):
+    return load_lstm(model_path)
+
+  def predict (self, model_object, X, verbose = False, language_pt = None):
+    if (len(model_object.input_shape) == 3):
+      # Sequence models expect (n, 33, 1). A view is created, without copying X:
+      X = X[:, :, np.newaxis]
+
+    y_pred = get_lstm_preds(model_object, X, verbose, language_pt)
+    if (y_pred.ndim == 2):
+      # Models returning several steps (the encoder-decoder): the first step is the prediction
+      y_pred = y_pred[:, 0]
+
+    return y_pred
+
+
+class XGBoostBackend (InferenceBackend):
+  """XGBoost booster saved as JSON or UBJSON. Requires xgboost (pip install xgboost), not TensorFlow."""
+
+  name = 'xgboost'
+
+  def load (self, model_path):
+    import xgboost as xgb
+
+    booster = xgb.Booster(model_file = model_path)
+    if (booster.num_features() != len(self.columns)):
+      raise ValueError(f"The XGBoost model expects {booster.num_features()} features, but the feature builder creates {len(self.columns)}.")
+
+    return booster
+
+  def predict (self, model_object, X, verbose = False, language_pt = None):
+    # inplace_predict reads the array directly, without building a DMatrix:
+    return np.asarray(model_object.inplace_predict(X))
+
+
+def first_output (y_pred):
+  """Return the 1-D array with the first output of each row (e.g. (n, 1) or (n, 2, 1) arrays)."""
+  y_pred = np.asarray(y_pred)
+  return y_pred.reshape(len(y_pred), -1)[:, 0]
+
+def tflite_cache_path (model_path, batch_size = 64, cache_directory = None, quantization = None):
+  """
+  Return the path of the cached TFLite flatbuffer of a Keras model. The name contains the hash of
+  the model file, so a modified model is converted again.
+  cache_directory (str): directory of the flatbuffers. If None, the environment variable
+    CROPSIM_CACHE_DIR or ~/.cache/crop_simulator is used.
+  quantization (str): None (float32), 'dynamic', 'float16' or 'int8' (see convert_to_tflite)
+  """
+  if (cache_directory is None):
+    cache_directory = default_cache_directory()
+
+  model_name = os.path.splitext(os.path.basename(model_path))[0]
+  suffix = '' if (quantization is None) else ('-' + quantization)
+  return os.path.join(cache_directory, f"{model_name}-{model_file_hash(model_path)}-b{batch_size}{suffix}.tflite")
+
+def convert_to_tflite (model_path, output_path = None, batch_size = 64, quantization = None, calibration_data = None):
+  """
+  Convert a Keras model into a TFLite flatbuffer, e.g. offline, before deploying the simulator.
+  The LSTM cannot be converted with a dynamic batch size (its tensor lists need static shapes),
+  so the flatbuffer has a fixed batch of batch_size rows; TFLiteEngine splits and pads the inputs.
+  model_path (str): path of the .keras model
+  output_path (str): path of the .tflite file. If None, tflite_cache_path is used.
+  batch_size (int): number of rows of each interpreter call. Small batches have the lowest latency
+    for single simulations (64 or 128 rows); larger ones have a higher throughput for sweeps.
+  quantization (str): post-training quantization of the weights:
+    - None: float32 model;
+    - 'dynamic': dynamic-range quantization, int8 weights with float activations;
+    - 'float16': float16 weights;
+    - 'int8': int8 weights and activations, calibrated on calibration_data. Inputs and outputs stay
+      in float32, so the variant replaces the float model without changing the feature matrix.
+  calibration_data: float32 (n, 33) feature matrix for the 'int8' calibration (see quantization.calibration_matrix).
+  Returns the path of the flatbuffer.
+  """
+  import tensorflow as tf
+
+  if (output_path is None):
+    output_path = tflite_cache_path(model_path, batch_size, quantization = quantization)
+
+  model = load_lstm(model_path)
+  input_shape = tuple(model.input_shape[1:])
+  inputs = tf.keras.Input(shape = input_shape, batch_size = batch_size)
+  fixed_batch_model = tf.keras.Model(inputs, model(inputs))
+  converter = tf.lite.TFLiteConverter.from_keras_model(fixed_batch_model)
+
+  if (quantization is not None):
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+  if (quantization == 'float16'):
+    converter.target_spec.supported_types = [tf.float16]
+
+  elif (quantization == 'int8'):
+    if (calibration_data is None):
+      raise ValueError("The 'int8' quantization requires calibration_data.")
+
+    calibration_data = np.asarray(calibration_data, dtype = np.float32).reshape((-1,) + input_shape)
+
+    def representative_dataset ():
+      # Batches of the fixed batch size, as seen by the interpreter:
+      for start in range(0, len(calibration_data) - batch_size + 1, batch_size):
+        yield [calibration_data[start:(start + batch_size)]]
+
+    converter.representative_dataset = representative_dataset
+
+  elif (quantization not in (None, 'dynamic')):
+    raise ValueError(f"Unknown quantization '{quantization}'. Use None, 'dynamic', 'float16' or 'int8'.")
+
+  flatbuffer = converter.convert()
+
+  directory = os.path.dirname(os.path.abspath(output_path))
+  os.makedirs(directory, exist_ok = True)
+  # Write to a temporary file first, so that other processes never read a partial flatbuffer:
+  temporary_path = output_path + f".{os.getpid()}.tmp"
+  with open(temporary_path, 'wb') as opened_file:
+    opened_file.write(flatbuffer)
+  os.replace(temporary_path, output_path)
+
+  return output_path
+
+
+class TFLiteEngine:
+  """
+  TFLite interpreter for a flatbuffer with a fixed batch size.
+  The rows are predicted in chunks of batch_size rows, and the last chunk is padded with zeros.
+  The interpreter of the ai_edge_litert package is used when it is installed (then TensorFlow is
+  not needed to run a cached flatbuffer); otherwise, tf.lite.Interpreter.
+  """
+
+  def __init__(self, flatbuffer_path, num_threads = 1):
+    """
+    flatbuffer_path (str): path of the .tflite file
+    num_threads (int): threads of the interpreter. For the batches of the simulator, a single thread
+      is usually the fastest; more threads only pay off for large batch sizes.
+    """
+    try:
+      from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+      import tensorflow as tf
+      Interpreter = tf.lite.Interpreter
+
+    with warnings.catch_warnings():
+      # tf.lite.Interpreter warns about its deprecation in favor of ai_edge_litert
+      warnings.simplefilter('ignore')
+      self.interpreter = Interpreter(model_path = flatbuffer_path, num_threads = num_threads)
+
+    self.interpreter.allocate_tensors()
+    input_details = self.interpreter.get_input_details()[0]
+    output_details = self.interpreter.get_output_details()[0]
+    self.input_index = input_details['index']
+    self.output_index = output_details['index']
+    self.input_shape = tuple(input_details['shape'])
+    self.output_shape = tuple(output_details['shape'])
+    self.batch_size = self.input_shape[0]
+    self.buffer = np.zeros(self.input_shape, dtype = np.float32)
+    # The interpreter is not thread-safe:
+    self.lock = threading.Lock()
+
+  def predict (self, X):
+    """Return the predictions for the rows of X, with shape (n,) + output shape of each row."""
+    X = np.asarray(X, dtype = np.float32).reshape((-1,) + self.input_shape[1:])
+    total_rows = len(X)
+    y_pred = np.empty((total_rows,) + self.output_shape[1:], dtype = np.float32)
+
+    with self.lock:
+      for start in range(0, total_rows, self.batch_size):
+        chunk = X[start:(start + self.batch_size)]
+        self.buffer[:len(chunk)] = chunk
+        self.interpreter.set_tensor(self.input_index, self.buffer)
+        self.interpreter.invoke()
+        y_pred[start:(start + len(chunk))] = self.interpreter.get_tensor(self.output_index)[:len(chunk)]
+
+    return y_pred
+
+
+class CompiledFunctionEngine:
+  """Keras model wrapped in a tf.function with a fixed input signature (traced only once)."""
+
+  def __init__(self, keras_model):
+    import tensorflow as tf
+
+    self.input_shape = tuple(keras_model.input_shape[1:])
+    signature = [tf.TensorSpec((None,) + self.input_shape, tf.float32)]
+    self.function = tf.function(lambda X: keras_model(X, training = False), input_signature = signature, autograph = False)
+
+  def predict (self, X):
+    X = np.asarray(X, dtype = np.float32).reshape((-1,) + self.input_shape)
+    return self.function(X).numpy()
+
+
+class TFFunctionBackend (InferenceBackend):
+  """Keras models compiled into a tf.function (requires TensorFlow)."""
+
+  name = 'tf_function'
+  variant = 'tf_function'
+
+  def load (self, model_path):
+    return CompiledFunctionEngine(load_lstm(model_path))
+
+  def predict (self, model_object, X, verbose = False, language_pt = None):
+    if (verbose):
+      print_prediction_message(language_pt)
+
+    return first_output(model_object.predict(X))
+
+
+class TFLiteBackend (InferenceBackend):
+  """Keras models converted into cached TFLite flatbuffers, with optional fallback to the Keras model."""
+
+  name = 'tflite'
+
+  def __init__(self, batch_size = 64, num_threads = 1, cache_directory = None, quantization = None, fallback = None):
+    """
+    batch_size (int): fixed batch of the flatbuffer (see convert_to_tflite)
+    num_threads (int): threads of the interpreter
+    cache_directory (str): directory of the flatbuffers (see tflite_cache_path)
+    quantization (str): None, 'dynamic', 'float16' or 'int8' (see convert_to_tflite). The 'int8' variant is
+      calibrated on dataset.csv, and converted in a child process, since the calibration may abort
+      the interpreter for some models (e.g. the recurrent ones with some TensorFlow versions).
+    fallback (bool): if True, the Keras model is used (with a warning) when the flatbuffer cannot be built;
+      if False, a RuntimeError is raised. If None, only the float32 flatbuffer falls back: a quantized
+      variant falling back to the float model would silently return unquantized predictions.
+    """
+    self.batch_size = batch_size
+    self.fallback = (quantization is None) if (fallback is None) else fallback
+    self.num_threads = num_threads
+    self.cache_directory = cache_directory
+    self.quantization = quantization
+    self.variant = f"tflite_b{batch_size}_t{num_threads}"
+    if (quantization is not None):
+      self.name = 'tflite_' + quantization
+      self.variant = self.variant + '_' + quantization
+    if (cache_directory is not None):
+      self.variant = self.variant + '_' + os.path.abspath(cache_directory)
+    if (self.fallback):
+      # The Keras model loaded on a failure is cached under this variant:
+      self.variant = self.variant + '_fallback'
+
+  def load (self, model_path):
+    try:
+      flatbuffer_path = tflite_cache_path(model_path, self.batch_size, self.cache_directory, self.quantization)
+      if (not os.path.exists(flatbuffer_path)):
+        if (self.quantization == 'int8'):
+          from .quantization import calibration_matrix, convert_in_child_process
+          convert_in_child_process(model_path, flatbuffer_path, self.batch_size, self.quantization, calibration_matrix())
+        else:
+          convert_to_tflite(model_path, flatbuffer_path, self.batch_size, self.quantization)
+
+      return TFLiteEngine(flatbuffer_path, self.num_threads)
+
+    except Exception as exception:
+      if (not self.fallback):
+        raise RuntimeError(f"The TFLite engine '{self.name}' is not available for {model_path}: {exception}") from exception
+
+      warnings.warn(f"The TFLite engine is not available for {model_path} ({exception}). The Keras model is used instead.")
+      return load_lstm(model_path)
+
+  def predict (self, model_object, X, verbose = False, language_pt = None):
+    if (not isinstance(model_object, TFLiteEngine)):
+      # Fallback: Keras model
+      return BACKENDS['keras'].predict(model_object, X, verbose, language_pt)
+
+    if (verbose):
+      print_prediction_message(language_pt)
+
+    return first_output(model_object.predict(X))
+
+
+BACKENDS = {'keras': KerasBackend(), 'xgboost': XGBoostBackend(), 'tflite': TFLiteBackend(), 'tf_function': TFFunctionBackend(),
+            'tflite_dynamic': TFLiteBackend(quantization = 'dynamic'), 'tflite_float16': TFLiteBackend(quantization = 'float16'),
+            'tflite_int8': TFLiteBackend(quantization = 'int8')}
+
+# Backend of each model file extension:
+EXTENSIONS = {'.keras': 'keras', '.h5': 'keras', '.json': 'xgboost', '.ubj': 'xgboost'}
+
+# Models bundled in models_and_encodings:
+BUNDLED_MODELS = {'lstm': 'lstm.keras', 'simple_dense': 'simple_dense.keras', 'double_dense': 'double_dense.keras',
+                  'cnn': 'cnn.keras', 'encoder_decoder': 'encoder_decoder.keras', 'xgb': 'xgb_model.json'}
+
+
+def register_backend (name, backend, extensions = None):
+  """
+  Register a new backend.
+  name (str): name used to select the backend
+  backend: InferenceBackend instance
+  extensions (list): model file extensions (e.g. ['.onnx']) for which the backend is selected by default
+  """
+  BACKENDS[name] = backend
+  for extension in (extensions or []):
+    EXTENSIONS[extension.lower()] = name
+
+def get_backend (backend = None, model_path = None):
+  """
+  Return the InferenceBackend.
+  backend: InferenceBackend instance, or name of a registered backend. If None, the backend is
+    inferred from the extension of model_path (Keras for unknown extensions).
+  """
+  if isinstance(backend, InferenceBackend):
+    return backend
+
+  if (backend is None):
+    extension = os.path.splitext(str(model_path))[1].lower()
+    backend = EXTENSIONS.get(extension, 'keras')
+
+  if (backend not in BACKENDS):
+    raise ValueError(f"Unknown inference backend '{backend}'. Available backends: {list(BACKENDS.keys())}")
+
+  return BACKENDS[backend]
@@ -0,0 +1,557 @@
+"""Benchmarks for the Crop Simulator.
+
+Run from the command line, e.g.:
+    python -m crop_simulator.benchmarks import-time --target 2.0
+    python -m crop_simulator.benchmarks backends --repeats 20
+    python -m crop_simulator.benchmarks engines --rows 1 121 1000
+    python -m crop_simulator.benchmarks stages --output baseline.json
+    python -m crop_simulator.benchmarks stages --baseline baseline.json --output current.json
+    python -m crop_simulator.benchmarks compare current.json baseline.json --threshold 0.1
+    python -m crop_simulator.benchmarks kmeans --random-rows 1000000
+The commands 'stages' and 'compare' return the exit code 1 when a case is slower than the baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+
+
+# Modules that must not be loaded by 'import crop_simulator':
+HEAVY_MODULES = ['tensorflow', 'sklearn', 'matplotlib']
+
+# Directory containing the crop_simulator package, the models and the datasets:
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS_PATH = os.path.join(REPOSITORY_PATH, 'models_and_encodings')
+
+
+def measure_import_time (repeats = 5, target_seconds = 2.0):
+  """
+  Measure the cold start of 'import crop_simulator', each time in a fresh interpreter.
+  repeats (int): number of interpreters started
+  target_seconds (float): maximum median import time accepted
+  Returns a dictionary with the median, minimum and maximum import times, the heavy modules that
+  were loaded during the import (they should be loaded only by predictions or plots), and the
+  flag 'within_target'.
+  """
+  package_parent = REPOSITORY_PATH
+  code = ("import sys, time, json; t = time.perf_counter(); import crop_simulator; t = time.perf_counter() - t; "
+          f"print(json.dumps({{'seconds': t, 'loaded': [m for m in {HEAVY_MODULES} if m in sys.modules]}}))")
+
+  environment = dict(os.environ)
+  environment['PYTHONPATH'] = package_parent + os.pathsep + environment.get('PYTHONPATH', '')
+
+  times, loaded_modules = [], set()
+  for i in range(repeats):
+    proc = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, env = environment)
+    if (proc.returncode != 0):
+      raise RuntimeError(proc.stderr)
+
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    times.append(result['seconds'])
+    loaded_modules.update(result['loaded'])
+
+  median_time = statistics.median(times)
+
+  return {'case': 'import_time', 'repeats': repeats,
+          'median_seconds': median_time, 'min_seconds': min(times), 'max_seconds': max(times),
+          'target_seconds': target_seconds, 'heavy_modules_loaded': sorted(loaded_modules),
+          'within_target': ((median_time <= target_seconds) & (len(loaded_modules) == 0))}
+
+
+def time_call (function, repeats):
+  """Run function repeats times and return the list of elapsed times, in seconds."""
+  times = []
+  for i in range(repeats):
+    start_time = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start_time)
+
+  return times
+
+def load_dataset_matrix (dataset_path = None):
+  """
+  Read a generated dataset with the 33 features and GY_log (e.g. generated_datasets/dataset4.csv).
+  Returns the float32 (n, 33) feature matrix in the order of LSTM_COLUMNS and the array of GY_log.
+  """
+  import numpy as np
+  import pandas as pd
+  from .utils import LSTM_COLUMNS
+
+  if (dataset_path is None):
+    dataset_path = os.path.join(REPOSITORY_PATH, 'generated_datasets', 'dataset4.csv')
+
+  dataset = pd.read_csv(dataset_path)
+  return dataset[LSTM_COLUMNS].to_numpy(dtype = np.float32), dataset['GY_log'].to_numpy(dtype = np.float64)
+
+def benchmark_backends (dataset_path = None, models = None, repeats = 10, models_path = None):
+  """
+  Compare the latency and the accuracy of the bundled models on a generated dataset.
+  dataset_path (str): csv with the 33 features and GY_log. Default: generated_datasets/dataset4.csv
+  models (list): names of BUNDLED_MODELS (e.g. ['lstm', 'xgb']). If None, all the bundled models are compared.
+  repeats (int): number of timed predictions of the whole dataset (after one warm-up prediction)
+  models_path (str): directory of the model files. Default: models_and_encodings
+  Returns a list of dictionaries (one per model) with the load time, the median latency, the rows
+  predicted per second and the errors against GY_log: RMSE in log scale, and MAPE and R² of GY (kg/ha).
+  """
+  import numpy as np
+  from .backends import BUNDLED_MODELS, get_backend
+
+  if (models is None):
+    models = list(BUNDLED_MODELS.keys())
+  if (models_path is None):
+    models_path = MODELS_PATH
+
+  X, y_log = load_dataset_matrix(dataset_path)
+  y = np.exp(y_log)
+  results = []
+
+  for model_name in models:
+    model_path = os.path.join(models_path, BUNDLED_MODELS[model_name])
+    backend = get_backend(model_path = model_path)
+
+    start_time = time.perf_counter()
+    model_object = backend.load(model_path)
+    load_seconds = time.perf_counter() - start_time
+
+    y_pred_log = np.asarray(backend.predict(model_object, X), dtype = np.float64).reshape(-1)
+    times = time_call(lambda: backend.predict(model_object, X), repeats)
+    median_time = statistics.median(times)
+    y_pred = np.exp(y_pred_log)
+
+    results.append({'case': 'backend', 'model': model_name, 'backend': backend.name, 'rows': len(X), 'repeats': repeats,
+                    'load_seconds': load_seconds, 'median_latency_ms': median_time * 1000,
+                    'rows_per_second': len(X) / median_time,
+                    'rmse_log': float(np.sqrt(np.mean((y_pred_log - y_log) ** 2))),
+                    'mape_GY': float(np.mean(np.abs(y_pred - y) / y)),
+                    'r2_GY': float(1 - np.sum((y_pred - y) ** 2) / np.sum((y - y.mean()) ** 2))})
+
+  return results
+
+
+def check_engine_parity (model_path = None, dataset_path = None, backends = ('tflite', 'tf_function'), tolerance = 1e-4):
+  """
+  Check that the compiled engines reproduce the predictions of the Keras model.
+  model_path (str): path of the .keras model. Default: models_and_encodings/lstm.keras
+  dataset_path (str): csv with the features (see load_dataset_matrix)
+  backends: names of the backends compared with 'keras'
+  tolerance (float): maximum absolute difference accepted in GY_log
+  Returns a dictionary {backend: {'max_abs_error_log': ..., 'max_relative_error_GY': ..., 'passed': ...}}.
+  """
+  import numpy as np
+  from .backends import get_backend
+
+  if (model_path is None):
+    model_path = os.path.join(MODELS_PATH, 'lstm.keras')
+
+  X, y_log = load_dataset_matrix(dataset_path)
+  reference = np.asarray(get_backend('keras').run(model_path, X), dtype = np.float64)
+  results = {}
+
+  for backend in backends:
+    y_pred = np.asarray(get_backend(backend).run(model_path, X), dtype = np.float64)
+    max_error = float(np.max(np.abs(y_pred - reference)))
+    results[backend] = {'max_abs_error_log': max_error,
+                        'max_relative_error_GY': float(np.max(np.abs(np.expm1(y_pred - reference)))),
+                        'passed': (max_error <= tolerance)}
+
+  return results
+
+def benchmark_engines (model_path = None, rows = (1, 121, 1000), backends = ('keras', 'tf_function', 'tflite'),
+                       thread_counts = (1, 2, 4), repeats = 20):
+  """
+  Compare the latency of model.predict with the compiled engines, for inputs of several sizes.
+  model_path (str): path of the .keras model. Default: models_and_encodings/lstm.keras
+  rows: number of rows of each prediction (121 rows is a 4-month simulation)
+  backends: names of the backends. The TFLite interpreter is measured for each of thread_counts.
+  repeats (int): number of timed predictions (after one warm-up prediction)
+  Returns a list of dictionaries with the median and p90 latencies in ms.
+  """
+  import numpy as np
+  from .backends import TFLiteBackend, get_backend
+
+  if (model_path is None):
+    model_path = os.path.join(MODELS_PATH, 'lstm.keras')
+
+  X_all, y_log = load_dataset_matrix()
+  configurations = []
+  for backend in backends:
+    if (backend == 'tflite'):
+      configurations = configurations + [(f"tflite_{num_threads}_threads", TFLiteBackend(num_threads = num_threads)) for num_threads in thread_counts]
+    else:
+      configurations.append((backend, get_backend(backend)))
+
+  results = []
+  for total_rows in rows:
+    # Repeat the dataset rows to reach the number of rows:
+    X = np.resize(X_all, (total_rows, X_all.shape[1]))
+    for name, backend in configurations:
+      backend.run(model_path, X)
+      times = time_call(lambda: backend.run(model_path, X), repeats)
+      results.append({'case': 'engine', 'engine': name, 'rows': total_rows, 'repeats': repeats,
+                      'median_latency_ms': statistics.median(times) * 1000,
+                      'p90_latency_ms': float(np.percentile(times, 90) * 1000)})
+
+  return results
+
+
+def check_kmeans_parity (model_path = None, dataset_path = None, random_rows = 1000000, seed = 0, repeats = 5):
+  """
+  Check that the nearest-centroid assignment (utils.assign_clusters) returns the labels of the
+  pickled scikit-learn KMeans (kmeans_model.pkl), and compare their latencies.
+  model_path (str): path of the KMeans pkl file. Default: models_and_encodings/kmeans_model.pkl
+  dataset_path (str): csv with the raw columns PH, IFP, NLP, NGL, NS and MHG. Default: dataset.csv
+  random_rows (int): number of additional rows drawn uniformly in the ranges of VAR_CHARACTERISTICS
+  seed (int): seed of the random rows
+  repeats (int): number of timed predictions of a 121-row simulation
+  Returns a dictionary with the number of rows, the number of mismatched labels, the times of both
+  methods for all the rows and for 121 rows, and the flag 'passed'.
+  """
+  import numpy as np
+  import pandas as pd
+  from .utils import KMEANS_COLUMNS, VAR_CHARACTERISTICS, assign_clusters, load_kmeans, load_kmeans_centroids
+
+  if (model_path is None):
+    model_path = os.path.join(MODELS_PATH, 'kmeans_model.pkl')
+  if (dataset_path is None):
+    dataset_path = os.path.join(REPOSITORY_PATH, 'dataset.csv')
+
+  columns = [column.replace('_log', '') for column in KMEANS_COLUMNS]
+  dataset = pd.read_csv(dataset_path)
+  rng = np.random.default_rng(seed)
+  random_values = np.column_stack([rng.uniform(VAR_CHARACTERISTICS[column]['min'], VAR_CHARACTERISTICS[column]['max'], random_rows)
+                                   for column in columns])
+  X = np.log(np.concatenate([dataset[columns].to_numpy(dtype = np.float64), random_values]))
+
+  model = load_kmeans(model_path)
+  centroids = load_kmeans_centroids(model_path)
+
+  start_time = time.perf_counter()
+  reference = model.predict(X)
+  sklearn_seconds = time.perf_counter() - start_time
+  start_time = time.perf_counter()
+  labels = assign_clusters(X, centroids)
+  centroid_seconds = time.perf_counter() - start_time
+
+  X_simulation = X[:121]
+  mismatches = int(np.sum(labels != reference))
+
+  return {'case': 'kmeans_parity', 'rows': len(X), 'clusters': len(centroids), 'mismatches': mismatches,
+          'sklearn_seconds': sklearn_seconds, 'centroid_seconds': centroid_seconds,
+          'sklearn_121_rows_ms': statistics.median(time_call(lambda: model.predict(X_simulation), repeats)) * 1000,
+          'centroid_121_rows_ms': statistics.median(time_call(lambda: assign_clusters(X_simulation, centroids), repeats)) * 1000,
+          'passed': (mismatches == 0)}
+
+# Stages of the simulation pipeline measured by benchmark_stages, in the order they run:
+STAGES = ['create_dataset', 'generate_numeric_column', 'calculate_frequency_features', 'apply_encoding',
+          'obtain_log_transformed_features', 'obtain_cluster_feature', 'get_lstm_preds', 'update_df', 'run_simulation']
+# Simulated horizons, in days (30 days, 1 year, 5 years and 30 years):
+HORIZONS = [30, 365, 1825, 10950]
+BATCH_SIZES = [1, 10, 100, 1000]
+# Cultivars and setpoints of the benchmark scenarios:
+BENCHMARK_CULTIVARS = ['SUZY IPRO', 'MANU IPRO', '96R29 IPRO', 'TMG 22X83I2X']
+BENCHMARK_SETPOINTS = {'PH': 63.3, 'NLP': 43.0, 'NGL': 1.71, 'NS': 3.7, 'IFP': 16.8, 'MHG': 156.7}
+
+
+def benchmark_scenarios (horizon_days, batch_size, start_date = '2000-01-01'):
+  """Return the list of batch_size scenarios (dictionaries with the keys of SCENARIO_KEYS) simulating horizon_days days."""
+  from datetime import datetime, timedelta
+
+  end_date = (datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days = horizon_days)).strftime('%Y-%m-%d')
+  scenarios = []
+  for i in range(batch_size):
+    scenario = {'start_date': start_date, 'end_date': end_date, 'cultivar': BENCHMARK_CULTIVARS[i % len(BENCHMARK_CULTIVARS)]}
+    scenario.update(BENCHMARK_SETPOINTS)
+    scenarios.append(scenario)
+
+  return scenarios
+
+def prepare_stage_inputs (horizon_days, batch_size, seed = 0, models_path = None):
+  """
+  Build the inputs of every stage for batch_size scenarios of horizon_days days: the datasets of
+  all the scenarios are generated with independent seeded streams and stacked, and each stage
+  receives the output of the previous one, as in feature_eng_pipeline.
+  Returns a dictionary with the intermediate dataframes and arrays.
+  """
+  import numpy as np
+  import pandas as pd
+  from .create import get_dataset
+  from .utils import (SCENARIO_KEYS, calculate_frequency_features, apply_encoding, obtain_log_transformed_features,
+                      obtain_cluster_feature, get_dataframe_for_lstm)
+
+  if (models_path is None):
+    models_path = MODELS_PATH
+
+  scenarios = benchmark_scenarios(horizon_days, batch_size)
+  seeds = np.random.SeedSequence(seed).spawn(batch_size)
+  df = pd.concat([get_dataset(*[scenario[key] for key in SCENARIO_KEYS], rng = scenario_seed)
+                  for scenario, scenario_seed in zip(scenarios, seeds)], ignore_index = True)
+
+  cluster_model_path = os.path.join(models_path, 'kmeans_model.pkl')
+  encoding_path = os.path.join(models_path, 'OneHot_encoding_list.pkl')
+  df_frequency = calculate_frequency_features(df)
+  df_encoded = apply_encoding(df_frequency, encoding_path)
+  df_log = obtain_log_transformed_features(df_encoded)
+  df_cluster = obtain_cluster_feature(df_log, cluster_model_path)
+
+  return {'scenarios': scenarios, 'seeds': seeds, 'df': df, 'rows': len(df),
+          'df_frequency': df_frequency, 'df_encoded': df_encoded, 'df_log': df_log,
+          'X': get_dataframe_for_lstm(df_cluster).to_numpy(dtype = np.float32),
+          # update_df only depends on the shape of the predictions, so seeded values around the mean GY_log are used:
+          'y_pred': np.random.default_rng(seed).normal(8.1, 0.1, len(df)).astype(np.float32),
+          'cluster_model_path': cluster_model_path, 'encoding_path': encoding_path,
+          'lstm_model_path': os.path.join(models_path, 'lstm.keras')}
+
+def stage_function (stage, inputs, seed = 0):
+  """Return a function without arguments running one stage on the inputs returned from prepare_stage_inputs."""
+  import numpy as np
+  from .core import run_simulations
+  from .registry import get_model
+  from .session import SimulationSession
+  from .utils import (SCENARIO_KEYS, create_dataset, generate_numeric_column, calculate_frequency_features, apply_encoding,
+                      obtain_log_transformed_features, obtain_cluster_feature, get_lstm_preds, load_lstm, update_df)
+
+  scenarios = inputs['scenarios']
+
+  if (stage == 'create_dataset'):
+    # One dataset per scenario, as get_dataset does:
+    return lambda: [create_dataset(scenario['start_date'], scenario['end_date']) for scenario in scenarios]
+
+  if (stage == 'generate_numeric_column'):
+    return lambda: generate_numeric_column(BENCHMARK_SETPOINTS['PH'], 'PH', inputs['rows'], np.random.default_rng(seed))
+
+  if (stage == 'calculate_frequency_features'):
+    return lambda: calculate_frequency_features(inputs['df'])
+
+  if (stage == 'apply_encoding'):
+    return lambda: apply_encoding(inputs['df_frequency'], inputs['encoding_path'])
+
+  if (stage == 'obtain_log_transformed_features'):
+    return lambda: obtain_log_transformed_features(inputs['df_encoded'])
+
+  if (stage == 'obtain_cluster_feature'):
+    return lambda: obtain_cluster_feature(inputs['df_log'], inputs['cluster_model_path'])
+
+  if (stage == 'get_lstm_preds'):
+    model = get_model(inputs['lstm_model_path'], loader = load_lstm)
+    # The LSTM expects (n, 33, 1), as passed by KerasBackend:
+    X = inputs['X'][:, :, np.newaxis] if (len(model.input_shape) == 3) else inputs['X']
+    return lambda: get_lstm_preds(model, X, verbose = False)
+
+  if (stage == 'update_df'):
+    return lambda: update_df(inputs['df'], inputs['y_pred'])
+
+  if (stage == 'run_simulation'):
+    def run ():
+      # A new session for each run, so the history of the previous runs is not kept:
+      session = SimulationSession(language_pt = False, cluster_model_path = inputs['cluster_model_path'],
+                                  lstm_model_path = inputs['lstm_model_path'], encoding_path = inputs['encoding_path'])
+      if (len(scenarios) == 1):
+        # Seeded with the same stream used by prepare_stage_inputs:
+        session.run_simulation(*[scenarios[0][key] for key in SCENARIO_KEYS], seed = inputs['seeds'][0], display_results = False)
+      else:
+        run_simulations(scenarios, display_results = False, seed = seed, session = session)
+
+    return run
+
+  raise ValueError(f"Unknown stage '{stage}'. Stages: {STAGES}")
+
+def benchmark_stages (stages = None, horizons = None, batch_sizes = None, repeats = 5, seed = 0,
+                      max_rows = 1000000, max_seconds_per_case = 30.0, models_path = None):
+  """
+  Benchmark each stage of the simulation pipeline for every combination of horizon and batch size.
+  stages (list): names of STAGES. If None, all the stages are measured.
+  horizons (list): simulated days of each scenario. Default: HORIZONS (30 days to 30 years)
+  batch_sizes (list): number of scenarios processed together. Default: BATCH_SIZES (1 to 1,000).
+    For the stages working on a single dataframe, the datasets of the scenarios are stacked, as in
+    run_simulations; 'run_simulation' runs run_simulation (1 scenario) or run_simulations.
+  repeats (int): maximum number of timed runs of each case (after one warm-up run)
+  seed (int): seed of the generated data, so the cases are the same in every run
+  max_rows (int): cases with more rows (horizon x batch size) are skipped. None runs all the cases.
+  max_seconds_per_case (float): no more runs of a case are timed after this time (at least one is timed).
+  models_path (str): directory of the model files. Default: models_and_encodings
+  Returns a list of dictionaries (one per case) with the median, minimum and p90 times in seconds and
+  the rows processed per second. Skipped cases have the key 'skipped'.
+  """
+  import numpy as np
+
+  stages = STAGES if (stages is None) else stages
+  horizons = HORIZONS if (horizons is None) else horizons
+  batch_sizes = BATCH_SIZES if (batch_sizes is None) else batch_sizes
+  results = []
+
+  for horizon_days in horizons:
+    for batch_size in batch_sizes:
+      cases = [{'case': 'stage', 'stage': stage, 'horizon_days': horizon_days, 'batch_size': batch_size,
+                'rows': horizon_days * batch_size} for stage in stages]
+
+      if ((max_rows is not None) and (horizon_days * batch_size > max_rows)):
+        for case in cases:
+          case['skipped'] = f"more than max_rows = {max_rows} rows"
+        results = results + cases
+        continue
+
+      inputs = prepare_stage_inputs(horizon_days, batch_size, seed, models_path)
+      for stage, case in zip(stages, cases):
+        function = stage_function(stage, inputs, seed)
+        function() # warm-up (loads the models)
+
+        times, start_time = [], time.perf_counter()
+        while ((len(times) < repeats) and ((len(times) == 0) or (time.perf_counter() - start_time < max_seconds_per_case))):
+          times = times + time_call(function, 1)
+
+        median_time = statistics.median(times)
+        case.update({'rows': inputs['rows'], 'repeats': len(times), 'median_seconds': median_time, 'min_seconds': min(times),
+                     'p90_seconds': float(np.percentile(times, 90)), 'rows_per_second': inputs['rows'] / median_time})
+      results = results + cases
+
+  return results
+
+def environment_metadata (seed = None):
+  """Return the versions and the machine where the benchmarks ran, stored with the results."""
+  import platform
+  import numpy as np
+  import pandas as pd
+  from datetime import datetime
+
+  return {'created_at': datetime.now().isoformat(timespec = 'seconds'), 'python': platform.python_version(),
+          'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.machine(),
+          'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'seed': seed}
+
+def case_key (result):
+  """Key identifying a benchmark case in the results of different runs."""
+  return (result.get('stage'), result.get('horizon_days'), result.get('batch_size'))
+
+def compare_benchmarks (results, baseline, threshold = 0.10, min_delta_seconds = 0.0005):
+  """
+  Compare benchmark results with a stored baseline.
+  results, baseline: lists of results of benchmark_stages (or dictionaries with the key 'results',
+    as written by the command line).
+  threshold (float): relative increase of the median time flagged as regression (0.10 = 10 % slower)
+  min_delta_seconds (float): increases smaller than this are ignored, since they are in the timer noise.
+  Returns a list of dictionaries (one per case found in both) with the baseline and current medians,
+  their ratio, and the flags 'regression' and 'improvement'.
+  """
+  if isinstance(results, dict):
+    results = results['results']
+  if isinstance(baseline, dict):
+    baseline = baseline['results']
+
+  baseline_cases = {case_key(result): result for result in baseline if 'median_seconds' in result}
+  comparison = []
+
+  for result in results:
+    reference = baseline_cases.get(case_key(result))
+    if ((reference is None) or ('median_seconds' not in result)):
+      continue
+
+    current_time, baseline_time = result['median_seconds'], reference['median_seconds']
+    delta = current_time - baseline_time
+    ratio = (current_time / baseline_time) if (baseline_time > 0) else float('inf')
+    comparison.append({'stage': result['stage'], 'horizon_days': result['horizon_days'], 'batch_size': result['batch_size'],
+                       'baseline_median_seconds': baseline_time, 'median_seconds': current_time, 'ratio': ratio,
+                       'regression': ((ratio > 1 + threshold) and (delta > min_delta_seconds)),
+                       'improvement': ((ratio < 1 / (1 + threshold)) and (-delta > min_delta_seconds))})
+
+  return comparison
+
+def save_benchmarks (results, output_path, seed = None):
+  """Write the results, with the environment metadata, to a JSON file."""
+  with open(output_path, 'w') as output_file:
+    json.dump({'metadata': environment_metadata(seed), 'results': results}, output_file, indent = 2)
+
+def load_benchmarks (path):
+  """Read a JSON file written by save_benchmarks."""
+  with open(path, 'r') as opened_file:
+    return json.load(opened_file)
+
+
+def main (args = None):
+  """Command line interface."""
+  import argparse
+
+  parser = argparse.ArgumentParser(prog = "python -m crop_simulator.benchmarks", description = "Crop Simulator benchmarks")
+  subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+  import_parser = subparsers.add_parser('import-time', help = "measure the cold start of 'import crop_simulator'")
+  import_parser.add_argument('--repeats', type = int, default = 5)
+  import_parser.add_argument('--target', type = float, default = 2.0, help = "maximum median import time, in seconds")
+
+  backends_parser = subparsers.add_parser('backends', help = "compare latency and accuracy of the bundled models")
+  backends_parser.add_argument('--dataset', default = None, help = "csv with the features and GY_log (default: generated_datasets/dataset4.csv)")
+  backends_parser.add_argument('--models', nargs = '*', default = None, help = "bundled models to compare (default: all)")
+  backends_parser.add_argument('--repeats', type = int, default = 10)
+
+  engines_parser = subparsers.add_parser('engines', help = "latency of model.predict and of the compiled engines (TFLite, tf.function), and their parity")
+  engines_parser.add_argument('--model', default = None, help = "path of the .keras model (default: models_and_encodings/lstm.keras)")
+  engines_parser.add_argument('--rows', type = int, nargs = '*', default = [1, 121, 1000])
+  engines_parser.add_argument('--threads', type = int, nargs = '*', default = [1, 2, 4], help = "thread counts of the TFLite interpreter")
+  engines_parser.add_argument('--repeats', type = int, default = 20)
+
+  stages_parser = subparsers.add_parser('stages', help = "time each stage of the pipeline for several horizons and batch sizes")
+  stages_parser.add_argument('--stages', nargs = '*', default = None, choices = STAGES, help = "default: all")
+  stages_parser.add_argument('--horizons', type = int, nargs = '*', default = HORIZONS, help = "simulated days of each scenario")
+  stages_parser.add_argument('--batch-sizes', type = int, nargs = '*', default = BATCH_SIZES, help = "scenarios processed together")
+  stages_parser.add_argument('--repeats', type = int, default = 5)
+  stages_parser.add_argument('--seed', type = int, default = 0)
+  stages_parser.add_argument('--max-rows', type = int, default = 1000000, help = "skip larger cases (0: no limit)")
+  stages_parser.add_argument('--max-seconds-per-case', type = float, default = 30.0)
+  stages_parser.add_argument('--output', default = None, help = "JSON file for the results")
+  stages_parser.add_argument('--baseline', default = None, help = "JSON file of a previous run to compare with")
+  stages_parser.add_argument('--threshold', type = float, default = 0.10, help = "relative slowdown flagged as regression")
+
+  compare_parser = subparsers.add_parser('compare', help = "compare two JSON files written by 'stages'")
+  compare_parser.add_argument('results')
+  compare_parser.add_argument('baseline')
+  compare_parser.add_argument('--threshold', type = float, default = 0.10, help = "relative slowdown flagged as regression")
+
+  kmeans_parser = subparsers.add_parser('kmeans', help = "parity and latency of the nearest-centroid KMeans assignment against kmeans_model.pkl")
+  kmeans_parser.add_argument('--model', default = None, help = "path of the KMeans pkl file (default: models_and_encodings/kmeans_model.pkl)")
+  kmeans_parser.add_argument('--random-rows', type = int, default = 1000000)
+  kmeans_parser.add_argument('--seed', type = int, default = 0)
+
+  args = parser.parse_args(args)
+
+  if (args.command == 'import-time'):
+    result = measure_import_time(repeats = args.repeats, target_seconds = args.target)
+    print(json.dumps(result, indent = 2))
+    return 0 if result['within_target'] else 1
+
+  if (args.command == 'engines'):
+    parity = check_engine_parity(args.model)
+    result = {'parity': parity, 'latency': benchmark_engines(args.model, args.rows, thread_counts = args.threads, repeats = args.repeats)}
+    print(json.dumps(result, indent = 2))
+    return 0 if all(check['passed'] for check in parity.values()) else 1
+
+  if (args.command == 'backends'):
+    print(json.dumps(benchmark_backends(args.dataset, args.models, args.repeats), indent = 2))
+    return 0
+
+  if (args.command == 'stages'):
+    results = benchmark_stages(args.stages, args.horizons, args.batch_sizes, args.repeats, args.seed,
+                               (args.max_rows or None), args.max_seconds_per_case)
+    if (args.output is not None):
+      save_benchmarks(results, args.output, args.seed)
+    if (args.baseline is None):
+      print(json.dumps(results, indent = 2))
+      return 0
+
+    comparison = compare_benchmarks(results, load_benchmarks(args.baseline), args.threshold)
+    print(json.dumps(comparison, indent = 2))
+    return 1 if any(case['regression'] for case in comparison) else 0
+
+  if (args.command == 'kmeans'):
+    result = check_kmeans_parity(args.model, random_rows = args.random_rows, seed = args.seed)
+    print(json.dumps(result, indent = 2))
+    return 0 if result['passed'] else 1
+
+  if (args.command == 'compare'):
+    comparison = compare_benchmarks(load_benchmarks(args.results), load_benchmarks(args.baseline), args.threshold)
+    print(json.dumps(comparison, indent = 2))
+    return 1 if any(case['regression'] for case in comparison) else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,36 +1,102 @@
 from .create import get_dataset
-from .modelling import prediction_pipeline
-from .idswcopy import time_series_vis, download_file_from_colab, export_pd_dataframe_as_excel
-from .utils import ControlVars, update_control_vars, retrieve_vars_from_global_context
-
-from datetime import datetime, timedelta
+from .modelling import prediction_pipeline, batch_prediction_pipeline
+from .idswcopy import time_series_vis, download_file_from_colab, export_new_tables_as_excel
+from .utils import (SCENARIO_KEYS, get_session, next_simulation_number,
+                    update_control_vars, retrieve_vars_from_global_context)
+from .tracing import NULL_SPAN, span, current_trace, format_span
+
+from datetime import datetime
+import numpy as np
 import pandas as pd
 
 
-def orchestrate_pipelines():
+def orchestrate_pipelines(session = None, inputs = None, seed = None, display_results = True):
   """Orchestrate all the pipelines to obtain a full simulation.
-  At the end, store in a list of dictionaries in ControlVars, that will be used for exporting a 
-  consolidated Excel file with all simulations.
+  At the end, store in a list of dictionaries in the session (ControlVars by default), that will be used
+  for exporting a consolidated Excel file with all simulations.
+  : param session: SimulationSession where the simulation runs. If None, ControlVars is used.
+  : param inputs: dictionary with the user defined parameters (keys of SCENARIO_KEYS). If None, the inputs
+    and the seed stored in the session by update_control_vars are used. Passing the inputs explicitly
+    allows concurrent simulations in the same session.
+  : param seed: seed for the random values. Only used when inputs is given.
+  : param display_results: if True, print the simulation report and display the dataframe.
+  If the session has a tracer, the time and memory of each stage are recorded (see tracing.py).
+  Returns the simulated dataframe.
+  """
+  session = get_session(session)
+  if (inputs is None):
+    inputs = dict(zip(SCENARIO_KEYS, retrieve_vars_from_global_context(session)))
+    seed = session.seed
+
+  def compute ():
+    with span('get_dataset'):
+      df = get_dataset(*[inputs[key] for key in SCENARIO_KEYS], rng = seed)
+    with span('prediction_pipeline'):
+      # The prediction message and the progress bar are only printed with the report:
+      return prediction_pipeline(df, session.cluster_model_path, session.lstm_model_path, language_pt = session.language_pt,
+                                 encoding_path = session.encoding_path, verbose = display_results, backend = session.backend)
+
+  with (session.tracer.trace('simulation') if (session.tracer is not None) else NULL_SPAN):
+    cache = session.result_cache
+    if (cache is not None):
+      # Seeded simulations are looked up in the cache (simulations without seed are always computed):
+      with span('result_cache'):
+        df = cache.get_or_compute(cache.key(inputs, seed, session), compute)
+    else:
+      df = compute()
+
+    with span('report'):
+      report_simulation(df, display_results, session, inputs, seed)
+
+  return df
+
+
+def format_seed (seed):
+  """
+  Return the seed as stored in the results store: '' for no seed, and the entropy and spawn key of a
+  SeedSequence (e.g. the child seeds of run_simulations), from which the same stream is recreated with
+  np.random.SeedSequence(entropy, spawn_key = spawn_key).
+  """
+  if (seed is None):
+    return ''
+  if isinstance(seed, np.random.SeedSequence):
+    return f"SeedSequence(entropy={seed.entropy}, spawn_key={tuple(int(value) for value in seed.spawn_key)})"
+
+  return str(seed)
+
+def report_simulation(df, display_results = True, session = None, inputs = None, seed = None, trace = None):
+  """Register a finished simulation: update the simulation counter and append the simulation
+  dataframe and its report (REP_ table) to the exported_tables of the session.
+  : param df: dataframe returned from the prediction pipeline.
+  : param display_results: if True, print the simulation report and display the dataframe.
+  : param session: SimulationSession where the simulation is registered. If None, ControlVars is used.
+  : param inputs: dictionary with the user defined parameters of the simulation (keys of SCENARIO_KEYS).
+    If None, user inputs (and the seed) are read from the session, so update_control_vars must be called before.
+  : param seed: seed of the simulation, stored in the results store. Only used when inputs is given.
+  : param trace: trace whose completed stages are listed in the report (e.g. the trace of the batch of
+    run_simulations). If None, the trace active in the current context is used, if any.
+  Returns the sheet name of the simulation, which identifies it in the session.
   """
-  start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, cluster_model_path, lstm_model_path = retrieve_vars_from_global_context()
-  df = get_dataset(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG)
-  df = prediction_pipeline(df, cluster_model_path, lstm_model_path)
-  # Update on ControlVars:
-  ControlVars.df = df
-  # Update the simulation counting:
-  ControlVars.simulation_counter = ControlVars.simulation_counter + 1
+  session = get_session(session)
+  if (inputs is None):
+    inputs = dict(zip(SCENARIO_KEYS, retrieve_vars_from_global_context(session)))
+    seed = session.seed
+
+  # Update on the session:
+  session.df = df
+  # Update the simulation counting. The number is kept, since other simulations may run concurrently:
+  simulation_number = next_simulation_number(session)
   # Get list exported_tables:
-  exported_tables = ControlVars.exported_tables
+  exported_tables = session.exported_tables
   # Get a date now to differentiate from others
   conclusion_time = pd.Timestamp(datetime.now())
-  update_control_vars(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG)
 
   # Obtain sheet name:
   # Apply timestamp() method to convert the timestamp to POSIX timestamp as float
   # https://pandas.pydata.org/docs/reference/api/pandas.Timestamp.timestamp.html#pandas.Timestamp.timestamp
   # It will guarantee that each sheet is unique. Also, hours in 00:00:00 format cannot
   # be used as sheet names, due to the ":" non-allowed character.
-  sheet_name = "sim" + str(ControlVars.simulation_counter) + "_" + str(conclusion_time.timestamp())
+  sheet_name = "sim" + str(simulation_number) + "_" + str(conclusion_time.timestamp())
   
   # Get a dictionary for exporting the table:
   table_dict = {'dataframe_obj_to_be_exported': df, 
@@ -40,9 +106,26 @@ def orchestrate_pipelines():
   # Append the dictionary on the list of exported tables:
   exported_tables.append(table_dict)
   # Update Global Variables:
-  ControlVars.exported_tables = exported_tables
-
-  if (ControlVars.language_pt):
+  session.exported_tables = exported_tables
+
+  active_trace = current_trace()
+  if (active_trace is not None):
+    active_trace.attributes['simulation_id'] = sheet_name
+  if (trace is None):
+    trace = active_trace
+
+  if (session.results_store is not None):
+    # Append the simulation and its inputs to the columnar results store:
+    metadata = {'cultivar': inputs['cultivar'], 'conclusion_time': conclusion_time, 
+                'server_start_time': session.server_start_time, 'simulation_counter': simulation_number,
+                'start_date': str(inputs['start_date']), 'end_date': str(inputs['end_date']),
+                'PH': float(inputs['PH']), 'NLP': float(inputs['NLP']), 'NGL': float(inputs['NGL']), 
+                'NS': float(inputs['NS']), 'IFP': float(inputs['IFP']), 'MHG': float(inputs['MHG']),
+                'seed': format_seed(seed)}
+    with span('results_store'):
+      session.results_store.append(df, sheet_name, metadata)
+
+  if (session.language_pt):
     completion_msg = f"""
 
 
@@ -62,21 +145,21 @@ def orchestrate_pipelines():
 
 
       # RELATÓRIO DE SIMULAÇÃO
-      SIMULAÇÃO #{ControlVars.simulation_counter}: IDENTIFICADOR {conclusion_time.timestamp()} 
-      - SIMULAÇÃO INICIADA EM (TEMPO DO SERVIDOR) = {ControlVars.server_start_time}
+      SIMULAÇÃO #{simulation_number}: IDENTIFICADOR {conclusion_time.timestamp()} 
+      - SIMULAÇÃO INICIADA EM (TEMPO DO SERVIDOR) = {session.server_start_time}
       - SIMULAÇÃO FINALIZADA EM (TEMPO DO SERVIDOR) = {conclusion_time}
 
       ## PARÂMETROS DE ENTRADA DO USUÁRIO
 
-      DATA DE INÍCIO = {ControlVars.start_date}
-      DATA DE TÉRMINO = {ControlVars.end_date}
-      HÍBRIDO DE SOJA (CULTIVAR) = {ControlVars.cultivar}
-      ALTURA DA PLANTA (PH) = {ControlVars.PH} cm
-      INSERÇÃO DA PRIMEIRA VAGEM (IFP) = {ControlVars.IFP} cm
-      NÚMERO DE HASTES E RAMOS (NLP) = {ControlVars.NLP} unidades
-      NÚMERO DE GRÃOS POR PLANTA (NGL) {ControlVars.NGL} unidades
-      NÚMERO DE GRÃOS POR VAGEM (NS) = {ControlVars.NS} unidades
-      MASSA DE MIL SEMENTES (MHG) = {ControlVars.MHG} g
+      DATA DE INÍCIO = {inputs['start_date']}
+      DATA DE TÉRMINO = {inputs['end_date']}
+      HÍBRIDO DE SOJA (CULTIVAR) = {inputs['cultivar']}
+      ALTURA DA PLANTA (PH) = {inputs['PH']} cm
+      INSERÇÃO DA PRIMEIRA VAGEM (IFP) = {inputs['IFP']} cm
+      NÚMERO DE HASTES E RAMOS (NLP) = {inputs['NLP']} unidades
+      NÚMERO DE GRÃOS POR PLANTA (NGL) {inputs['NGL']} unidades
+      NÚMERO DE GRÃOS POR VAGEM (NS) = {inputs['NS']} unidades
+      MASSA DE MIL SEMENTES (MHG) = {inputs['MHG']} g
 
       -------------------------------------------------------------------------------
 
@@ -90,11 +173,11 @@ def orchestrate_pipelines():
                   'INSERÇÃO DA PRIMEIRA VAGEM (IFP)', 'NÚMERO DE HASTES E RAMOS (NLP)',
                   'NÚMERO DE GRÃOS POR PLANTA (NGL)', 'NÚMERO DE GRÃOS POR VAGEM (NS)', 'MASSA DE MIL SEMENTES (MHG)']
     
-    user_input_params = [f"{ControlVars.simulation_counter}", f"{conclusion_time.timestamp()}", f"{ControlVars.server_start_time}", 
-                          f"{conclusion_time}", f"{ControlVars.start_date}",
-                          f"{ControlVars.end_date}", f"{ControlVars.cultivar}", f"{ControlVars.PH} cm", 
-                          f"{ControlVars.IFP} cm", f"{ControlVars.NLP} unidades", 
-                          f"{ControlVars.NGL} unidades", f"{ControlVars.NS} unidades", f"{ControlVars.MHG} g"]
+    user_input_params = [f"{simulation_number}", f"{conclusion_time.timestamp()}", f"{session.server_start_time}", 
+                          f"{conclusion_time}", f"{inputs['start_date']}",
+                          f"{inputs['end_date']}", f"{inputs['cultivar']}", f"{inputs['PH']} cm", 
+                          f"{inputs['IFP']} cm", f"{inputs['NLP']} unidades", 
+                          f"{inputs['NGL']} unidades", f"{inputs['NS']} unidades", f"{inputs['MHG']} g"]
   
   else:
     completion_msg = f"""
@@ -116,21 +199,21 @@ def orchestrate_pipelines():
 
 
       # SIMULATION REPORT
-      SIMULATION #{ControlVars.simulation_counter}: IDENTIFIER {conclusion_time.timestamp()} 
-      - STARTED SIMULATION AT (SERVER TIME) = {ControlVars.server_start_time}
+      SIMULATION #{simulation_number}: IDENTIFIER {conclusion_time.timestamp()} 
+      - STARTED SIMULATION AT (SERVER TIME) = {session.server_start_time}
       - FINISHED SIMULATION AT (SERVER TIME) = {conclusion_time}
 
       ## USER INPUT PARAMETERS
 
-      START DATE = {ControlVars.start_date}
-      END DATE = {ControlVars.end_date}
-      CULTIVAR = {ControlVars.cultivar}
-      PLANT HEIGHT (PH) = {ControlVars.PH} cm
-      INSERTION OF THE FIRST POD (IFP) = {ControlVars.IFP} cm
-      NUMBER OF STEMS (NLP) = {ControlVars.NLP} units
-      NUMBER OF GRAINS PER PLANT (NGL) {ControlVars.NGL} units
-      NUMBER OF GRAINS PER POD (NS) = {ControlVars.NS} units
-      THOUSAND SEED WEIGHT (MHG) = {ControlVars.MHG} g
+      START DATE = {inputs['start_date']}
+      END DATE = {inputs['end_date']}
+      CULTIVAR = {inputs['cultivar']}
+      PLANT HEIGHT (PH) = {inputs['PH']} cm
+      INSERTION OF THE FIRST POD (IFP) = {inputs['IFP']} cm
+      NUMBER OF STEMS (NLP) = {inputs['NLP']} units
+      NUMBER OF GRAINS PER PLANT (NGL) {inputs['NGL']} units
+      NUMBER OF GRAINS PER POD (NS) = {inputs['NS']} units
+      THOUSAND SEED WEIGHT (MHG) = {inputs['MHG']} g
 
       -------------------------------------------------------------------------------
 
@@ -144,13 +227,19 @@ def orchestrate_pipelines():
                   'INSERTION OF THE FIRST POD (IFP)', 'NUMBER OF STEMS (NLP)',
                   'NUMBER OF GRAINS PER PLANT (NGL)', 'NUMBER OF GRAINS PER POD (NS)', 'THOUSAND SEED WEIGHT (MHG)']
     
-    user_input_params = [f"{ControlVars.simulation_counter}", f"{conclusion_time.timestamp()}", f"{ControlVars.server_start_time}", 
-                          f"{conclusion_time}", f"{ControlVars.start_date}",
-                          f"{ControlVars.end_date}", f"{ControlVars.cultivar}", f"{ControlVars.PH} cm", 
-                          f"{ControlVars.IFP} cm", f"{ControlVars.NLP} units", 
-                          f"{ControlVars.NGL} units", f"{ControlVars.NS} units", f"{ControlVars.MHG} g"]
+    user_input_params = [f"{simulation_number}", f"{conclusion_time.timestamp()}", f"{session.server_start_time}", 
+                          f"{conclusion_time}", f"{inputs['start_date']}",
+                          f"{inputs['end_date']}", f"{inputs['cultivar']}", f"{inputs['PH']} cm", 
+                          f"{inputs['IFP']} cm", f"{inputs['NLP']} units", 
+                          f"{inputs['NGL']} units", f"{inputs['NS']} units", f"{inputs['MHG']} g"]
   
 
+  if (trace is not None):
+    # Time and memory of the stages finished before the report (paths relative to the simulation):
+    for record in trace.breakdown():
+      parameters.append(('ETAPA: ' if session.language_pt else 'STAGE: ') + record['path'].split('/', 1)[1])
+      user_input_params.append(format_span(record))
+
   sim_rep = pd.DataFrame(data = {'SIMULATION_REPORT': parameters, 'USER_INPUT': user_input_params})
 
   # Get a dictionary for exporting the table:
@@ -161,40 +250,102 @@ def orchestrate_pipelines():
   exported_tables.append(table_dict)
 
   # Finally, update the list:
-  ControlVars.exported_tables = exported_tables
-  
-  print(completion_msg)
-  try:
-        # only works in Jupyter Notebook:
-        from IPython.display import display
-        display(df)
-            
-  except: # regular mode
-        print(df)
-
-
-def run_simulation(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG):
+  session.exported_tables = exported_tables
+
+  if (display_results):
+    with span('display'):
+      print(completion_msg)
+      try:
+            # only works in Jupyter Notebook:
+            from IPython.display import display
+            display(df)
+                
+      except: # regular mode
+            print(df)
+
+  return sheet_name
+
+def run_simulation(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed = None, session = None, display_results = True):
   """
   Set all user defined parameters, update the global context and actuate the pipeline orchestration
   : params start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG: user defined parameters.
+  : param seed: integer seed for the random values. The same seed and inputs reproduce the same simulation.
+    If None, each simulation is different.
+  : param session: SimulationSession where the simulation runs. If None, the global context (ControlVars) is used.
+  : param display_results: if True, print the simulation report and display the dataframe.
   """
-  update_control_vars(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG)
-  orchestrate_pipelines()
+  inputs = dict(zip(SCENARIO_KEYS, [start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG]))
+  # The session keeps the inputs of its last simulation, but the pipelines receive them explicitly,
+  # so that a concurrent simulation cannot change them:
+  update_control_vars(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed, session)
+  orchestrate_pipelines(session, inputs, seed, display_results)
 
-def visualize_yield (export_images = True):
+def run_simulations(scenarios, display_results = False, seed = None, session = None):
+  """
+  Run several simulations with a single model.predict call.
+  The datasets of all scenarios are generated, stacked and passed together through the feature
+  engineering and the LSTM; predictions are then split back into one dataframe per scenario,
+  and each simulation is registered in the exported_tables of the session, as in run_simulation.
+  : param scenarios: list of dictionaries with keys 'start_date', 'end_date', 'cultivar', 'PH', 'NLP', 
+    'NGL', 'NS', 'IFP', 'MHG'. Tuples or lists with the values in this same order are also accepted.
+    e.g. scenarios = [{'start_date': '2022-12-01', 'end_date': '2023-04-01', 'cultivar': 'SUZY IPRO', 
+    'PH': 63.3, 'NLP': 43.0, 'NGL': 1.71, 'NS': 3.7, 'IFP': 16.8, 'MHG': 156.7}]
+  : param display_results: if True, print the report and display the dataframe of each simulation.
+  : param seed: integer seed. An independent random stream is derived for each scenario with
+    SeedSequence.spawn, so the same seed and scenarios reproduce the same simulations.
+  : param session: SimulationSession where the simulations run. If None, ControlVars is used.
+  Returns the list of simulated dataframes, in the same order as scenarios.
+  """
+  session = get_session(session)
+  scenarios = [scenario if isinstance(scenario, dict) else dict(zip(SCENARIO_KEYS, scenario)) for scenario in scenarios]
+
+  # One child seed per scenario:
+  seeds = np.random.SeedSequence(seed).spawn(len(scenarios))
+  cache = session.result_cache
+  # The stages of the batch are recorded in a single trace, listed in the report of each simulation:
+  trace = session.tracer.trace('simulations') if (session.tracer is not None) else None
+
+  with (trace if (trace is not None) else NULL_SPAN):
+    with span('result_cache'):
+      # The child seeds are reproducible only when the seed is given:
+      cache_keys = [cache.key(scenario, scenario_seed, session) if ((cache is not None) and (seed is not None)) else None
+                    for scenario, scenario_seed in zip(scenarios, seeds)]
+      dfs = [cache.get(cache_key) if (cache_key is not None) else None for cache_key in cache_keys]
+
+    # Only the scenarios not found in the cache are predicted (in a single batch):
+    missing = [index for index, df in enumerate(dfs) if df is None]
+    if (len(missing) > 0):
+      with span('get_dataset'):
+        new_dfs = [get_dataset(*[scenarios[index][key] for key in SCENARIO_KEYS], rng = seeds[index]) for index in missing]
+      with span('batch_prediction_pipeline'):
+        new_dfs = batch_prediction_pipeline(new_dfs, session.cluster_model_path, session.lstm_model_path, verbose = display_results,
+                                            language_pt = session.language_pt, encoding_path = session.encoding_path, backend = session.backend)
+      for index, df in zip(missing, new_dfs):
+        dfs[index] = df
+        if (cache is not None):
+          cache.put(cache_keys[index], df)
+
+  for scenario, df, scenario_seed in zip(scenarios, dfs, seeds):
+    update_control_vars(*[scenario[key] for key in SCENARIO_KEYS], seed = scenario_seed, session = session)
+    report_simulation(df, display_results, session, scenario, scenario_seed, trace)
+
+  return dfs
+
+def visualize_yield (export_images = True, session = None):
   """Plot the GY (yield) for the simulations
   : param: export_images = True keep True to
   export the image files and download them.
+  : param: session: SimulationSession with the simulations. If None, ControlVars is used.
   """
-
-  exported_tables = ControlVars.exported_tables
+  session = get_session(session)
+  exported_tables = session.exported_tables
   # Loop through each simulation:
   for table_dict in exported_tables:
     # Check if it is not a Report table. These tables have 4 initial 
     # characters "REP_" in their sheet names.
     if (table_dict['excel_sheet_name'][:4] != "REP_"):
       
-      if (ControlVars.language_pt):
+      if (session.language_pt):
 
         msg = f"""
       
@@ -232,7 +383,7 @@ def visualize_yield (export_images = True):
       print(msg)
       
       df = table_dict['dataframe_obj_to_be_exported']
-      if (ControlVars.language_pt):
+      if (session.language_pt):
         x = df['dia']
         y = df['produtividade_de_graos']
       
@@ -242,7 +393,7 @@ def visualize_yield (export_images = True):
 
       plot_title = table_dict['excel_sheet_name']
 
-      time_series_vis (x, y, plot_title)
+      time_series_vis (x, y, plot_title, session.language_pt)
 
       if (export_images):
         # Download the png file saved in Colab environment:
@@ -252,15 +403,20 @@ def visualize_yield (export_images = True):
     else:
       pass
 
-def download_excel_with_data():
-  """Download Excel file containing all the tables generated from simulations."""
+def download_excel_with_data(session = None):
+  """Download Excel file containing all the tables generated from simulations.
+  : param: session: SimulationSession with the simulations. If None, ControlVars is used.
+  """
+  session = get_session(session)
   
-  # Create Excel file and store it in Colab's memory:
-  FILE_NAME_WITHOUT_EXTENSION = "soybean_crop_simulations"
-  EXPORTED_TABLES = ControlVars.exported_tables
+  # Create Excel file and store it in Colab's memory.
+  # Only the simulations that were not exported yet are written to the file:
+  FILE_NAME_WITHOUT_EXTENSION = session.excel_file_name
+  EXPORTED_TABLES = session.exported_tables
   FILE_DIRECTORY_PATH = ""
-  export_pd_dataframe_as_excel (file_name_without_extension = FILE_NAME_WITHOUT_EXTENSION, exported_tables = EXPORTED_TABLES, file_directory_path = FILE_DIRECTORY_PATH)
+  export_new_tables_as_excel (file_name_without_extension = FILE_NAME_WITHOUT_EXTENSION, exported_tables = EXPORTED_TABLES, 
+                              file_directory_path = FILE_DIRECTORY_PATH, persisted_sheets = session.persisted_sheets)
 
   # Download the file:
-  FILE_TO_DOWNLOAD_FROM_COLAB = "soybean_crop_simulations.xlsx"
+  FILE_TO_DOWNLOAD_FROM_COLAB = FILE_NAME_WITHOUT_EXTENSION + ".xlsx"
   download_file_from_colab (FILE_TO_DOWNLOAD_FROM_COLAB)
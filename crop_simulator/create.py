@@ -1,8 +1,8 @@
 from .utils import (create_dataset, include_cultivar_column, 
-                    generate_numeric_column, calculate_NGP_linear_reg)
+                    generate_numeric_block, calculate_NGP_linear_reg)
 
 
-def get_dataset (start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG):
+def get_dataset (start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, rng = None):
   """
   start_date (str): start date of the dataset. Format: '2024-02-21'
   end_date (str): end date of the dataset. Format: '2024-02-21'
@@ -13,17 +13,28 @@ def get_dataset (start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG):
   NS (float): NS value
   IFP (float): IFP value
   MHG (float): MHG value
+  rng: numpy random Generator, integer seed or SeedSequence used for the random values.
+    The same seed always returns the same dataset. If None, the values are not reproducible.
   """
   df = create_dataset(start_date, end_date)
+  return fill_dataset(df, cultivar, PH, NLP, NGL, NS, IFP, MHG, rng)
+
+def fill_dataset (df, cultivar, PH, NLP, NGL, NS, IFP, MHG, rng = None):
+  """
+  Add the cultivar and the numeric features to a dataframe with the column 'timestamp'
+  (returned from create_dataset or create_dataset_chunk).
+  : params cultivar, PH, NLP, NGL, NS, IFP, MHG, rng: same of get_dataset.
+  """
   df = include_cultivar_column(df, cultivar)
   total_values = len(df)
-  df['PH'] = generate_numeric_column(PH, 'PH', total_values)
-  df['NLP'] = generate_numeric_column(NLP, 'NLP', total_values)
+  # All the six numeric features are generated in a single block:
+  values = generate_numeric_block([PH, NLP, NGL, NS, IFP, MHG], total_values, rng)
+  df['PH'] = values[:, 0]
+  df['NLP'] = values[:, 1]
   df['NGP'] = calculate_NGP_linear_reg (df['NLP'])
-  df['NGL'] = generate_numeric_column(NGL, 'NGL', total_values)
-  df['NS'] = generate_numeric_column(NS, 'NS', total_values)
-  df['IFP'] = generate_numeric_column(IFP, 'IFP', total_values)
-  df['MHG'] = generate_numeric_column(MHG, 'MHG', total_values)
+  df['NGL'] = values[:, 2]
+  df['NS'] = values[:, 3]
+  df['IFP'] = values[:, 4]
+  df['MHG'] = values[:, 5]
 
   return df
-  
\ No newline at end of file
@@ -0,0 +1,160 @@
+"""Monte Carlo ensemble simulations.
+
+A single simulation returns one noisy GY trajectory, since the crop features are randomized
+around the setpoints. The ensemble runs many stochastic replicas of the same scenario and
+summarizes them per day (mean and quantile bands), without keeping the replicas in memory.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .transform import feature_eng_matrix
+from .utils import (NUMERIC_COLUMNS, create_dataset, include_cultivar_column, get_session,
+                    generate_numeric_block, run_model, reverse_log_transform)
+
+
+class StreamingQuantiles:
+  """
+  Mergeable sketch of the distribution of GY for each day.
+  Each day has a histogram with log-spaced bins from min_value to max_value: updating the sketch
+  only adds counts, two sketches are merged by summing their counts, and the memory does not
+  depend on the number of replicas. Quantiles are interpolated inside the bins, so the relative
+  error is below the bin width, (max_value/min_value)**(1/bins) - 1 (~0.9% with the defaults).
+  Values out of the range are counted in the first or last bin; the exact minimum and maximum
+  of each day are also stored and bound the quantiles.
+  """
+
+  def __init__(self, total_days, min_value = 10.0, max_value = 100000.0, bins = 1024):
+    """
+    total_days (int): number of days (rows) of each replica
+    min_value, max_value (float): range of the histograms, in kg/ha
+    bins (int): number of bins of each histogram
+    """
+    self.total_days = total_days
+    self.bins = bins
+    self.log_min = np.log(min_value)
+    self.bin_width = (np.log(max_value) - self.log_min) / bins
+    self.counts = np.zeros((total_days, bins), dtype = np.int64)
+    self.total = 0 # number of replicas
+    self.sum = np.zeros(total_days)
+    self.min = np.full(total_days, np.inf)
+    self.max = np.full(total_days, -np.inf)
+
+  def update (self, values):
+    """
+    Add replicas to the sketch.
+    values: array with shape (replicas, total_days) with GY in kg/ha
+    """
+    values = np.asarray(values, dtype = np.float64).reshape(-1, self.total_days)
+
+    bin_indices = np.floor((np.log(values) - self.log_min) / self.bin_width).astype(np.int64)
+    bin_indices = np.clip(bin_indices, 0, self.bins - 1)
+    # Position of each value in the flattened (total_days, bins) array of counts:
+    flat_indices = np.arange(self.total_days) * self.bins + bin_indices
+    self.counts += np.bincount(flat_indices.ravel(), minlength = self.total_days * self.bins).reshape(self.total_days, self.bins)
+
+    self.total = self.total + len(values)
+    self.sum += values.sum(axis = 0)
+    self.min = np.minimum(self.min, values.min(axis = 0))
+    self.max = np.maximum(self.max, values.max(axis = 0))
+
+    return self
+
+  def merge (self, other):
+    """Add the counts of other sketch (with the same days and bins) to this one."""
+    self.counts += other.counts
+    self.total = self.total + other.total
+    self.sum += other.sum
+    self.min = np.minimum(self.min, other.min)
+    self.max = np.maximum(self.max, other.max)
+
+    return self
+
+  def mean (self):
+    """Return the mean of each day (NaN if the sketch is empty)."""
+    if (self.total == 0):
+      return np.full(self.total_days, np.nan)
+
+    return self.sum / self.total
+
+  def quantile (self, q):
+    """
+    Return the quantile q (from 0 to 1) of each day (NaN if the sketch is empty).
+    """
+    if (self.total == 0):
+      return np.full(self.total_days, np.nan)
+
+    cumulative_counts = np.cumsum(self.counts, axis = 1)
+    target = q * self.total
+    # First bin where the cumulative count reaches the target:
+    bin_indices = np.argmax(cumulative_counts >= max(target, 1e-12), axis = 1)
+    days = np.arange(self.total_days)
+    counts_in_bin = self.counts[days, bin_indices]
+    counts_before = cumulative_counts[days, bin_indices] - counts_in_bin
+    # Linear interpolation inside the bin:
+    fraction = np.clip((target - counts_before) / np.maximum(counts_in_bin, 1), 0, 1)
+    values = np.exp(self.log_min + (bin_indices + fraction) * self.bin_width)
+
+    return np.clip(values, self.min, self.max)
+
+
+def run_ensemble (start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, replicas = 1000, seed = None,
+                  replicas_per_batch = 100, quantiles = (0.05, 0.50, 0.95), cluster_model_path = None, lstm_model_path = None,
+                  session = None):
+  """
+  Run replicas of a scenario and summarize the GY (kg/ha) of each day.
+  The replicas are generated and predicted in batches of replicas_per_batch, so each batch is a single
+  model.predict call, and they are accumulated in a StreamingQuantiles sketch: the full dataframes
+  of the replicas are never stored.
+  : params start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG: user defined parameters.
+  : param replicas (int): number of stochastic replicas.
+  : param seed: integer seed. Each replica has its own random stream, derived with SeedSequence.spawn.
+  : param replicas_per_batch (int): number of replicas in each model.predict call.
+  : param quantiles: quantiles (from 0 to 1) returned for each day. Default: P5, P50, P95.
+  : param cluster_model_path, lstm_model_path (str): model paths. If None, the paths of the session are used.
+  : param session: SimulationSession with the model paths and language. If None, ControlVars is used.
+  Returns a dataframe with the timestamp, the mean and the quantiles of GY of each day.
+  """
+  if (replicas < 1):
+    raise ValueError(f"replicas must be at least 1, but it is {replicas}.")
+  if (replicas_per_batch < 1):
+    raise ValueError(f"replicas_per_batch must be at least 1, but it is {replicas_per_batch}.")
+
+  session = get_session(session)
+  if (cluster_model_path is None):
+    cluster_model_path = session.cluster_model_path
+  if (lstm_model_path is None):
+    lstm_model_path = session.lstm_model_path
+
+  # Dates and cultivar are the same for all the replicas:
+  base_df = create_dataset(start_date, end_date)
+  base_df = include_cultivar_column(base_df, cultivar)
+  total_values = len(base_df)
+
+  sketch = StreamingQuantiles(total_values)
+  seeds = np.random.SeedSequence(seed).spawn(replicas)
+  setpoints = [PH, NLP, NGL, NS, IFP, MHG]
+
+  for batch_start in range(0, replicas, replicas_per_batch):
+    batch_seeds = seeds[batch_start:(batch_start + replicas_per_batch)]
+    # Each replica draws its numeric features as get_dataset does:
+    values = np.concatenate([generate_numeric_block(setpoints, total_values, replica_seed) for replica_seed in batch_seeds], axis = 0)
+
+    batch_df = pd.DataFrame({'timestamp': np.tile(base_df['timestamp'].to_numpy(), len(batch_seeds)), 'Cultivar': cultivar})
+    for j, column in enumerate(NUMERIC_COLUMNS):
+      batch_df[column] = values[:, j]
+
+    X = feature_eng_matrix(batch_df, cluster_model_path, encoding_path = session.encoding_path)
+    y_pred = run_model(lstm_model_path, X, verbose = False, backend = session.backend)
+    sketch.update(reverse_log_transform(y_pred).reshape(len(batch_seeds), total_values))
+
+  if (session.language_pt):
+    date_column, variable = 'dia', 'produtividade_de_graos'
+  else:
+    date_column, variable = 'timestamp', 'GY'
+
+  summary = pd.DataFrame({date_column: base_df['timestamp'], (variable + '_mean'): sketch.mean()})
+  for q in quantiles:
+    summary[variable + '_P' + str(int(round(q * 100)))] = sketch.quantile(q)
+
+  return summary
@@ -0,0 +1,139 @@
+"""Bounded session history of the simulations.
+
+ControlVars.exported_tables collects two dataframes per simulation (the simulation and its REP_
+report). In long sessions, the history keeps only the most recent tables in memory, within a
+memory budget, and spills the older ones to pickle files in a temporary directory. Spilled
+tables are loaded back transparently when their dataframe is accessed, e.g. by visualize_yield
+or by the Excel export.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import pandas as pd
+
+
+class SpilledTable (dict):
+  """
+  Table dictionary whose dataframe is stored on disk.
+  The dataframe is read from the file only when the key 'dataframe_obj_to_be_exported' is accessed.
+  """
+
+  def __getitem__ (self, key):
+    if ((key == 'dataframe_obj_to_be_exported') and (dict.get(self, key) is None)):
+      return pd.read_pickle(dict.__getitem__(self, 'spilled_path'))
+
+    return dict.__getitem__(self, key)
+
+  def get (self, key, default = None):
+    return self[key] if (key in self) else default
+
+
+class SessionHistory:
+  """
+  List of exported tables with a memory budget.
+  It has the list methods used by the simulator (append, iteration, len, indexing), and the
+  tables are dictionaries with keys 'dataframe_obj_to_be_exported' and 'excel_sheet_name'.
+  """
+
+  def __init__(self, memory_budget_bytes = 256 * 1024 * 1024, spill_directory = None):
+    """
+    memory_budget_bytes (int): maximum size of the dataframes kept in memory. When it is exceeded,
+      the oldest tables are spilled to disk. The most recent table always stays in memory.
+      Use None for no limit.
+    spill_directory (str): parent directory for the spilled tables (the system temporary directory
+      if None). Each history creates its own subdirectory in it when the first table is spilled,
+      so several sessions can share the same spill_directory. The subdirectory is removed when the
+      history is released.
+    """
+    self.memory_budget_bytes = memory_budget_bytes
+    self.spill_root = spill_directory
+    self.spill_directory = None # Subdirectory of this history, created on the first spill
+    self.tables = []
+    self.sizes = [] # size in memory of each resident dataframe (0 for spilled tables)
+    self.lock = threading.RLock()
+
+  def get_spill_directory (self):
+    """Return the directory for spilled tables, creating it if needed."""
+    if ((self.spill_directory is None) or (not os.path.isdir(self.spill_directory))):
+      if (self.spill_root is not None):
+        os.makedirs(self.spill_root, exist_ok = True)
+      # A new directory per history, so the file names of different sessions never collide:
+      self.spill_directory = tempfile.mkdtemp(prefix = 'crop_simulator_history_', dir = self.spill_root)
+      # Remove the temporary files when the history is released or the interpreter exits:
+      weakref.finalize(self, shutil.rmtree, self.spill_directory, True)
+
+    return self.spill_directory
+
+  def append (self, table_dict):
+    """Add a table dictionary to the history, spilling older tables if the memory budget is exceeded."""
+    df = table_dict.get('dataframe_obj_to_be_exported')
+    size = int(df.memory_usage(deep = True).sum()) if isinstance(df, pd.DataFrame) else 0
+
+    with self.lock:
+      self.tables.append(table_dict)
+      self.sizes.append(size)
+      self.enforce_budget()
+
+  def enforce_budget (self):
+    """Spill the oldest resident tables until the resident size fits in the memory budget."""
+    if (self.memory_budget_bytes is None):
+      return
+
+    with self.lock:
+      index = 0
+      # The most recent table is never spilled:
+      while ((self.resident_bytes() > self.memory_budget_bytes) and (index < (len(self.tables) - 1))):
+        if (self.sizes[index] > 0):
+          self.spill(index)
+        index = index + 1
+
+  def spill (self, index):
+    """Write the dataframe of the table in position index to disk and release it from memory."""
+    with self.lock:
+      table_dict = self.tables[index]
+      file_path = os.path.join(self.get_spill_directory(), f"table_{index}.pkl")
+      table_dict['dataframe_obj_to_be_exported'].to_pickle(file_path)
+
+      spilled = SpilledTable(table_dict)
+      spilled['dataframe_obj_to_be_exported'] = None
+      spilled['spilled_path'] = file_path
+      self.tables[index] = spilled
+      self.sizes[index] = 0
+
+  def resident_bytes (self):
+    """Return the size, in bytes, of the dataframes currently kept in memory."""
+    return sum(self.sizes)
+
+  def spilled_tables (self):
+    """Return the number of tables stored on disk."""
+    return sum(isinstance(table_dict, SpilledTable) for table_dict in self.tables)
+
+  def clear (self):
+    """Remove all the tables from the history, including the spilled files."""
+    with self.lock:
+      for table_dict in self.tables:
+        if isinstance(table_dict, SpilledTable):
+          try:
+            os.remove(dict.__getitem__(table_dict, 'spilled_path'))
+          except OSError:
+            pass
+
+      self.tables = []
+      self.sizes = []
+
+  def __len__ (self):
+    return len(self.tables)
+
+  def __getitem__ (self, index):
+    return self.tables[index]
+
+  def __iter__ (self):
+    # Iterate over a snapshot, so that new simulations do not change the iteration:
+    return iter(list(self.tables))
+
+  def __repr__ (self):
+    return f"SessionHistory({len(self.tables)} tables, {self.spilled_tables()} spilled, {self.resident_bytes()} bytes in memory)"
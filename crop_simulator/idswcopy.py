@@ -4,7 +4,6 @@ Classes and functions copied and adapted from IDSW: https://github.com/marcosoar
 """
 from .utils import ControlVars
 import pandas as pd
-import matplotlib.pyplot as plt
 
 
 def export_pd_dataframe_as_excel (file_name_without_extension, exported_tables = [{'dataframedataframe_obj_to_be_exported': None, 'excel_sheet_name': None}], file_directory_path = None):
@@ -97,7 +96,291 @@ def export_pd_dataframe_as_excel (file_name_without_extension, exported_tables =
                                 startrow = 0, startcol = 0, merge_cells = False, 
                                 inf_rep = 'inf')
 
-def time_series_vis (x, y, plot_title):
+def write_dataframe_to_worksheet (worksheet, df):
+    """
+    Write the header and the rows of a dataframe to an openpyxl worksheet, row by row, so that it
+    can be used with write-only (streaming) workbooks.
+    Missing values are written as empty cells and infinite values as 'inf', as in export_pd_dataframe_as_excel.
+
+    : param: worksheet: openpyxl worksheet (regular or write-only).
+    : param: df: Pandas dataframe to be written.
+    """
+    import math
+    import datetime
+    from openpyxl.cell import WriteOnlyCell
+
+    worksheet.append([str(column) for column in df.columns])
+
+    for row in df.itertuples(index = False, name = None):
+        values = []
+        for value in row:
+            if ((value is None) or (value is pd.NaT)):
+                value = None
+            elif isinstance(value, float):
+                if math.isnan(value):
+                    value = None
+                elif math.isinf(value):
+                    value = 'inf' if (value > 0) else '-inf'
+            elif isinstance(value, datetime.datetime):
+                # Same formats of export_pd_dataframe_as_excel:
+                cell = WriteOnlyCell(worksheet, value = pd.Timestamp(value).to_pydatetime())
+                cell.number_format = "YYYY-MM-DD" if (value == pd.Timestamp(value).normalize()) else "YYYY-MM-DD HH:MM:SS"
+                value = cell
+            
+            values.append(value)
+
+        worksheet.append(values)
+
+def append_sheets_to_package (file_path, new_tables):
+    """
+    Append new sheets to an xlsx file without loading the workbook.
+    
+    An xlsx file is a zip package where each sheet is a separate XML part. The new sheets are written
+    with a write-only (streaming) workbook, and their parts are added to the package; only the small
+    parts listing the sheets are parsed and updated: xl/workbook.xml, its relationships,
+    [Content_Types].xml and the sheet titles of docProps/app.xml.
+    The parts of the existing sheets are copied to the new package as zip streams, without being
+    parsed, so the cost of an export no longer grows with the number of sheets already in the file.
+    The write-only workbooks store the strings inline (there is no shared strings table to merge).
+
+    : param: file_path: path of the xlsx file.
+    : param: new_tables: list of tuples (sheet name, dataframe) to append.
+
+    Returns False (and leaves the file unchanged) if the sheets cannot be appended this way: a sheet
+    name already exists in the file, the styles (date formats) of the new sheets differ from the
+    styles of the file, or the file uses markup compatibility declarations (e.g. files saved by Excel),
+    which must keep their namespace prefixes.
+    """
+    import io
+    import os
+    import shutil
+    import tempfile
+    import zipfile
+    from xml.etree import ElementTree
+    from openpyxl import Workbook
+
+    MAIN_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    RELATIONSHIPS_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    PACKAGE_RELATIONSHIPS_NAMESPACE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+    CONTENT_TYPES_NAMESPACE = 'http://schemas.openxmlformats.org/package/2006/content-types'
+    EXTENDED_PROPERTIES_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/extended-properties'
+    VARIANT_TYPES_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes'
+    MARKUP_COMPATIBILITY_NAMESPACE = 'http://schemas.openxmlformats.org/markup-compatibility/2006'
+    WORKSHEET_RELATIONSHIP = RELATIONSHIPS_NAMESPACE + '/worksheet'
+    WORKSHEET_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+    # Parts edited in the package, with the default namespace used to serialize them:
+    EDITED_PARTS = {'xl/workbook.xml': MAIN_NAMESPACE, 'xl/_rels/workbook.xml.rels': PACKAGE_RELATIONSHIPS_NAMESPACE,
+                    '[Content_Types].xml': CONTENT_TYPES_NAMESPACE, 'docProps/app.xml': EXTENDED_PROPERTIES_NAMESPACE}
+
+    def tag (namespace, name):
+        return '{' + namespace + '}' + name
+
+    def serialize (root, namespace):
+        """Serialize a part, with its own namespace as the default namespace (as in the parts written by openpyxl and Excel)."""
+        for element in root.iter():
+            if element.tag.startswith(tag(namespace, '')):
+                element.tag = element.tag[len(tag(namespace, '')):]
+        root.set('xmlns', namespace)
+
+        return ElementTree.tostring(root, encoding = 'UTF-8', xml_declaration = True)
+
+    def update_sheet_titles (properties, sheet_names):
+        """Describe all the sheets in the HeadingPairs and TitlesOfParts of docProps/app.xml. Returns False if they list other parts."""
+        heading_pairs = properties.find(tag(EXTENDED_PROPERTIES_NAMESPACE, 'HeadingPairs'))
+        if ((heading_pairs is not None) and (len(heading_pairs.findall('.//' + tag(VARIANT_TYPES_NAMESPACE, 'lpstr'))) > 1)):
+            # Other kinds of parts (e.g. named ranges) are listed
+            return False
+
+        for name in ('HeadingPairs', 'TitlesOfParts'):
+            element = properties.find(tag(EXTENDED_PROPERTIES_NAMESPACE, name))
+            if (element is not None):
+                properties.remove(element)
+
+        heading_pairs = ElementTree.SubElement(properties, tag(EXTENDED_PROPERTIES_NAMESPACE, 'HeadingPairs'))
+        vector = ElementTree.SubElement(heading_pairs, tag(VARIANT_TYPES_NAMESPACE, 'vector'), {'size': '2', 'baseType': 'variant'})
+        ElementTree.SubElement(ElementTree.SubElement(vector, tag(VARIANT_TYPES_NAMESPACE, 'variant')), tag(VARIANT_TYPES_NAMESPACE, 'lpstr')).text = 'Worksheets'
+        ElementTree.SubElement(ElementTree.SubElement(vector, tag(VARIANT_TYPES_NAMESPACE, 'variant')), tag(VARIANT_TYPES_NAMESPACE, 'i4')).text = str(len(sheet_names))
+
+        titles = ElementTree.SubElement(properties, tag(EXTENDED_PROPERTIES_NAMESPACE, 'TitlesOfParts'))
+        vector = ElementTree.SubElement(titles, tag(VARIANT_TYPES_NAMESPACE, 'vector'), {'size': str(len(sheet_names)), 'baseType': 'lpstr'})
+        for sheet_name in sheet_names:
+            ElementTree.SubElement(vector, tag(VARIANT_TYPES_NAMESPACE, 'lpstr')).text = sheet_name
+
+        return True
+
+    # Package with the new sheets only:
+    buffer = io.BytesIO()
+    workbook = Workbook(write_only = True)
+    for sheet, df in new_tables:
+        write_dataframe_to_worksheet(workbook.create_sheet(title = sheet), df)
+    workbook.save(buffer)
+
+    with zipfile.ZipFile(buffer) as new_package, zipfile.ZipFile(file_path) as package:
+        part_names = set(package.namelist())
+        if ((not all((part_name in part_names) for part_name in EDITED_PARTS)) or ('xl/styles.xml' not in part_names)):
+            return False
+        if (new_package.read('xl/styles.xml') != package.read('xl/styles.xml')):
+            return False
+
+        roots = {part_name: ElementTree.fromstring(package.read(part_name)) for part_name in EDITED_PARTS}
+        if any((tag(MARKUP_COMPATIBILITY_NAMESPACE, 'Ignorable') in element.attrib) for root in roots.values() for element in root.iter()):
+            return False
+
+        sheets_element = roots['xl/workbook.xml'].find(tag(MAIN_NAMESPACE, 'sheets'))
+        relationships = roots['xl/_rels/workbook.xml.rels']
+        content_types = roots['[Content_Types].xml']
+
+        sheet_names = [sheet_element.get('name') for sheet_element in sheets_element]
+        if any((sheet in sheet_names) for sheet, df in new_tables):
+            return False
+
+        # Parts of the new sheets, in the order of the new workbook:
+        new_targets = {relationship.get('Id'): relationship.get('Target')
+                       for relationship in ElementTree.fromstring(new_package.read('xl/_rels/workbook.xml.rels'))}
+        new_sheets = [(sheet_element.get('name'), new_targets[sheet_element.get(tag(RELATIONSHIPS_NAMESPACE, 'id'))])
+                      for sheet_element in ElementTree.fromstring(new_package.read('xl/workbook.xml')).iter(tag(MAIN_NAMESPACE, 'sheet'))]
+
+        # Free identifiers of the package:
+        sheet_id = max([int(sheet_element.get('sheetId')) for sheet_element in sheets_element] + [0])
+        relationship_ids = {relationship.get('Id') for relationship in relationships}
+        relationship_number, part_number = 0, 0
+        new_parts = []
+
+        for sheet, target in new_sheets:
+            sheet_id = sheet_id + 1
+            relationship_number = relationship_number + 1
+            while (f"rId{relationship_number}" in relationship_ids):
+                relationship_number = relationship_number + 1
+            part_number = part_number + 1
+            while (f"xl/worksheets/sheet{part_number}.xml" in part_names):
+                part_number = part_number + 1
+
+            relationship_id, part_name = f"rId{relationship_number}", f"xl/worksheets/sheet{part_number}.xml"
+            relationship_ids.add(relationship_id)
+            part_names.add(part_name)
+
+            ElementTree.SubElement(sheets_element, tag(MAIN_NAMESPACE, 'sheet'), {'name': sheet, 'sheetId': str(sheet_id), 'state': 'visible',
+                                                                                  tag(RELATIONSHIPS_NAMESPACE, 'id'): relationship_id})
+            ElementTree.SubElement(relationships, tag(PACKAGE_RELATIONSHIPS_NAMESPACE, 'Relationship'),
+                                   {'Type': WORKSHEET_RELATIONSHIP, 'Target': '/' + part_name, 'Id': relationship_id})
+            ElementTree.SubElement(content_types, tag(CONTENT_TYPES_NAMESPACE, 'Override'), {'PartName': '/' + part_name, 'ContentType': WORKSHEET_CONTENT_TYPE})
+            new_parts.append((part_name, target.lstrip('/')))
+            sheet_names.append(sheet)
+
+        if (not update_sheet_titles(roots['docProps/app.xml'], sheet_names)):
+            return False
+
+        edited_parts = {part_name: serialize(root, EDITED_PARTS[part_name]) for part_name, root in roots.items()}
+
+        # The new package is written next to the file and replaces it at the end, so the file is never partially written:
+        file_descriptor, temporary_path = tempfile.mkstemp(dir = (os.path.dirname(os.path.abspath(file_path))), suffix = '.xlsx.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as opened_file, zipfile.ZipFile(opened_file, 'w', zipfile.ZIP_DEFLATED) as output:
+                for info in package.infolist():
+                    if info.filename in edited_parts:
+                        output.writestr(info.filename, edited_parts[info.filename])
+                    else:
+                        with package.open(info) as source, output.open(info, 'w') as target:
+                            shutil.copyfileobj(source, target, 1 << 20)
+
+                for part_name, new_part_name in new_parts:
+                    output.writestr(part_name, new_package.read(new_part_name))
+
+            os.replace(temporary_path, file_path)
+
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    return True
+
+def export_new_tables_as_excel (file_name_without_extension, exported_tables, file_directory_path = "", persisted_sheets = None):
+    """
+    Incremental version of export_pd_dataframe_as_excel for the simulation sessions.
+    
+    The sheets already written to the file are recorded in ControlVars.persisted_sheets, so each
+    export only writes the tables (simulation and REP_ sheets) that were not exported yet, instead
+    of rewriting all the sheets of the workbook each time.
+    If the file was modified or removed outside this session, its record is discarded and all the
+    tables are exported again.
+    - When the file does not exist yet, it is created with a write-only (streaming) workbook, so the
+      rows are written without building the whole workbook in memory.
+    - Otherwise, the sheets already in the file are kept, as in export_pd_dataframe_as_excel (including
+      sheets written by other sessions or programs). The new sheets are written with a write-only
+      workbook and added to the zip package of the file (see append_sheets_to_package), without
+      loading the sheets already written. If that is not possible (e.g. a sheet with the same name
+      must be replaced, or the file was saved by another program), the workbook is loaded and the
+      new sheets are added to it, replacing the sheets with the same names.
+
+    : param: file_name_without_extension - (string, in quotes): name of the file without the extension.
+    : param: exported_tables: list of dictionaries with keys 'dataframe_obj_to_be_exported' and 'excel_sheet_name',
+      as in export_pd_dataframe_as_excel.
+    : param: file_directory_path - (string, in quotes): path of the directory where the file is stored.
+    : param: persisted_sheets: dictionary with the record of the sheets already written to each file
+      (e.g. SimulationSession.persisted_sheets). If None, ControlVars.persisted_sheets is used.
+
+    Returns the list of sheet names written in this export.
+    """
+    import os
+    from openpyxl import Workbook, load_workbook
+
+    file_path = os.path.join(file_directory_path, file_name_without_extension) + ".xlsx"
+    key = os.path.abspath(file_path)
+    if (persisted_sheets is None):
+        persisted_sheets = ControlVars.persisted_sheets
+
+    # Get the record of the sheets already written to this file:
+    record = persisted_sheets.get(key)
+    append = os.path.exists(file_path)
+    if ((record is None) or (not append) or (os.stat(file_path).st_mtime_ns != record['mtime'])):
+        # File was not written by this session or changed: all the tables are exported
+        record = {'mtime': None, 'sheets': set()}
+
+    new_tables = []
+    for storage_dict in exported_tables:
+        sheet = storage_dict['excel_sheet_name']
+        # The sheet name is checked first, so that tables spilled to disk are only loaded when they are new:
+        if ((sheet is not None) and (str(sheet) not in record['sheets'])):
+            df = storage_dict['dataframe_obj_to_be_exported']
+            if ((df is not None) & (type(df) == pd.DataFrame)):
+                # Guarantee sheet name is a string
+                new_tables.append((str(sheet), df))
+
+    if ((len(new_tables) == 0) & append):
+        return []
+
+    if (append and append_sheets_to_package(file_path, new_tables)):
+        record['sheets'].update(sheet for sheet, df in new_tables)
+        record['mtime'] = os.stat(file_path).st_mtime_ns
+        persisted_sheets[key] = record
+        return [sheet for sheet, df in new_tables]
+
+    if (append):
+        workbook = load_workbook(file_path)
+    else:
+        # Streaming (write-only) workbook: rows are flushed as they are appended
+        workbook = Workbook(write_only = True)
+
+    for sheet, df in new_tables:
+        if (append and (sheet in workbook.sheetnames)):
+            del workbook[sheet]
+        worksheet = workbook.create_sheet(title = sheet)
+        write_dataframe_to_worksheet(worksheet, df)
+
+    if ((not append) & (len(new_tables) == 0)):
+        # A workbook must have at least one sheet
+        workbook.create_sheet(title = "Sheet1")
+
+    workbook.save(file_path)
+
+    record['sheets'].update(sheet for sheet, df in new_tables)
+    record['mtime'] = os.stat(file_path).st_mtime_ns
+    persisted_sheets[key] = record
+
+    return [sheet for sheet, df in new_tables]
+
+def time_series_vis (x, y, plot_title, language_pt = None):
     """
     SIMPLIFIED VERSION FROM ORIGINAL IDSW FUNCTION
 
@@ -116,6 +399,9 @@ def time_series_vis (x, y, plot_title):
      https://matplotlib.org/stable/_downloads/2a7b13c059456984288f5b84b4b73f45/colors.ipynb
 
     """
+    # matplotlib is only imported when a plot is created
+    import matplotlib.pyplot as plt
+
     LINE_STYLE = '-'
     # Alternatively: LINE_STYLE = '' not to show spline lines
     MARKER = ''
@@ -124,7 +410,10 @@ def time_series_vis (x, y, plot_title):
     y_axis_rotation = 0 
     grid = True
 
-    if (ControlVars.language_pt == True):
+    if (language_pt is None):
+      language_pt = ControlVars.language_pt
+
+    if (language_pt == True):
       vertical_axis_title = "Produtividade de Grãos (kg/ha)"
       horizontal_axis_title = "Data"
     
@@ -214,6 +503,8 @@ class LoadCropSimulator:
     self.cmd_line3 = """mv crop_model_proj_case_soybean_uci/models_and_encodings/kmeans_model.pkl ."""
     # Move LSTM model to root
     self.cmd_line4 = """mv crop_model_proj_case_soybean_uci/models_and_encodings/lstm.keras ."""
+    # Move One-Hot encodings to root
+    self.cmd_line5 = """mv crop_model_proj_case_soybean_uci/models_and_encodings/OneHot_encoding_list.pkl ."""
 
 
 
@@ -276,6 +567,10 @@ class LoadCropSimulator:
     self.proc4 = self.set_process (self.cmd_line4)
     # RUN PROCESS:
     self.output4, self.error4 = self.run_process(self.proc4)
+    # SET PROCESS:
+    self.proc5 = self.set_process (self.cmd_line5)
+    # RUN PROCESS:
+    self.output5, self.error5 = self.run_process(self.proc5)
 
 
     return self
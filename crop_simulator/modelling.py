@@ -1,17 +1,85 @@
-from .transform import feature_eng_pipeline
-from .utils import (ControlVars, run_model, update_df)
+from .transform import feature_eng_matrix, batch_feature_matrix
+import numpy as np
+from .utils import (ControlVars, deduplicate_rows, run_model, update_df)
+from .tracing import span
 
-def prediction_pipeline(df, cluster_model_path, lstm_model_path):
+def prediction_pipeline(df, cluster_model_path, lstm_model_path, language_pt = None, encoding_path = None, verbose = True, backend = None):
   """
   df: dataframe that will be prepared for the LSTM Modelling
   cluster_model_path (str): path for the KMeans pkl file
   lstm_model_path (str): path for the .keras model file
+  language_pt (bool): language of the messages and columns. If None, ControlVars.language_pt is used.
+  encoding_path (str): path for the OneHot_encoding_list.pkl file. If None, ControlVars.encoding_path is used.
+  verbose (bool): if False, no message nor progress bar is printed during the prediction
+  backend: inference backend (see backends.py). If None, it is inferred from the extension of lstm_model_path.
   """
-  transformed_df = feature_eng_pipeline (df, cluster_model_path)
-  y_pred = run_model (lstm_model_path, transformed_df)
-  dataset = update_df (df, y_pred)
+  with span('feature_engineering'):
+    X = feature_eng_matrix (df, cluster_model_path, encoding_path = encoding_path)
+  with span('inference'):
+    y_pred = run_model (lstm_model_path, X, verbose, language_pt, backend)
+  with span('update_df'):
+    dataset = update_df (df, y_pred)
+    dataset = translate_columns (dataset, language_pt)
 
-  if (ControlVars.language_pt):
+  return dataset
+
+def batch_prediction_pipeline(dfs, cluster_model_path, lstm_model_path, verbose = True, language_pt = None, encoding_path = None,
+                              backend = None, deduplicate = True):
+  """
+  Run the prediction pipeline for several scenarios at once: the feature matrices of all scenarios
+  are stacked into one array (see transform.batch_feature_matrix), so that model.predict runs only
+  once for the whole batch. Predictions are then split back into one dataframe per scenario.
+  dfs: list of dataframes (one per scenario) that will be prepared for the LSTM Modelling
+  cluster_model_path (str): path for the KMeans pkl file
+  lstm_model_path (str): path for the .keras model file
+  verbose (bool): if False, no message nor progress bar is printed during the prediction
+  language_pt (bool): language of the messages and columns. If None, ControlVars.language_pt is used.
+  encoding_path (str): path for the OneHot_encoding_list.pkl file. If None, ControlVars.encoding_path is used.
+  backend: inference backend (see backends.py). If None, it is inferred from the extension of lstm_model_path.
+  deduplicate (bool): if True, rows repeated in the batch (e.g. the same scenario and seed requested
+    several times) are predicted only once, and the prediction is copied back to each repetition.
+  """
+  if (len(dfs) == 0):
+    return []
+
+  lengths = [len(df) for df in dfs]
+  # Indices where each scenario ends:
+  split_indices = np.cumsum(lengths)[:-1]
+
+  # Each row is an independent sample for the model, so the scenarios can be stacked:
+  with span('feature_engineering'):
+    X = batch_feature_matrix (dfs, cluster_model_path, encoding_path = encoding_path)
+
+  unique_indices, inverse = (None, None)
+  if (deduplicate):
+    with span('deduplication'):
+      unique_indices, inverse = deduplicate_rows (X)
+
+  with span('inference'):
+    if (unique_indices is None):
+      y_pred = run_model (lstm_model_path, X, verbose, language_pt, backend)
+    else:
+      # Predict the distinct rows, then scatter the predictions back to all the rows:
+      y_pred = np.asarray(run_model (lstm_model_path, X[unique_indices], verbose, language_pt, backend))[inverse]
+  datasets = []
+
+  for df, scenario_preds in zip(dfs, np.split(y_pred, split_indices)):
+    dataset = update_df (df, scenario_preds)
+    dataset = translate_columns (dataset, language_pt)
+    datasets.append(dataset)
+
+  return datasets
+
+def translate_columns(dataset, language_pt = None):
+  """
+  Rename the columns to Portuguese when language_pt is True.
+  dataset: dataframe with the predictions
+  language_pt (bool): if None, ControlVars.language_pt is used.
+  """
+  if (language_pt is None):
+    language_pt = ControlVars.language_pt
+
+  if (language_pt):
     # Modify columns labels
     """
     - Altura da planta (PH, cm) – determinada da superfície do solo até a inserção da última folha com régua milimetrada
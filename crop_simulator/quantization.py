@@ -0,0 +1,151 @@
+"""Post-training quantization of the Keras models.
+
+Builds quantized TFLite variants of the bundled Keras models (dynamic-range, float16 and int8),
+calibrated on the feature matrices of the experimental data (dataset.csv), and reports, for each
+variant, the GY error against the float Keras model, the size of the model and its latency.
+The variants are stored in the TFLite cache (see backends.tflite_cache_path) and are selected with
+the backends 'tflite_dynamic', 'tflite_float16' and 'tflite_int8', e.g.
+    run_model('lstm.keras', X, backend = 'tflite_dynamic')
+    SimulationSession(backend = 'tflite_dynamic')
+
+Run from the command line, e.g.:
+    python -m crop_simulator.quantization --models lstm cnn --budget 0.02
+"""
+
+import os
+import sys
+import json
+import statistics
+
+import numpy as np
+
+from .benchmarks import REPOSITORY_PATH, MODELS_PATH, load_dataset_matrix, time_call
+
+
+QUANTIZATIONS = ['dynamic', 'float16', 'int8']
+
+
+def calibration_matrix (dataset_path = None, cluster_model_path = None):
+  """
+  Feature matrix of the experimental data, used to calibrate the int8 variants.
+  dataset_path (str): csv with the columns of dataset.csv (timestamp, Cultivar, PH, IFP, NLP, NGL, NS, MHG).
+    Default: dataset.csv of the repository.
+  cluster_model_path (str): path for the KMeans pkl file. Default: models_and_encodings/kmeans_model.pkl
+  Returns the float32 (n, 33) array returned from feature_eng_pipeline, in the order of LSTM_COLUMNS.
+  """
+  import pandas as pd
+  from .transform import feature_eng_pipeline
+
+  if (dataset_path is None):
+    dataset_path = os.path.join(REPOSITORY_PATH, 'dataset.csv')
+  if (cluster_model_path is None):
+    cluster_model_path = os.path.join(MODELS_PATH, 'kmeans_model.pkl')
+
+  dataset = pd.read_csv(dataset_path, parse_dates = ['timestamp'])
+  return feature_eng_pipeline(dataset, cluster_model_path).to_numpy(dtype = np.float32)
+
+def convert_in_child_process (model_path, output_path, batch_size = 64, quantization = None, calibration_data = None):
+  """
+  Run backends.convert_to_tflite in a child process, so that a crash of the converter (the int8
+  calibration may abort the interpreter) does not stop the simulator.
+  Raises RuntimeError if the conversion fails. Returns the path of the flatbuffer.
+  """
+  import multiprocessing
+  from concurrent.futures import ProcessPoolExecutor
+  from concurrent.futures.process import BrokenProcessPool
+  from .backends import convert_to_tflite
+
+  context = multiprocessing.get_context('spawn')
+  try:
+    with ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+      return executor.submit(convert_to_tflite, model_path, output_path, batch_size, quantization, calibration_data).result()
+
+  except BrokenProcessPool:
+    raise RuntimeError(f"The TFLite converter crashed while converting {model_path} with quantization '{quantization}'.")
+
+def quantize_models (models = None, quantizations = QUANTIZATIONS, calibration_dataset_path = None, evaluation_dataset_path = None,
+                     batch_size = 64, cache_directory = None, budget = 0.02, repeats = 20):
+  """
+  Build the quantized variants of the Keras models and compare them with the float models.
+  : param models (list): names of the bundled Keras models (see backends.BUNDLED_MODELS). If None, all of them.
+  : param quantizations (list): variants to build ('dynamic', 'float16', 'int8').
+  : param calibration_dataset_path (str): data for the int8 calibration (see calibration_matrix). Default: dataset.csv
+  : param evaluation_dataset_path (str): csv with the 33 features (see benchmarks.load_dataset_matrix).
+    Default: generated_datasets/dataset4.csv, so the variants are not evaluated on the calibration data.
+  : param batch_size (int): fixed batch of the flatbuffers.
+  : param cache_directory (str): directory of the flatbuffers (see backends.tflite_cache_path).
+  : param budget (float): accepted relative error of GY: a variant is within the budget when the 95th percentile
+    of |GY_variant / GY_float - 1| is below it.
+  : param repeats (int): number of timed predictions of the evaluation data.
+  Returns a list of dictionaries (one per model and variant, including the float32 TFLite model as
+  reference) with the size in bytes, the median latency in ms, the relative GY errors (mean, p95 and
+  max) against the float Keras model and the flag 'within_budget'. Variants that cannot be built have
+  the key 'error'.
+  """
+  from .backends import BUNDLED_MODELS, TFLiteEngine, first_output, get_backend, tflite_cache_path
+
+  if (models is None):
+    models = [name for name, file_name in BUNDLED_MODELS.items() if file_name.endswith('.keras')]
+
+  X, y_log = load_dataset_matrix(evaluation_dataset_path)
+  calibration_data = calibration_matrix(calibration_dataset_path) if ('int8' in quantizations) else None
+  results = []
+
+  for model_name in models:
+    model_path = os.path.join(MODELS_PATH, BUNDLED_MODELS[model_name])
+    reference = np.asarray(get_backend('keras').run(model_path, X), dtype = np.float64)
+
+    for quantization in [None] + list(quantizations):
+      result = {'case': 'quantization', 'model': model_name, 'quantization': (quantization or 'float32'),
+                'keras_file_bytes': os.path.getsize(model_path)}
+      flatbuffer_path = tflite_cache_path(model_path, batch_size, cache_directory, quantization)
+
+      try:
+        if (not os.path.exists(flatbuffer_path)):
+          convert_in_child_process(model_path, flatbuffer_path, batch_size, quantization, calibration_data)
+
+        # The engine is used directly, so that a broken flatbuffer is reported instead of falling back to Keras:
+        engine = TFLiteEngine(flatbuffer_path)
+        y_pred = np.asarray(first_output(engine.predict(X)), dtype = np.float64)
+        times = time_call(lambda: engine.predict(X), repeats)
+
+      except Exception as exception:
+        result['error'] = str(exception)
+        results.append(result)
+        continue
+
+      relative_errors = np.abs(np.expm1(y_pred - reference))
+      result.update({'path': flatbuffer_path, 'size_bytes': os.path.getsize(flatbuffer_path), 'rows': len(X),
+                     'median_latency_ms': statistics.median(times) * 1000,
+                     'mean_relative_error_GY': float(relative_errors.mean()),
+                     'p95_relative_error_GY': float(np.percentile(relative_errors, 95)),
+                     'max_relative_error_GY': float(relative_errors.max()),
+                     'budget': budget, 'within_budget': bool(np.percentile(relative_errors, 95) <= budget)})
+      results.append(result)
+
+  return results
+
+
+def main (args = None):
+  """Command line interface."""
+  import argparse
+
+  parser = argparse.ArgumentParser(prog = "python -m crop_simulator.quantization", description = "Build and evaluate quantized variants of the Keras models")
+  parser.add_argument('--models', nargs = '*', default = None, help = "bundled Keras models (default: all)")
+  parser.add_argument('--quantizations', nargs = '*', default = QUANTIZATIONS, choices = QUANTIZATIONS)
+  parser.add_argument('--calibration-dataset', default = None, help = "default: dataset.csv")
+  parser.add_argument('--evaluation-dataset', default = None, help = "default: generated_datasets/dataset4.csv")
+  parser.add_argument('--batch-size', type = int, default = 64)
+  parser.add_argument('--cache-directory', default = None)
+  parser.add_argument('--budget', type = float, default = 0.02, help = "accepted p95 relative error of GY")
+  parser.add_argument('--repeats', type = int, default = 20)
+  args = parser.parse_args(args)
+
+  results = quantize_models(args.models, args.quantizations, args.calibration_dataset, args.evaluation_dataset,
+                            args.batch_size, args.cache_directory, args.budget, args.repeats)
+  print(json.dumps(results, indent = 2))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
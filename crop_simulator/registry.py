@@ -0,0 +1,131 @@
+"""Process-wide registry of the model artifacts used by the simulator.
+
+Loading the LSTM (.keras) and the KMeans (.pkl) files dominates the latency of a single
+simulation. The registry keeps each deserialized model in memory, keyed by its path and
+by the modification time of the file, so that it is loaded only once per process and
+reloaded only when the file on disk changes.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from .tracing import span
+
+
+def load_model_artifact (model_path):
+  """Deserialize a model file, selecting the loader from the file extension.
+  model_path (str): path of the .pkl (pickled scikit-learn object) file, or of a model of an
+    inference backend (.keras/.h5 for TensorFlow, .json/.ubj for XGBoost; see backends.py)
+  """
+  extension = os.path.splitext(model_path)[1].lower()
+
+  if (extension == '.pkl'):
+    import pickle
+
+    with open(model_path, 'rb') as opened_file:
+      model = pickle.load(opened_file)
+
+  else:
+    # TensorFlow (or XGBoost) is only imported when the model is really needed
+    from .backends import get_backend
+    model = get_backend(model_path = model_path).load(model_path)
+
+  return model
+
+
+class ModelRegistry:
+  """Cache of loaded models shared by all the simulations run in the process."""
+
+  def __init__(self, max_models = 4):
+    """
+    max_models (int): maximum number of models kept resident in memory. When a new model is
+      loaded and the cap is exceeded, the least recently used model is released.
+    """
+    self.max_models = max_models
+    # path (or path#variant) -> (modification time in ns, model object). OrderedDict keeps the LRU order.
+    self.models = OrderedDict()
+    self.lock = threading.RLock()
+    self.loads = 0 # Count how many times a file was deserialized
+    self.hits = 0 # Count how many times a resident model was reused
+
+  def get (self, model_path, loader = None, variant = None):
+    """Return the model stored in model_path, loading it only if it is not resident or if the
+    file was modified since it was loaded.
+    model_path (str): path of the model file
+    loader: function that receives the path and returns the model object. If None,
+      load_model_artifact is used.
+    variant (str): name of a different object built from the same file (e.g. 'tflite' for an
+      interpreter converted from the .keras model). Each variant is cached separately.
+    """
+    if (loader is None):
+      loader = load_model_artifact
+
+    key = os.path.abspath(model_path)
+    mtime = os.stat(key).st_mtime_ns
+    if (variant is not None):
+      key = key + '#' + str(variant)
+
+    with self.lock:
+      if key in self.models:
+        cached_mtime, model = self.models[key]
+        if (cached_mtime == mtime):
+          self.models.move_to_end(key)
+          self.hits = self.hits + 1
+          return model
+
+      with span('load_model'):
+        model = loader(model_path)
+      self.loads = self.loads + 1
+      self.models[key] = (mtime, model)
+      self.models.move_to_end(key)
+
+      # Release the least recently used models above the cap:
+      while (len(self.models) > max(1, self.max_models)):
+        self.models.popitem(last = False)
+
+    return model
+
+  def invalidate (self, model_path = None):
+    """Remove a model (and its variants) from the registry, forcing a reload on next use.
+    model_path (str): path of the model file. If None, all the models are released.
+    """
+    with self.lock:
+      if (model_path is None):
+        self.models.clear()
+      else:
+        path = os.path.abspath(model_path)
+        for key in [key for key in self.models if ((key == path) or key.startswith(path + '#'))]:
+          self.models.pop(key)
+
+  def warm_up (self, model_paths):
+    """Load the models in advance, so that the first simulation does not pay for deserialization.
+    model_paths (list): list of paths of model files. Paths that do not exist are ignored.
+    """
+    for model_path in model_paths:
+      if os.path.exists(model_path):
+        self.get(model_path)
+
+    return self
+
+  def resident_models (self):
+    """Return the list of paths of the models currently loaded, from the least to the most recently used."""
+    with self.lock:
+      return list(self.models.keys())
+
+
+# Default registry used by the simulation pipelines:
+model_registry = ModelRegistry(max_models = 4)
+
+
+def get_model (model_path, loader = None, variant = None):
+  """Return the model from model_path using the process-wide registry."""
+  return model_registry.get(model_path, loader, variant)
+
+def invalidate_models (model_path = None):
+  """Release one model (model_path) or all models (model_path = None) from the process-wide registry."""
+  model_registry.invalidate(model_path)
+
+def warm_up_models (model_paths):
+  """Load the models from model_paths into the process-wide registry."""
+  return model_registry.warm_up(model_paths)
@@ -0,0 +1,328 @@
+"""Content-addressed cache of simulation results.
+
+With a seed, a simulation is deterministic: the same inputs, seed and model files always return
+the same dataframe. ResultCache stores the dataframe returned from the prediction pipeline under
+a SHA-256 key of (inputs, seed, language, backend, hashes of the model files), so a repeated
+scenario skips get_dataset and prediction_pipeline. Simulations without a seed (or with a numpy
+Generator, whose state changes) are never cached.
+
+The cache has an in-memory LRU tier and an optional on-disk tier (one pickle per result), which
+is evicted from the least recently used file when it exceeds its size budget. The disk tier is
+stored in a subdirectory owned by the cache (CACHE_DIRECTORY_NAME) of the given directory, so
+clearing the cache never removes other files. The disk entries are grouped in a directory per
+combination of model hashes, so the entries of a modified model are removed when the change is
+detected.
+
+e.g.
+    session = SimulationSession(result_cache = ResultCache(directory = 'simulation_cache'))
+    session.run_simulation('2022-12-01', '2023-04-01', 'SUZY IPRO', 63.3, 43.0, 1.71, 3.7, 16.8, 156.7, seed = 1)
+    session.result_cache.stats()
+"""
+
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .utils import SCENARIO_KEYS, get_session
+
+
+CACHE_VERSION = 2 # Changed when the cached results are no longer compatible
+# Hash of the encoder when the encoding file is not available (get_cultivar_encoder then uses the list CULTIVARS):
+DEFAULT_ENCODER_HASH = 'default_cultivars'
+CACHE_DIRECTORY_NAME = 'crop_simulator_result_cache' # Subdirectory of the disk tier, owned by the cache
+
+
+def normalize_seed (seed):
+  """
+  Return a JSON-serializable description of the random stream of a seed, or None if the seed does
+  not define a reproducible stream (None, or a numpy Generator).
+  Integer seeds are described as SeedSequence(seed), since get_dataset uses np.random.default_rng.
+  """
+  if isinstance(seed, (int, np.integer)) and (not isinstance(seed, bool)):
+    seed = np.random.SeedSequence(int(seed))
+
+  if isinstance(seed, np.random.SeedSequence):
+    entropy = seed.entropy if isinstance(seed.entropy, int) else [int(value) for value in seed.entropy]
+    return {'entropy': entropy, 'spawn_key': [int(value) for value in seed.spawn_key], 'pool_size': int(seed.pool_size)}
+
+  return None
+
+def normalize_inputs (inputs):
+  """
+  Return the user defined parameters in the order of SCENARIO_KEYS: the dates as ISO strings of their
+  parsed values (so '2022-12-01' and pd.Timestamp('2022-12-01') are the same), the cultivar as a string
+  and the crop parameters as floats.
+  """
+  import pandas as pd
+
+  def normalize (key, value):
+    if key in ('start_date', 'end_date'):
+      return pd.Timestamp(value).isoformat()
+    if (key == 'cultivar'):
+      return str(value)
+    return float(value)
+
+  return [normalize(key, inputs[key]) for key in SCENARIO_KEYS]
+
+
+class ResultCache:
+  """Two-tier (memory LRU and optional disk) cache of simulated dataframes."""
+
+  def __init__(self, max_entries = 256, directory = None, max_disk_bytes = 256 * 1024 * 1024):
+    """
+    max_entries (int): maximum number of dataframes kept in memory.
+    directory (str): directory of the disk tier. The files are stored in its subdirectory
+      CACHE_DIRECTORY_NAME. If None, only the memory tier is used.
+    max_disk_bytes (int): size budget of the disk tier. When it is exceeded, the least recently
+      used files are removed.
+    """
+    self.max_entries = max_entries
+    self.directory = None if (directory is None) else os.path.join(directory, CACHE_DIRECTORY_NAME)
+    self.max_disk_bytes = max_disk_bytes
+    # Running total of the size of the disk tier. None when unknown: the files are then listed
+    # again (on the first store, after an invalidation, or when the budget is exceeded).
+    self.disk_bytes = None
+
+    self.entries = OrderedDict() # key -> (model hashes, dataframe). OrderedDict keeps the LRU order.
+    self.file_hashes = {} # absolute path -> (modification time in ns, size, hash)
+    self.lock = threading.RLock()
+
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.stores = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def model_hash (self, model_path):
+    """
+    Return the hash of the contents of a model file. The file is only read again when its
+    modification time or size change; if its contents changed, the entries computed with the
+    previous contents are removed.
+    """
+    from .utils import model_file_hash
+
+    path = os.path.abspath(model_path)
+    stat = os.stat(path)
+
+    with self.lock:
+      cached = self.file_hashes.get(path)
+      if ((cached is not None) and (cached[:2] == (stat.st_mtime_ns, stat.st_size))):
+        return cached[2]
+
+      file_hash = model_file_hash(path)
+      self.file_hashes[path] = (stat.st_mtime_ns, stat.st_size, file_hash)
+      if ((cached is not None) and (cached[2] != file_hash)):
+        self.remove_model_hash(cached[2])
+
+      return file_hash
+
+  def key (self, inputs, seed, session = None):
+    """
+    Return the key of a simulation, or None if it cannot be cached (no seed).
+    inputs (dict): user defined parameters (keys of SCENARIO_KEYS)
+    seed: integer seed or numpy SeedSequence of the simulation
+    session: SimulationSession (or ControlVars) with the language, the backend and the model paths.
+    Returns a tuple (key, model hashes).
+    """
+    seed = normalize_seed(seed)
+    if (seed is None):
+      return None
+
+    session = get_session(session)
+    # The encoding file is optional: without it, the encoder is built from the list CULTIVARS
+    if ((session.encoding_path is not None) and os.path.exists(session.encoding_path)):
+      encoder_hash = self.model_hash(session.encoding_path)
+    else:
+      encoder_hash = DEFAULT_ENCODER_HASH
+    model_hashes = (self.model_hash(session.lstm_model_path), self.model_hash(session.cluster_model_path), encoder_hash)
+    backend = session.backend if ((session.backend is None) or isinstance(session.backend, str)) else type(session.backend).__name__
+    content = json.dumps({'version': CACHE_VERSION, 'inputs': normalize_inputs(inputs), 'seed': seed,
+                          'language_pt': bool(session.language_pt), 'backend': backend, 'models': model_hashes}, sort_keys = True)
+
+    return hashlib.sha256(content.encode('utf-8')).hexdigest(), model_hashes
+
+  def disk_path (self, key, model_hashes):
+    """Return the path of the disk entry of a key."""
+    return os.path.join(self.directory, '-'.join(model_hashes), key + '.pkl')
+
+  def get (self, cache_key):
+    """
+    Return a copy of the cached dataframe of a key returned from self.key, or None if it is not cached.
+    Disk hits are promoted to the memory tier.
+    """
+    if (cache_key is None):
+      return None
+
+    key, model_hashes = cache_key
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        self.memory_hits = self.memory_hits + 1
+        return self.entries[key][1].copy()
+
+      if (self.directory is not None):
+        path = self.disk_path(key, model_hashes)
+        try:
+          with open(path, 'rb') as opened_file:
+            df = pickle.load(opened_file)
+          # The modification time marks the recent use for the eviction:
+          os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+          df = None
+
+        if (df is not None):
+          self.disk_hits = self.disk_hits + 1
+          self.store_in_memory(key, model_hashes, df)
+          return df.copy()
+
+      self.misses = self.misses + 1
+      return None
+
+  def store_in_memory (self, key, model_hashes, df):
+    """Store the dataframe in the memory tier, releasing the least recently used entries above max_entries."""
+    self.entries[key] = (model_hashes, df)
+    self.entries.move_to_end(key)
+    while (len(self.entries) > max(0, self.max_entries)):
+      self.entries.popitem(last = False)
+      self.evictions = self.evictions + 1
+
+  def put (self, cache_key, df):
+    """Store a copy of the dataframe under a key returned from self.key. Keys equal to None are ignored."""
+    if (cache_key is None):
+      return
+
+    key, model_hashes = cache_key
+    df = df.copy()
+    with self.lock:
+      self.store_in_memory(key, model_hashes, df)
+      self.stores = self.stores + 1
+
+      if (self.directory is not None):
+        path = self.disk_path(key, model_hashes)
+        if (self.disk_bytes is None):
+          self.disk_bytes = sum(size for mtime, size, file_path in self.disk_files())
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        # Written to a temporary file and renamed, so a reader never finds a partial file:
+        file_descriptor, temporary_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+        with os.fdopen(file_descriptor, 'wb') as opened_file:
+          pickle.dump(df, opened_file, protocol = pickle.HIGHEST_PROTOCOL)
+          written_bytes = opened_file.tell()
+
+        # A file with the same key is replaced:
+        replaced_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temporary_path, path)
+        self.disk_bytes = self.disk_bytes + written_bytes - replaced_bytes
+
+        # The files are only listed when the running total exceeds the budget:
+        if (self.disk_bytes > self.max_disk_bytes):
+          self.evict_disk()
+
+  def get_or_compute (self, cache_key, compute):
+    """Return the cached dataframe of the key, or call compute() and store its result."""
+    df = self.get(cache_key)
+    if (df is None):
+      df = compute()
+      self.put(cache_key, df)
+
+    return df
+
+  def disk_files (self):
+    """Return the list of (modification time, size, path) of the files of the disk tier."""
+    files = []
+    if ((self.directory is None) or (not os.path.exists(self.directory))):
+      return files
+
+    for root, directories, file_names in os.walk(self.directory):
+      for file_name in file_names:
+        if file_name.endswith('.pkl'):
+          path = os.path.join(root, file_name)
+          stat = os.stat(path)
+          files.append((stat.st_mtime_ns, stat.st_size, path))
+
+    return files
+
+  def evict_disk (self):
+    """
+    Remove the least recently used files of the disk tier until it fits in max_disk_bytes.
+    The files are listed again, so the running total self.disk_bytes is also refreshed.
+    """
+    with self.lock:
+      files = sorted(self.disk_files())
+      total_bytes = sum(size for mtime, size, path in files)
+
+      for mtime, size, path in files:
+        if (total_bytes <= self.max_disk_bytes):
+          break
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+        total_bytes = total_bytes - size
+        self.evictions = self.evictions + 1
+
+      self.disk_bytes = total_bytes
+
+  def remove_model_hash (self, file_hash):
+    """Remove the entries (memory and disk) computed with a model whose contents hash to file_hash."""
+    with self.lock:
+      for key in [key for key, (model_hashes, df) in self.entries.items() if file_hash in model_hashes]:
+        self.entries.pop(key)
+        self.invalidations = self.invalidations + 1
+
+      if ((self.directory is not None) and os.path.exists(self.directory)):
+        for directory in os.listdir(self.directory):
+          if file_hash in directory.split('-'):
+            path = os.path.join(self.directory, directory)
+            self.invalidations = self.invalidations + len(os.listdir(path))
+            shutil.rmtree(path, ignore_errors = True)
+            self.disk_bytes = None
+
+  def invalidate (self, model_path = None):
+    """
+    Remove cached results.
+    model_path (str): remove the results computed with the current contents of this model file
+      (a modified file is also detected automatically). If None, the whole cache is cleared.
+    """
+    with self.lock:
+      if (model_path is not None):
+        self.remove_model_hash(self.model_hash(model_path))
+        return
+
+      self.invalidations = self.invalidations + len(self.entries)
+      self.entries.clear()
+      self.file_hashes.clear()
+      # Only the files of the disk tier are removed (the directory may have been created by the user):
+      for mtime, size, path in self.disk_files():
+        try:
+          os.remove(path)
+        except OSError:
+          pass
+      if ((self.directory is not None) and os.path.exists(self.directory)):
+        for directory in os.listdir(self.directory):
+          path = os.path.join(self.directory, directory)
+          if (os.path.isdir(path) and (len(os.listdir(path)) == 0)):
+            os.rmdir(path)
+      self.disk_bytes = None
+
+  def stats (self):
+    """Return a dictionary with the hit and miss counters and the size of each tier."""
+    with self.lock:
+      hits = self.memory_hits + self.disk_hits
+      requests = hits + self.misses
+      files = self.disk_files()
+      if (self.directory is not None):
+        self.disk_bytes = sum(size for mtime, size, path in files)
+
+      return {'hits': hits, 'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+              'hit_rate': ((hits / requests) if (requests > 0) else 0.0), 'stores': self.stores,
+              'evictions': self.evictions, 'invalidations': self.invalidations,
+              'memory_entries': len(self.entries), 'disk_entries': len(files),
+              'disk_bytes': sum(size for mtime, size, path in files)}
@@ -0,0 +1,101 @@
+"""Columnar results store for the simulations.
+
+Each simulation is appended to a Parquet dataset partitioned by cultivar and by the date the
+simulation was run (Hive layout: cultivar=<name>/run_date=<YYYY-MM-DD>/<simulation_id>.parquet),
+with a 'simulation_id' column. The inputs of each simulation are stored in a metadata dataset
+with the same layout. The datasets can be queried across simulations with predicate pushdown,
+so only the matching partitions and columns are read from disk.
+
+Requires pyarrow (pip install pyarrow).
+"""
+
+import os
+from urllib.parse import quote
+
+import pandas as pd
+
+
+class ParquetResultsStore:
+  """Append-only Parquet dataset with the simulated days and the metadata of each simulation."""
+
+  def __init__(self, root_path = 'soybean_crop_simulations'):
+    """
+    root_path (str): directory of the store. The simulated days are stored in root_path/simulations
+      and the metadata in root_path/reports.
+    """
+    self.root_path = root_path
+    self.simulations_path = os.path.join(root_path, 'simulations')
+    self.reports_path = os.path.join(root_path, 'reports')
+
+  def partition_path (self, base_path, cultivar, run_date):
+    """Return the directory of a partition. Partition values are URI-encoded, as expected by pyarrow's Hive partitioning."""
+    return os.path.join(base_path, 'cultivar=' + quote(str(cultivar), safe = ''), 'run_date=' + str(run_date))
+
+  def append (self, df, simulation_id, metadata):
+    """
+    Store a simulation.
+    df: dataframe returned from the prediction pipeline
+    simulation_id (str): unique identifier of the simulation (e.g. its Excel sheet name)
+    metadata (dict): inputs and report information of the simulation. It must contain the key 'cultivar',
+      and may contain 'conclusion_time' (used as the run date; default: now).
+    Returns the path of the Parquet file with the simulated days.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    conclusion_time = pd.Timestamp(metadata.get('conclusion_time', pd.Timestamp.now()))
+    run_date = conclusion_time.strftime('%Y-%m-%d')
+    cultivar = metadata['cultivar']
+    file_name = quote(str(simulation_id), safe = '') + '.parquet'
+
+    # Simulated days:
+    directory = self.partition_path(self.simulations_path, cultivar, run_date)
+    os.makedirs(directory, exist_ok = True)
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    table = table.add_column(0, 'simulation_id', pa.array([str(simulation_id)] * len(df), type = pa.string()))
+    file_path = os.path.join(directory, file_name)
+    pq.write_table(table, file_path)
+
+    # Metadata (one row per simulation):
+    directory = self.partition_path(self.reports_path, cultivar, run_date)
+    os.makedirs(directory, exist_ok = True)
+    report = {'simulation_id': str(simulation_id)}
+    report.update({key: value for key, value in metadata.items() if key != 'cultivar'})
+    report['conclusion_time'] = conclusion_time
+    report_table = pa.Table.from_pandas(pd.DataFrame([report]), preserve_index = False)
+    pq.write_table(report_table, os.path.join(directory, file_name))
+
+    return file_path
+
+  def read_table (self, base_path, columns = None, filters = None, memory_map = True):
+    """Read a dataset of the store as a pyarrow Table."""
+    import pyarrow.parquet as pq
+
+    if (not os.path.exists(base_path)):
+      return None
+
+    return pq.read_table(base_path, columns = columns, filters = filters, partitioning = 'hive', memory_map = memory_map)
+
+  def read (self, columns = None, filters = None, memory_map = True, as_arrow = False):
+    """
+    Read the simulated days of the stored simulations.
+    columns (list): columns to read. If None, all the columns (including the partitions 'cultivar' and 'run_date') are read.
+    filters: predicates pushed down to the dataset, so that only the matching partitions and row groups are read.
+      e.g. filters = [('cultivar', '=', 'SUZY IPRO'), ('run_date', '>=', '2024-01-01')]
+      or filters = [('simulation_id', 'in', ['sim1_1708000000.0'])]
+    memory_map (bool): if True, the files are memory-mapped instead of read into buffers.
+    as_arrow (bool): if True, return the pyarrow Table (zero-copy); otherwise, a pandas dataframe.
+    """
+    table = self.read_table(self.simulations_path, columns, filters, memory_map)
+    if (table is None):
+      return None
+
+    return table if as_arrow else table.to_pandas()
+
+  def read_reports (self, columns = None, filters = None, memory_map = True, as_arrow = False):
+    """Read the metadata of the stored simulations. Parameters are the same of read."""
+    table = self.read_table(self.reports_path, columns, filters, memory_map)
+    if (table is None):
+      return None
+
+    return table if as_arrow else table.to_pandas()
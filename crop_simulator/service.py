@@ -0,0 +1,352 @@
+"""Local HTTP simulation service.
+
+The service exposes run_simulation as a JSON endpoint for dashboards. Concurrent requests are
+coalesced by a MicroBatcher: the requests that arrive within a small time window are feature
+engineered together and predicted with a single model.predict call on the cached LSTM, and the
+predictions are then sent back to each request.
+
+Endpoints:
+    POST /simulate   body: {"start_date": "2022-12-01", "end_date": "2023-04-01", "cultivar": "SUZY IPRO",
+                            "PH": 63.3, "NLP": 43.0, "NGL": 1.71, "NS": 3.7, "IFP": 16.8, "MHG": 156.7, "seed": 1}
+    GET  /metrics    queue depth, batch size histogram and p50/p99 latency (and the counters of the
+                     result cache of the session, if any)
+    GET  /health
+
+The service is a WSGI application, so it can be served by any WSGI server, by serve (standard
+library server, one thread per request), or called in-process with ServiceClient, without sockets.
+The simulations of the service are not added to the history of the session by default, so a
+long-running service does not accumulate tables (in memory or spilled to disk); use register = True
+(--register from the command line) to export them with the session.
+From the command line:
+    python -m crop_simulator.service --port 8000
+"""
+
+import io
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from .utils import SCENARIO_KEYS, get_session
+
+
+class MicroBatcher:
+  """
+  Request coalescer for the prediction pipeline.
+  A background thread takes the dataframes submitted by concurrent requests from a queue, waits
+  at most max_wait_seconds for other requests after the first one (or until max_batch_size requests
+  are collected), and runs them through batch_prediction_pipeline, i.e. one model.predict call.
+  """
+
+  def __init__(self, cluster_model_path, lstm_model_path, language_pt = None, encoding_path = None,
+               max_batch_size = 64, max_wait_seconds = 0.005, latency_window = 10000, backend = None):
+    """
+    cluster_model_path (str): path for the KMeans pkl file
+    lstm_model_path (str): path for the .keras model file
+    language_pt (bool): language of the columns. If None, ControlVars.language_pt is used.
+    encoding_path (str): path for the OneHot_encoding_list.pkl file. If None, ControlVars.encoding_path is used.
+    max_batch_size (int): maximum number of requests predicted together
+    max_wait_seconds (float): time window for coalescing requests, counted from the first request of the batch
+    latency_window (int): number of recent requests used for the latency percentiles
+    backend: inference backend (see backends.py). If None, it is inferred from the extension of lstm_model_path.
+    """
+    self.cluster_model_path = cluster_model_path
+    self.lstm_model_path = lstm_model_path
+    self.language_pt = language_pt
+    self.encoding_path = encoding_path
+    self.backend = backend
+    self.max_batch_size = max_batch_size
+    self.max_wait_seconds = max_wait_seconds
+
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    self.batch_sizes = {} # histogram: {batch size: number of batches}
+    self.latencies = deque(maxlen = latency_window) # seconds from submit to result
+    self.requests = 0
+    self.errors = 0
+
+    self.closed = False
+    self.thread = threading.Thread(target = self.run, name = 'crop_simulator_batcher', daemon = True)
+    self.thread.start()
+
+  def submit (self, df):
+    """
+    Queue the dataframe returned from get_dataset for prediction.
+    Returns a concurrent.futures.Future with the predicted dataframe.
+    """
+    if (self.closed):
+      raise RuntimeError("The batcher is closed.")
+
+    future = Future()
+    self.queue.put((df, future, time.perf_counter()))
+    return future
+
+  def predict (self, df, timeout = None):
+    """Submit the dataframe and wait for its predictions."""
+    return self.submit(df).result(timeout)
+
+  def collect_batch (self):
+    """Wait for a request and collect the requests that arrive within the time window."""
+    first = self.queue.get()
+    if (first is None):
+      return None
+
+    batch = [first]
+    deadline = time.perf_counter() + self.max_wait_seconds
+    while (len(batch) < self.max_batch_size):
+      remaining = deadline - time.perf_counter()
+      try:
+        # Requests already in the queue are taken without waiting:
+        item = self.queue.get(timeout = remaining) if (remaining > 0) else self.queue.get_nowait()
+      except queue.Empty:
+        break
+
+      if (item is None):
+        # Closing: finish this batch, then stop
+        self.queue.put(None)
+        break
+      batch.append(item)
+
+    return batch
+
+  def predict_batch (self, dfs):
+    """Return the list of predicted dataframes (see batch_prediction_pipeline)."""
+    from .modelling import batch_prediction_pipeline
+
+    return batch_prediction_pipeline(dfs, self.cluster_model_path, self.lstm_model_path, verbose = False,
+                                     language_pt = self.language_pt, encoding_path = self.encoding_path, backend = self.backend)
+
+  def run (self):
+    """Loop of the background thread."""
+    while True:
+      batch = self.collect_batch()
+      if (batch is None):
+        return
+
+      dfs = [df for df, future, submit_time in batch]
+      # (result, exception) of each request:
+      try:
+        outcomes = [(result, None) for result in self.predict_batch(dfs)]
+      except Exception as exception:
+        if (len(batch) == 1):
+          outcomes = [(None, exception)]
+        else:
+          # A bad request must not fail the requests coalesced with it: they are predicted one by one
+          outcomes = []
+          for df in dfs:
+            try:
+              outcomes.append((self.predict_batch([df])[0], None))
+            except Exception as request_exception:
+              outcomes.append((None, request_exception))
+
+      end_time = time.perf_counter()
+      failed = sum(1 for result, exception in outcomes if exception is not None)
+      with self.lock:
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+        self.requests = self.requests + len(batch) - failed
+        self.errors = self.errors + failed
+        self.latencies.extend(end_time - submit_time for (df, future, submit_time), (result, exception) in zip(batch, outcomes)
+                              if exception is None)
+
+      for (df, future, submit_time), (result, exception) in zip(batch, outcomes):
+        if (exception is None):
+          future.set_result(result)
+        else:
+          future.set_exception(exception)
+
+  def stats (self):
+    """Return a dictionary with the queue depth, the batch size histogram and the latency percentiles (in ms)."""
+    with self.lock:
+      latencies = np.array(self.latencies)
+      batch_sizes = dict(sorted(self.batch_sizes.items()))
+      requests, errors = self.requests, self.errors
+
+    total_batches = sum(batch_sizes.values())
+
+    return {'queue_depth': self.queue.qsize(), 'requests': requests, 'errors': errors, 'batches': total_batches,
+            'mean_batch_size': ((sum(size * count for size, count in batch_sizes.items()) / total_batches) if (total_batches > 0) else 0.0),
+            'batch_size_histogram': {str(size): count for size, count in batch_sizes.items()},
+            'latency_p50_ms': (float(np.percentile(latencies, 50) * 1000) if (len(latencies) > 0) else None),
+            'latency_p99_ms': (float(np.percentile(latencies, 99) * 1000) if (len(latencies) > 0) else None)}
+
+  def close (self):
+    """Stop the background thread after the queued requests are predicted."""
+    if (not self.closed):
+      self.closed = True
+      self.queue.put(None)
+      self.thread.join()
+
+
+class SimulationService:
+  """WSGI application running the simulations of a session through a MicroBatcher."""
+
+  def __init__(self, session = None, max_batch_size = 64, max_wait_seconds = 0.005, register = False):
+    """
+    session: SimulationSession with the language, model paths and result cache. If None, ControlVars is used.
+      A dedicated SimulationSession is recommended, so the service does not share its history with the notebook.
+    max_batch_size (int), max_wait_seconds (float): parameters of the MicroBatcher.
+    register (bool): if True, each simulation and its report are appended to the exported_tables of the
+      session, as in run_simulation. The history grows with every request, so it is disabled by default.
+    """
+    self.session = get_session(session)
+    self.register = register
+    self.batcher = MicroBatcher(self.session.cluster_model_path, self.session.lstm_model_path,
+                                language_pt = self.session.language_pt, encoding_path = self.session.encoding_path,
+                                max_batch_size = max_batch_size, max_wait_seconds = max_wait_seconds, backend = self.session.backend)
+
+  def simulate (self, inputs, seed = None):
+    """
+    Run a simulation. If self.register is True, it is registered in the session as run_simulation does (without printing).
+    inputs (dict): user defined parameters (keys of SCENARIO_KEYS)
+    seed: integer seed for the random values
+    Returns the simulation id (sheet name, None if it was not registered) and the simulated dataframe.
+    """
+    from .core import report_simulation
+    from .create import get_dataset
+
+    cache = self.session.result_cache
+    cache_key = cache.key(inputs, seed, self.session) if (cache is not None) else None
+    df = cache.get(cache_key) if (cache_key is not None) else None
+
+    if (df is None):
+      df = get_dataset(*[inputs[key] for key in SCENARIO_KEYS], rng = seed)
+      df = self.batcher.predict(df)
+      if (cache is not None):
+        cache.put(cache_key, df)
+
+    if (not self.register):
+      return None, df
+
+    with self.session.lock:
+      simulation_id = report_simulation(df, False, self.session, inputs, seed)
+
+    return simulation_id, df
+
+  def handle_simulate (self, body):
+    """Handle POST /simulate. Returns the status and the response dictionary."""
+    try:
+      payload = json.loads(body or b'{}')
+      missing = [key for key in SCENARIO_KEYS if key not in payload]
+      if (len(missing) > 0):
+        return '400 Bad Request', {'error': f"Missing parameters: {missing}"}
+
+      inputs = {key: payload[key] for key in SCENARIO_KEYS}
+      seed = payload.get('seed')
+
+    except (ValueError, TypeError) as exception:
+      return '400 Bad Request', {'error': str(exception)}
+
+    try:
+      simulation_id, df = self.simulate(inputs, seed)
+    except (ValueError, TypeError) as exception:
+      # e.g. invalid dates or seed
+      return '400 Bad Request', {'error': str(exception)}
+    except Exception as exception:
+      # e.g. a model file that cannot be loaded: still answered with a JSON body
+      return '500 Internal Server Error', {'error': f"{type(exception).__name__}: {exception}"}
+
+    records = json.loads(df.to_json(orient = 'records', date_format = 'iso'))
+    return '200 OK', {'simulation_id': simulation_id, 'inputs': inputs, 'seed': seed, 'columns': list(df.columns), 'data': records}
+
+  def __call__ (self, environ, start_response):
+    """WSGI entry point."""
+    method = environ.get('REQUEST_METHOD', 'GET')
+    path = environ.get('PATH_INFO', '/')
+
+    if ((method == 'POST') and (path == '/simulate')):
+      length = int(environ.get('CONTENT_LENGTH') or 0)
+      status, response = self.handle_simulate(environ['wsgi.input'].read(length))
+    elif ((method == 'GET') and (path == '/metrics')):
+      response = self.batcher.stats()
+      if (self.session.result_cache is not None):
+        response['result_cache'] = self.session.result_cache.stats()
+      status = '200 OK'
+    elif ((method == 'GET') and (path == '/health')):
+      status, response = '200 OK', {'status': 'ok'}
+    else:
+      status, response = '404 Not Found', {'error': f"{method} {path} not found"}
+
+    body = json.dumps(response).encode('utf-8')
+    start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+    return [body]
+
+  def close (self):
+    """Stop the batcher."""
+    self.batcher.close()
+
+
+class ServiceClient:
+  """
+  In-process client for a SimulationService (or any WSGI application): requests are passed
+  directly to the application, without sockets, so the service can be exercised locally.
+  Calls from several threads are coalesced by the service as concurrent HTTP requests are.
+  """
+
+  def __init__(self, app):
+    self.app = app
+
+  def request (self, method, path, payload = None):
+    """Returns the HTTP status code and the decoded JSON response."""
+    body = b'' if (payload is None) else json.dumps(payload).encode('utf-8')
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'CONTENT_TYPE': 'application/json',
+               'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+    response_status = []
+
+    def start_response (status, headers):
+      response_status.append(status)
+
+    content = b''.join(self.app(environ, start_response))
+    return int(response_status[0].split(' ')[0]), json.loads(content)
+
+  def get (self, path):
+    return self.request('GET', path)
+
+  def post (self, path, payload):
+    return self.request('POST', path, payload)
+
+
+def serve (host = '127.0.0.1', port = 8000, session = None, max_batch_size = 64, max_wait_seconds = 0.005, register = False):
+  """
+  Serve the simulations over HTTP with the standard library WSGI server, handling each request
+  in its own thread, so that concurrent requests are coalesced. Blocks until interrupted.
+  : param host, port: address of the server. The default host only accepts local connections.
+  : params session, max_batch_size, max_wait_seconds, register: parameters of SimulationService.
+  """
+  from socketserver import ThreadingMixIn
+  from wsgiref.simple_server import WSGIServer, make_server
+
+  class ThreadingWSGIServer (ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+  service = SimulationService(session, max_batch_size, max_wait_seconds, register)
+  server = make_server(host, port, service, server_class = ThreadingWSGIServer)
+  print(f"Crop Simulator service running on http://{host}:{port}")
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.close()
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser(prog = "python -m crop_simulator.service", description = "Crop Simulator HTTP service")
+  parser.add_argument('--host', default = '127.0.0.1')
+  parser.add_argument('--port', type = int, default = 8000)
+  parser.add_argument('--max-batch-size', type = int, default = 64)
+  parser.add_argument('--max-wait-ms', type = float, default = 5.0, help = "time window for coalescing requests")
+  parser.add_argument('--english', action = 'store_true', help = "return the columns in English")
+  parser.add_argument('--register', action = 'store_true', help = "add the simulations to the session history")
+  args = parser.parse_args()
+
+  from .session import SimulationSession
+  serve(args.host, args.port, SimulationSession(language_pt = (not args.english)), args.max_batch_size, args.max_wait_ms / 1000,
+        args.register)
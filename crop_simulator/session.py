@@ -0,0 +1,77 @@
+"""Simulation sessions.
+
+A session carries the state of a sequence of simulations: language, model paths, simulation
+counter, exported tables and the inputs of the last simulation. The module-level functions
+(run_simulation, run_simulations, visualize_yield, download_excel_with_data) use the default
+session, ControlVars. Simulations that run concurrently in one process (threads, async tasks or
+a server with several users) should each use their own SimulationSession, so that they do not
+share their inputs and results.
+
+e.g.
+    session = SimulationSession(language_pt = False)
+    session.run_simulation('2022-12-01', '2023-04-01', 'SUZY IPRO', 63.3, 43.0, 1.71, 3.7, 16.8, 156.7)
+    session.exported_tables
+"""
+
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import pandas as pd
+
+from .history import SessionHistory
+
+
+@dataclass
+class SimulationSession:
+  """
+  State of a simulation session. It has the same attributes of ControlVars, so any function
+  with a parameter 'session' accepts either a SimulationSession or ControlVars.
+  """
+
+  language_pt: bool = True # If language_pt = True, responses are shown in Portugues (BR). Otherwise, they are in English
+  cluster_model_path: str = 'kmeans_model.pkl'
+  lstm_model_path: str = 'lstm.keras' # Model used for the predictions: the LSTM or other bundled model (e.g. 'xgb_model.json')
+  backend: str = None # Inference backend (see backends.py). If None, it is inferred from the extension of lstm_model_path
+  encoding_path: str = 'OneHot_encoding_list.pkl'
+  results_store: object = None # Optional ParquetResultsStore where each simulation is appended
+  result_cache: object = None # Optional ResultCache (see result_cache.py): seeded simulations already run are not computed again
+  tracer: object = None # Optional Tracer (see tracing.py): time and memory of each stage, attached to the REP_ table
+  excel_file_name: str = 'soybean_crop_simulations' # Excel file written by download_excel_with_data (without extension)
+  server_start_time: pd.Timestamp = field(default_factory = lambda: pd.Timestamp(datetime.now()))
+  simulation_counter: int = 0 # Count how many simulations were run in this session
+  exported_tables: SessionHistory = field(default_factory = SessionHistory)
+  persisted_sheets: dict = field(default_factory = dict) # Sheets already written to each exported Excel file
+  # Inputs of the last simulation of the session:
+  seed: object = None
+  start_date: str = None
+  end_date: str = None
+  cultivar: str = None
+  PH: float = None
+  NLP: float = None
+  NGL: float = None
+  NS: float = None
+  IFP: float = None
+  MHG: float = None
+  df: pd.DataFrame = field(default = None, repr = False) # Dataframe of the last simulation
+  lock: object = field(default_factory = threading.RLock, repr = False, compare = False)
+
+  def run_simulation (self, start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed = None, display_results = True):
+    """Run a simulation in this session. Parameters are the same of crop_simulator.run_simulation."""
+    from .core import run_simulation
+    return run_simulation(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed, session = self, display_results = display_results)
+
+  def run_simulations (self, scenarios, display_results = False, seed = None):
+    """Run several simulations in this session. Parameters are the same of crop_simulator.run_simulations."""
+    from .core import run_simulations
+    return run_simulations(scenarios, display_results, seed, session = self)
+
+  def visualize_yield (self, export_images = True):
+    """Plot the GY (yield) of the simulations of this session."""
+    from .core import visualize_yield
+    return visualize_yield(export_images, session = self)
+
+  def download_excel_with_data (self):
+    """Download the Excel file with the tables of the simulations of this session."""
+    from .core import download_excel_with_data
+    return download_excel_with_data(session = self)
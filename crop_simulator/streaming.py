@@ -0,0 +1,126 @@
+"""Streaming simulations for long horizons.
+
+run_simulation creates every day of the range in one dataframe, which is copied by each stage before
+a single model.predict. stream_simulation walks the date range in chunks of chunk_days days instead:
+each chunk is generated, feature engineered into a reused buffer and predicted, and the predicted
+chunk is yielded, so the memory used by the simulation does not grow with the horizon (only the
+process-wide table of frequency features grows, up to its bound; see utils.FrequencyFeatureTable).
+run_streaming_simulation passes
+the chunks to a sink (a CSV or Parquet file, a socket, or any function receiving a dataframe).
+
+The dates and the deterministic features of the chunks are the same of create_dataset. The random
+values of each chunk are drawn from its own stream (spawned from the seed), so a streamed simulation
+is reproducible for the same seed and chunk_days, but it is not the same draw as run_simulation.
+
+e.g.
+    summary = run_streaming_simulation('2000-01-01', '2030-01-01', 'SUZY IPRO', 63.3, 43.0, 1.71, 3.7, 16.8, 156.7,
+                                       sink = ParquetSink('simulation_30_years.parquet'), seed = 1)
+"""
+
+import numpy as np
+
+from .utils import dataset_length, get_session
+
+
+def stream_simulation (start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed = None, chunk_days = 365, session = None):
+  """
+  Generator of the predicted chunks of a simulation.
+  : params start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG: user defined parameters.
+  : param seed: integer seed (or SeedSequence). A stream is spawned from it for each chunk.
+  : param chunk_days (int): number of days of each chunk.
+  : param session: SimulationSession with the language, the backend and the model paths. If None,
+    ControlVars is used. The chunks are not registered in the session.
+  Yields dataframes with the columns returned from run_simulation and the index of their rows in the
+  whole simulation.
+  """
+  from .create import fill_dataset
+  from .transform import feature_eng_matrix
+  from .modelling import translate_columns
+  from .utils import LSTM_COLUMNS, create_dataset_chunk, run_model, update_df
+
+  session = get_session(session)
+  if (chunk_days < 1):
+    raise ValueError("chunk_days must be at least 1.")
+
+  total_days = dataset_length(start_date, end_date)
+  if (total_days < 0):
+    raise ValueError(f"The end date ({end_date}) must not be before the start date ({start_date}).")
+  seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+  # Feature matrix reused by all the chunks:
+  X_buffer = np.empty((min(chunk_days, max(total_days, 0)), len(LSTM_COLUMNS)), dtype = np.float32)
+
+  for start_index in range(0, total_days, chunk_days):
+    df = create_dataset_chunk(start_date, end_date, start_index, start_index + chunk_days)
+    df = fill_dataset(df, cultivar, PH, NLP, NGL, NS, IFP, MHG, rng = seed_sequence.spawn(1)[0])
+
+    X = feature_eng_matrix(df, session.cluster_model_path, out = X_buffer[:len(df)], encoding_path = session.encoding_path)
+    y_pred = run_model(session.lstm_model_path, X, False, session.language_pt, session.backend)
+    df = update_df(df, y_pred)
+
+    yield translate_columns(df, session.language_pt)
+
+
+class CsvSink:
+  """Sink appending the chunks to a CSV file (the header is written with the first chunk)."""
+
+  def __init__(self, path, **to_csv_kwargs):
+    self.path = path
+    self.to_csv_kwargs = to_csv_kwargs
+    self.header_written = False
+
+  def write (self, df):
+    df.to_csv(self.path, mode = ('a' if self.header_written else 'w'), header = (not self.header_written), index = False, **self.to_csv_kwargs)
+    self.header_written = True
+
+  def close (self):
+    pass
+
+
+class ParquetSink:
+  """Sink writing each chunk as a row group of a Parquet file. Requires pyarrow (pip install pyarrow)."""
+
+  def __init__(self, path):
+    self.path = path
+    self.writer = None
+
+  def write (self, df):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    if (self.writer is None):
+      self.writer = pq.ParquetWriter(self.path, table.schema)
+    self.writer.write_table(table)
+
+  def close (self):
+    if (self.writer is not None):
+      self.writer.close()
+      self.writer = None
+
+
+def run_streaming_simulation (start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, sink, seed = None,
+                              chunk_days = 365, session = None):
+  """
+  Run a simulation in chunks (see stream_simulation), passing each predicted chunk to the sink.
+  : param sink: object with the method write(df) (and, optionally, close(), called at the end), such as
+    CsvSink or ParquetSink, or a function receiving each chunk (e.g. sending it through a socket).
+  : params seed, chunk_days, session: same of stream_simulation.
+  Returns a dictionary with the number of chunks and days, and the mean, minimum and maximum GY (kg/ha).
+  """
+  write = sink.write if hasattr(sink, 'write') else sink
+  chunks, days, total_GY, min_GY, max_GY = 0, 0, 0.0, np.inf, -np.inf
+
+  try:
+    for df in stream_simulation(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed, chunk_days, session):
+      write(df)
+      # GY is the last column in both languages:
+      GY = df.iloc[:, -1].to_numpy()
+      chunks, days = chunks + 1, days + len(df)
+      total_GY, min_GY, max_GY = total_GY + GY.sum(), min(min_GY, GY.min()), max(max_GY, GY.max())
+
+  finally:
+    if hasattr(sink, 'close'):
+      sink.close()
+
+  return {'chunks': chunks, 'days': days, 'mean_GY': ((total_GY / days) if (days > 0) else None),
+          'min_GY': (float(min_GY) if (days > 0) else None), 'max_GY': (float(max_GY) if (days > 0) else None)}
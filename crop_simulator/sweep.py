@@ -0,0 +1,270 @@
+"""Parameter sweeps over cultivars and crop parameters.
+
+The scenarios of a sweep are expanded from a grid or from a Latin hypercube design, split into
+chunks and distributed over a pool of worker processes. Each worker loads the KMeans and LSTM
+models once, when it starts, and runs each chunk with a single model.predict call.
+"""
+
+import os
+import time
+import itertools
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from .utils import ControlVars, CULTIVARS, NUMERIC_COLUMNS, SCENARIO_KEYS, VAR_CHARACTERISTICS, get_session
+
+
+@dataclass
+class SweepResult:
+  """Results of a sweep."""
+
+  results: pd.DataFrame # Simulated days of all the scenarios, identified by the column 'scenario_id'
+  scenarios: pd.DataFrame # Parameters of each scenario, identified by the column 'scenario_id'
+  failed: list = field(default_factory = list) # scenario_id of the scenarios that could not be simulated
+  errors: dict = field(default_factory = dict) # scenario_id -> error message of the failed scenarios
+  elapsed_seconds: float = 0.0
+  throughput: float = 0.0 # simulated scenarios per second
+
+
+def expand_grid (start_date, end_date, cultivars, PH, NLP, NGL, NS, IFP, MHG):
+  """
+  Expand a full grid of scenarios: all the combinations of the values.
+  : params start_date, end_date (str): dates of all the scenarios. Format: '2024-02-21'
+  : params cultivars, PH, NLP, NGL, NS, IFP, MHG: single values or lists of values.
+  Returns the list of scenario dictionaries (as accepted by run_simulations).
+  """
+  def as_list (value):
+    return list(value) if isinstance(value, (list, tuple, np.ndarray)) else [value]
+
+  scenarios = []
+  for values in itertools.product(as_list(cultivars), as_list(PH), as_list(NLP), as_list(NGL), as_list(NS), as_list(IFP), as_list(MHG)):
+    scenarios.append(dict(zip(SCENARIO_KEYS, [start_date, end_date] + list(values))))
+
+  return scenarios
+
+def latin_hypercube (total_scenarios, start_date, end_date, cultivars = None, bounds = None, seed = None):
+  """
+  Sample scenarios with a Latin hypercube design: the range of each crop parameter is divided into
+  total_scenarios strata of equal width, and each stratum is sampled exactly once.
+  : param total_scenarios (int): number of scenarios
+  : params start_date, end_date (str): dates of all the scenarios. Format: '2024-02-21'
+  : param cultivars (list): cultivars distributed evenly over the scenarios. If None, the 40 cultivars are used.
+  : param bounds (dict): {'PH': (min, max), ...} for the crop parameters. Parameters that are not in the
+    dictionary are sampled in the range of the experimental data (VAR_CHARACTERISTICS).
+  : param seed: integer seed for the design.
+  Returns the list of scenario dictionaries (as accepted by run_simulations).
+  """
+  rng = np.random.default_rng(seed)
+
+  if (cultivars is None):
+    cultivars = CULTIVARS
+  if (bounds is None):
+    bounds = {}
+
+  columns = {}
+  for column in NUMERIC_COLUMNS:
+    low, high = bounds.get(column, (VAR_CHARACTERISTICS[column]['min'], VAR_CHARACTERISTICS[column]['max']))
+    # One random point inside each stratum, with the strata in random order:
+    strata = (rng.permutation(total_scenarios) + rng.random(total_scenarios)) / total_scenarios
+    columns[column] = low + strata * (high - low)
+
+  # Cultivars are repeated to complete the design and shuffled:
+  repeated_cultivars = np.resize(np.asarray(cultivars, dtype = object), total_scenarios)
+  columns['cultivar'] = rng.permutation(repeated_cultivars)
+
+  scenarios = []
+  for i in range(total_scenarios):
+    scenario = {'start_date': start_date, 'end_date': end_date, 'cultivar': columns['cultivar'][i]}
+    for column in NUMERIC_COLUMNS:
+      scenario[column] = float(columns[column][i])
+    scenarios.append(scenario)
+
+  return scenarios
+
+
+def _init_worker (cluster_model_path, lstm_model_path, language_pt, encoding_path, backend):
+  """Load the models once in each worker process."""
+  from .registry import warm_up_models
+  from .utils import get_kmeans_centroids
+
+  ControlVars.language_pt = language_pt
+  ControlVars.cluster_model_path = cluster_model_path
+  ControlVars.lstm_model_path = lstm_model_path
+  ControlVars.encoding_path = encoding_path
+  ControlVars.backend = backend
+  get_kmeans_centroids(cluster_model_path)
+  warm_up_models([lstm_model_path])
+
+def _run_chunk (scenario_ids, scenarios, seeds):
+  """
+  Simulate a chunk of scenarios in a worker process with one model.predict call.
+  Errors are deterministic, so they are not retried: if the chunk raises an error, its scenarios are
+  simulated one by one, and only the scenarios that raise are reported as failed.
+  Returns the dataframe of the simulated scenarios and a dictionary {scenario_id: error message} of the failed ones.
+  """
+  from .create import get_dataset
+  from .modelling import batch_prediction_pipeline
+
+  def simulate (ids, chunk_scenarios, chunk_seeds):
+    dfs = [get_dataset(*[scenario[key] for key in SCENARIO_KEYS], rng = scenario_seed) for scenario, scenario_seed in zip(chunk_scenarios, chunk_seeds)]
+    dfs = batch_prediction_pipeline(dfs, ControlVars.cluster_model_path, ControlVars.lstm_model_path, verbose = False, backend = ControlVars.backend)
+    for scenario_id, df in zip(ids, dfs):
+      df.insert(0, 'scenario_id', scenario_id)
+    return dfs
+
+  errors = {}
+  try:
+    dfs = simulate(scenario_ids, scenarios, seeds)
+
+  except Exception:
+    dfs = []
+    for scenario_id, scenario, scenario_seed in zip(scenario_ids, scenarios, seeds):
+      try:
+        dfs = dfs + simulate([scenario_id], [scenario], [scenario_seed])
+      except Exception as exception:
+        errors[scenario_id] = repr(exception)
+
+  results = pd.concat(dfs, axis = 0, ignore_index = True) if (len(dfs) > 0) else pd.DataFrame()
+  return results, errors
+
+def run_sweep (scenarios, max_workers = None, scenarios_per_chunk = 50, seed = None, max_retries = 2,
+               cluster_model_path = None, lstm_model_path = None, verbose = True, session = None):
+  """
+  Simulate all the scenarios using a pool of processes.
+  : param scenarios: list of scenario dictionaries, e.g. from expand_grid or latin_hypercube.
+  : param max_workers (int): number of worker processes. If None, the number of CPUs is used.
+  : param scenarios_per_chunk (int): scenarios simulated together (one model.predict call) by a worker.
+  : param seed: integer seed. Each scenario has its own random stream (SeedSequence.spawn), so the
+    generated inputs do not depend on the number of workers nor on the chunk size.
+  : param max_retries (int): number of times a chunk is resubmitted when its worker crashes. When a worker
+    crashes, all the chunks running in its pool are lost; they are run again one at a time, so that only
+    the chunk that crashes its worker uses its retries. Chunks that still crash, and scenarios that raise
+    an error (which are not retried), are reported in SweepResult.failed and the sweep continues.
+  : param cluster_model_path, lstm_model_path (str): model paths. If None, the paths of the session are used.
+  : param verbose (bool): if True, print the throughput at the end.
+  : param session: SimulationSession with the model paths and language. If None, ControlVars is used.
+  Returns a SweepResult with the columnar results of all the scenarios.
+  """
+  import multiprocessing
+  from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+  from concurrent.futures.process import BrokenProcessPool
+
+  session = get_session(session)
+  if (cluster_model_path is None):
+    cluster_model_path = session.cluster_model_path
+  if (lstm_model_path is None):
+    lstm_model_path = session.lstm_model_path
+  # Workers may not share the working directory assumptions of relative paths:
+  cluster_model_path, lstm_model_path = os.path.abspath(cluster_model_path), os.path.abspath(lstm_model_path)
+  encoding_path = os.path.abspath(session.encoding_path)
+  workers = max_workers if (max_workers is not None) else (os.cpu_count() or 1)
+
+  start_time = time.perf_counter()
+  seeds = np.random.SeedSequence(seed).spawn(len(scenarios))
+  chunks = {}
+  for chunk_start in range(0, len(scenarios), scenarios_per_chunk):
+    scenario_ids = list(range(chunk_start, min(chunk_start + scenarios_per_chunk, len(scenarios))))
+    chunks[chunk_start] = scenario_ids
+
+  attempts = {chunk_id: 0 for chunk_id in chunks}
+  results, errors = [], {}
+  pending = set(chunks.keys())
+  # Chunks lost when a pool broke. It is not known which of them crashed the worker, so they are run one at a time:
+  suspects = set()
+  # 'spawn' avoids forking a parent process where TensorFlow may already be running:
+  context = multiprocessing.get_context('spawn')
+
+  def collect (chunk_id, future):
+    """Store the result of a chunk. Raises BrokenProcessPool if the worker crashed."""
+    try:
+      chunk_results, chunk_errors = future.result()
+    except BrokenProcessPool:
+      raise
+    except Exception as exception:
+      # The chunk raised outside of the simulation (e.g. its arguments could not be sent): not retried
+      chunk_results, chunk_errors = None, {scenario_id: repr(exception) for scenario_id in chunks[chunk_id]}
+
+    if (chunk_results is not None) and (len(chunk_results) > 0):
+      results.append(chunk_results)
+    errors.update(chunk_errors)
+
+  def submit (executor, chunk_id):
+    scenario_ids = chunks[chunk_id]
+    return executor.submit(_run_chunk, scenario_ids, [scenarios[i] for i in scenario_ids], [seeds[i] for i in scenario_ids])
+
+  while ((len(pending) > 0) or (len(suspects) > 0)):
+    isolated = (len(suspects) > 0)
+    with ProcessPoolExecutor(max_workers = (1 if isolated else max_workers), mp_context = context, initializer = _init_worker,
+                             initargs = (cluster_model_path, lstm_model_path, session.language_pt, encoding_path, session.backend)) as executor:
+      if (isolated):
+        # One chunk at a time in a single worker: a crash is caused by the running chunk
+        for chunk_id in sorted(suspects):
+          try:
+            future = submit(executor, chunk_id)
+          except BrokenProcessPool:
+            # The pool broke without running the chunk: start a new one
+            break
+
+          try:
+            collect(chunk_id, future)
+            suspects.discard(chunk_id)
+
+          except BrokenProcessPool:
+            attempts[chunk_id] = attempts[chunk_id] + 1
+            if (attempts[chunk_id] > max_retries):
+              errors.update({scenario_id: "The worker process crashed." for scenario_id in chunks[chunk_id]})
+              suspects.discard(chunk_id)
+            # The pool is broken: start a new one
+            break
+
+      else:
+        # At most one chunk per worker is submitted, so a crash loses only the chunks that were running:
+        queued, futures = sorted(pending), {}
+        while ((len(queued) > 0) or (len(futures) > 0)):
+          broken = False
+          while ((len(queued) > 0) and (len(futures) < workers)):
+            try:
+              futures[submit(executor, queued[0])] = queued[0]
+              queued.pop(0)
+            except BrokenProcessPool:
+              broken = True
+              break
+
+          done = wait(futures, return_when = FIRST_COMPLETED)[0] if (len(futures) > 0) else set()
+          for future in done:
+            chunk_id = futures.pop(future)
+            pending.discard(chunk_id)
+            try:
+              collect(chunk_id, future)
+            except BrokenProcessPool:
+              suspects.add(chunk_id)
+              broken = True
+
+          if (broken):
+            # A worker crashed: the chunks still running in the pool are also lost
+            suspects.update(futures.values())
+            pending.difference_update(futures.values())
+            break
+
+  failed = sorted(errors.keys())
+
+  elapsed_seconds = time.perf_counter() - start_time
+  succeeded = len(scenarios) - len(failed)
+
+  if (len(results) > 0):
+    results = pd.concat(results, axis = 0, ignore_index = True).sort_values(by = 'scenario_id', kind = 'stable', ignore_index = True)
+  else:
+    results = pd.DataFrame()
+
+  scenarios_df = pd.DataFrame([dict(scenario) for scenario in scenarios], columns = SCENARIO_KEYS)
+  scenarios_df.insert(0, 'scenario_id', range(len(scenarios)))
+
+  sweep_result = SweepResult(results = results, scenarios = scenarios_df, failed = failed, errors = errors,
+                             elapsed_seconds = elapsed_seconds, throughput = (succeeded / elapsed_seconds if (elapsed_seconds > 0) else 0.0))
+
+  if (verbose):
+    print(f"Sweep: {succeeded} of {len(scenarios)} scenarios simulated in {elapsed_seconds:.1f} s ({sweep_result.throughput:.2f} scenarios/s). Failed scenarios: {len(failed)}.")
+
+  return sweep_result
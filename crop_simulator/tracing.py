@@ -0,0 +1,264 @@
+"""Per-stage instrumentation of the simulations.
+
+A Tracer records, for each stage of a simulation (dataset generation, feature engineering, KMeans,
+model loading, inference, report, display), the wall time, the CPU time of the process and the
+peak memory allocated during the stage (tracemalloc: allocations of Python objects and numpy
+arrays; memory allocated by TensorFlow is not seen). Each simulation run with the tracer is a
+Trace, and each stage is a span of the trace. tracemalloc counts the allocations of the whole
+process, so the memory is measured by a single trace at a time: traces started while another trace
+is active (e.g. concurrent simulations in threads) record only the times, and the spans that overlap
+another trace have peak_bytes = None. Allocations of threads that are not traced are still counted.
+The completed spans are:
+    - attached to the report of the simulation (REP_ table), for the stages finished before the report;
+    - kept in tracer.spans;
+    - passed to the callbacks of the tracer, e.g. to export them to a metrics sink.
+
+The pipeline opens the spans with the module-level function span, which looks up the active trace
+in a context variable. When no trace is active, span returns a shared no-op context manager, so the
+instrumentation costs a single lookup per stage.
+
+e.g.
+    tracer = Tracer(callbacks = [lambda record: print(record['path'], record['wall_seconds'])])
+    session = SimulationSession(tracer = tracer)
+    session.run_simulation('2022-12-01', '2023-04-01', 'SUZY IPRO', 63.3, 43.0, 1.71, 3.7, 16.8, 156.7)
+    tracer.summary()
+"""
+
+import time
+import uuid
+import warnings
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+
+# No-op context manager returned when no trace is active:
+NULL_SPAN = nullcontext()
+
+_active_trace = ContextVar('crop_simulator_trace', default = None)
+
+# tracemalloc is process-wide: it is used by a single trace at a time (the owner), which starts it if needed.
+_memory_lock = threading.Lock()
+_memory_owner = None
+_memory_started = False
+# Number of active traces, and a counter incremented each time traces overlap:
+_active_traces = 0
+_overlap_count = 0
+
+
+def span (name):
+  """
+  Return a context manager recording the stage name in the active trace, or NULL_SPAN if no trace is active.
+  e.g.
+    with span('kmeans'):
+      clusters = model.predict(X)
+  """
+  trace = _active_trace.get()
+  if (trace is None):
+    return NULL_SPAN
+
+  return trace.span(name)
+
+def current_trace ():
+  """Return the trace active in the current context, or None."""
+  return _active_trace.get()
+
+def start_memory_tracing (trace):
+  """
+  Register a new active trace. If it needs the memory and no other trace is active, it becomes the
+  owner of tracemalloc (started if it is not running). Returns True if the trace owns tracemalloc.
+  """
+  global _memory_owner, _memory_started, _active_traces, _overlap_count
+
+  with _memory_lock:
+    _active_traces = _active_traces + 1
+    if (_active_traces > 1):
+      _overlap_count = _overlap_count + 1
+      return False
+
+    if (trace.trace_memory):
+      if (not tracemalloc.is_tracing()):
+        tracemalloc.start()
+        _memory_started = True
+      _memory_owner = trace
+      return True
+
+    return False
+
+def stop_memory_tracing (trace):
+  """Unregister a finished trace, stopping tracemalloc if the trace owned it and started it."""
+  global _memory_owner, _memory_started, _active_traces
+
+  with _memory_lock:
+    _active_traces = _active_traces - 1
+    if (_memory_owner is trace):
+      _memory_owner = None
+      if (_memory_started):
+        tracemalloc.stop()
+        _memory_started = False
+
+def memory_is_exclusive ():
+  """Return (number of active traces == 1, overlap counter), to detect traces overlapping a span."""
+  with _memory_lock:
+    return (_active_traces == 1), _overlap_count
+
+
+class SpanContext:
+  """Context manager of a span: measures the stage and records it in the trace when it exits."""
+
+  def __init__(self, trace, name):
+    self.trace = trace
+    self.name = name
+
+  def __enter__ (self):
+    trace = self.trace
+    self.path = '/'.join([frame.name for frame in trace.stack] + [self.name])
+    self.peak_so_far = 0
+
+    if (trace.trace_memory):
+      self.overlap_count = memory_is_exclusive()[1]
+      current, peak = tracemalloc.get_traced_memory()
+      if (len(trace.stack) > 0):
+        # The peak of the enclosing span is kept before the peak counter is reset for this span:
+        parent = trace.stack[-1]
+        parent.peak_so_far = max(parent.peak_so_far, peak)
+      tracemalloc.reset_peak()
+      self.start_memory = current
+
+    trace.stack.append(self)
+    self.start_time = time.time()
+    self.start_wall = time.perf_counter()
+    self.start_cpu = time.process_time()
+    return self
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    wall_seconds = time.perf_counter() - self.start_wall
+    cpu_seconds = time.process_time() - self.start_cpu
+    trace = self.trace
+    trace.stack.pop()
+
+    peak_bytes = None
+    if (trace.trace_memory):
+      absolute_peak = max(tracemalloc.get_traced_memory()[1], self.peak_so_far)
+      exclusive, overlap_count = memory_is_exclusive()
+      if (exclusive and (overlap_count == self.overlap_count)):
+        # No other trace was active during the span:
+        peak_bytes = max(0, absolute_peak - self.start_memory)
+      if (len(trace.stack) > 0):
+        parent = trace.stack[-1]
+        parent.peak_so_far = max(parent.peak_so_far, absolute_peak)
+
+    trace.record({'trace_id': trace.trace_id, 'name': self.name, 'path': self.path, 'depth': len(trace.stack),
+                  'start_time': self.start_time, 'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds,
+                  'peak_bytes': peak_bytes, 'error': (exc_type is not None)})
+    return False
+
+
+class Trace:
+  """Spans of one simulation. A trace is used by a single thread (or task); the tracer may be shared."""
+
+  def __init__(self, tracer, name):
+    self.tracer = tracer
+    self.name = name
+    self.trace_id = uuid.uuid4().hex[:12]
+    # Set when the trace starts: True only if it owns tracemalloc (see start_memory_tracing)
+    self.trace_memory = tracer.trace_memory
+    self.stack = []
+    self.spans = [] # Completed spans, in the order they finished
+    self.attributes = {} # e.g. the simulation id, set by report_simulation
+
+  def span (self, name):
+    return SpanContext(self, name)
+
+  def record (self, record):
+    self.spans.append(record)
+    self.tracer.record(record, self)
+
+  def __enter__ (self):
+    self.trace_memory = start_memory_tracing(self)
+    self.token = _active_trace.set(self)
+    self.root = self.span(self.name).__enter__()
+    return self
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    try:
+      self.root.__exit__(exc_type, exc_value, traceback)
+    finally:
+      _active_trace.reset(self.token)
+      stop_memory_tracing(self)
+
+    return False
+
+  def breakdown (self):
+    """Return the completed spans below the root, in the order they started."""
+    return sorted([record for record in self.spans if record['depth'] > 0], key = lambda record: record['start_time'])
+
+
+class Tracer:
+  """Collects the spans of the simulations and passes them to the callbacks."""
+
+  def __init__(self, trace_memory = True, callbacks = None, max_spans = 10000):
+    """
+    trace_memory (bool): if True, the peak memory of each stage is measured with tracemalloc, when no
+      other trace is active (see the module docstring). Tracing the allocations slows down the Python
+      code, so disable it when only the times are needed.
+    callbacks (list): functions called with each completed span (a dictionary with the keys trace_id,
+      name, path, depth, start_time, wall_seconds, cpu_seconds, peak_bytes, error and simulation_id).
+      Exceptions raised by a callback are turned into warnings, so they do not stop the simulation.
+    max_spans (int): number of recent spans kept in self.spans.
+    """
+    self.trace_memory = trace_memory
+    self.callbacks = list(callbacks or [])
+    self.spans = deque(maxlen = max_spans)
+    self.lock = threading.Lock()
+
+  def add_callback (self, callback):
+    """Add a function called with each completed span."""
+    self.callbacks.append(callback)
+
+  def trace (self, name = 'simulation'):
+    """
+    Return a context manager that activates a new Trace in the current context: the spans opened
+    inside it (with the function span) are recorded in the trace.
+    """
+    return Trace(self, name)
+
+  def record (self, record, trace):
+    """Store a completed span and pass it to the callbacks."""
+    record['simulation_id'] = trace.attributes.get('simulation_id')
+    with self.lock:
+      self.spans.append(record)
+
+    for callback in self.callbacks:
+      try:
+        callback(record)
+      except Exception as exception:
+        warnings.warn(f"Tracer callback {callback!r} failed: {exception!r}")
+
+  def summary (self):
+    """
+    Return a dataframe with the number of runs, the total and mean wall times, the total CPU time
+    and the maximum peak memory of each stage (path) in self.spans.
+    """
+    import pandas as pd
+
+    with self.lock:
+      spans = pd.DataFrame(list(self.spans))
+
+    if (len(spans) == 0):
+      return spans
+
+    return spans.groupby('path').agg(runs = ('wall_seconds', 'size'), total_wall_seconds = ('wall_seconds', 'sum'),
+                                     mean_wall_seconds = ('wall_seconds', 'mean'), total_cpu_seconds = ('cpu_seconds', 'sum'),
+                                     max_peak_bytes = ('peak_bytes', 'max')).sort_values('total_wall_seconds', ascending = False)
+
+
+def format_span (record):
+  """Return the wall time, CPU time and peak memory of a span as a string for the report."""
+  text = f"wall = {record['wall_seconds']:.4f} s, cpu = {record['cpu_seconds']:.4f} s"
+  if (record['peak_bytes'] is not None):
+    text = text + f", peak = {record['peak_bytes'] / 2**20:.2f} MiB"
+
+  return text
@@ -1,4 +1,11 @@
+import numpy as np
+from .tracing import span
 from .utils import (
+  LSTM_COLUMNS,
+  get_cultivar_encoder,
+  get_frequency_features,
+  get_kmeans_centroids,
+  assign_clusters,
   calculate_frequency_features,
   apply_encoding,
   obtain_log_transformed_features,
@@ -19,3 +26,94 @@ def feature_eng_pipeline(df, model_path):
   dataset = get_dataframe_for_lstm(dataset)
 
   return dataset
+
+def feature_eng_matrix(df, model_path, out = None, encoding_path = None):
+  """
+  Compiled version of feature_eng_pipeline: instead of copying the dataframe at each stage,
+  one float32 (n, 33) array is preallocated in the order of LSTM_COLUMNS (the order expected
+  by get_dataframe_for_lstm), and each stage writes directly into its column slice.
+  feature_eng_pipeline remains available to inspect the intermediate dataframe.
+  df: dataframe that will be prepared for the LSTM Modelling
+  model_path (str): path for the KMeans pkl file
+  out: optional float32 array with shape (len(df), 33) to be filled (e.g. a slice of a larger
+    array holding several scenarios). If None, a new array is created.
+  encoding_path (str): path for the OneHot_encoding_list.pkl file. If None, ControlVars.encoding_path is used.
+  Returns the (n, 33) float32 array that can be passed to run_model.
+  """
+  total_values = len(df)
+  if (out is None):
+    out = np.empty((total_values, len(LSTM_COLUMNS)), dtype = np.float32)
+
+  # Columns 0 to 15: frequency features f1_sin, f1_cos, ..., f8_cos
+  with span('frequency_features'):
+    out[:, 0:16] = get_frequency_features(df['timestamp'])
+
+  # Log-transformed features, in the order used by the KMeans model:
+  log_features = np.empty((total_values, 6))
+  for j, column in enumerate(['PH', 'IFP', 'NLP', 'NGL', 'NS', 'MHG']):
+    np.log(df[column].to_numpy(dtype = np.float64), out = log_features[:, j])
+
+  # Column 16: cluster from the pretrained KMeans (nearest centroid, without scikit-learn)
+  with span('kmeans'):
+    out[:, 16] = assign_clusters(log_features, get_kmeans_centroids(model_path))
+
+  # Columns 17 to 28: One-Hot encoded cultivars
+  with span('encoding'):
+    get_cultivar_encoder(encoding_path).transform(df['Cultivar'], out = out[:, 17:29])
+
+  # Columns 29 to 32: PH_log, NLP_log, NGL_log, NS_log
+  out[:, 29:33] = log_features[:, [0, 2, 3, 4]]
+
+  return out
+
+def batch_feature_matrix(dfs, model_path, out = None, encoding_path = None):
+  """
+  Feature matrix of several scenarios, stacked in the order of dfs (the rows of each scenario are
+  the same returned from feature_eng_matrix). Only the six crop features vary from one scenario to
+  another, so the features shared by the scenarios are computed once for the whole batch:
+  - the frequency features are computed once per range of dates, and copied to each scenario with those dates;
+  - the One-Hot block of a scenario with a single cultivar is its cultivar row, broadcast to all its days;
+  - the clusters of all the rows are assigned with a single KMeans call.
+  dfs: list of dataframes that will be prepared for the LSTM Modelling
+  model_path (str): path for the KMeans pkl file
+  out: optional float32 array with shape (total number of rows, 33) to be filled. If None, a new array is created.
+  encoding_path (str): path for the OneHot_encoding_list.pkl file. If None, ControlVars.encoding_path is used.
+  Returns the (total number of rows, 33) float32 array that can be passed to run_model.
+  """
+  bounds = np.cumsum([0] + [len(df) for df in dfs])
+  if (out is None):
+    out = np.empty((bounds[-1], len(LSTM_COLUMNS)), dtype = np.float32)
+  if (len(dfs) == 0):
+    return out
+
+  blocks = [out[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+  # Columns 0 to 15: scenarios with the same dates share the frequency features
+  with span('frequency_features'):
+    shared_features = {}
+    for df, block in zip(dfs, blocks):
+      timestamps = np.asarray(df['timestamp'])
+      key = (timestamps.dtype.str, timestamps.tobytes())
+      if key not in shared_features:
+        shared_features[key] = get_frequency_features(timestamps)
+      block[:, 0:16] = shared_features[key]
+
+  # Log-transformed features of all the scenarios, in the order used by the KMeans model:
+  log_features = np.empty((bounds[-1], 6))
+  for j, column in enumerate(['PH', 'IFP', 'NLP', 'NGL', 'NS', 'MHG']):
+    np.log(np.concatenate([df[column].to_numpy(dtype = np.float64) for df in dfs]), out = log_features[:, j])
+
+  # Column 16: clusters of the whole batch
+  with span('kmeans'):
+    out[:, 16] = assign_clusters(log_features, get_kmeans_centroids(model_path))
+
+  # Columns 17 to 28: One-Hot encoded cultivars
+  with span('encoding'):
+    encoder = get_cultivar_encoder(encoding_path)
+    for df, block in zip(dfs, blocks):
+      encoder.transform(df['Cultivar'], out = block[:, 17:29])
+
+  # Columns 29 to 32: PH_log, NLP_log, NGL_log, NS_log
+  out[:, 29:33] = log_features[:, [0, 2, 3, 4]]
+
+  return out
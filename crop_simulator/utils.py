@@ -1,9 +1,12 @@
+import os
+import hashlib
 import numpy as np
 import pandas as pd
-import sklearn
-import tensorflow as tf
 from datetime import datetime, timedelta
+import threading
 from dataclasses import dataclass
+from .registry import get_model
+from .history import SessionHistory
 
 
 @dataclass
@@ -13,9 +16,35 @@ class ControlVars:
     # default value of start date will be the instant:
     server_start_time = pd.Timestamp(datetime.now())
     simulation_counter = 0 # Count how many simulations were run
-    exported_tables = [] # List of exported tables
+    exported_tables = SessionHistory() # List of exported tables. Older tables are spilled to disk above its memory budget
     cluster_model_path = 'kmeans_model.pkl'
     lstm_model_path = 'lstm.keras'
+    encoding_path = 'OneHot_encoding_list.pkl'
+    seed = None # Seed for the random values of the next simulation
+    results_store = None # Optional ParquetResultsStore where each simulation is appended
+    persisted_sheets = {} # Sheets already written to each exported Excel file: {file path: {'mtime': mtime, 'sheets': set of names}}
+    excel_file_name = 'soybean_crop_simulations' # Excel file written by download_excel_with_data (without extension)
+    backend = None # Inference backend (see backends.py). If None, it is inferred from the extension of lstm_model_path
+    result_cache = None # Optional ResultCache (see result_cache.py) for the seeded simulations
+    tracer = None # Optional Tracer (see tracing.py) recording the time and memory of each stage
+    lock = threading.RLock() # Protects the simulation counter when simulations run concurrently
+
+# User defined parameters of a simulation, in the order of run_simulation:
+SCENARIO_KEYS = ['start_date', 'end_date', 'cultivar', 'PH', 'NLP', 'NGL', 'NS', 'IFP', 'MHG']
+
+def get_session (session = None):
+  """
+  Return the session where a simulation is registered.
+  session: SimulationSession (see session.py). If None, the default session, ControlVars, is returned.
+  """
+  return ControlVars if (session is None) else session
+
+def next_simulation_number (session = None):
+  """Increment the simulation counter of the session and return the number of the new simulation."""
+  session = get_session(session)
+  with session.lock:
+    session.simulation_counter = session.simulation_counter + 1
+    return session.simulation_counter
 
 def create_dataset (start_date, end_date):
   """
@@ -35,6 +64,38 @@ def create_dataset (start_date, end_date):
 
   return df
 
+def create_dataset_chunk (start_date, end_date, start_index, stop_index):
+  """
+  Rows start_index to stop_index (excluded) of create_dataset(start_date, end_date), computed without
+  creating the whole range. The dates are the same of create_dataset: np.linspace with days points
+  from start_date to end_date (so one date of the range is skipped), truncated to days.
+  start_date, end_date (str): Format: '2024-02-21'
+  Returns a dataframe with the column 'timestamp' and the index from start_index to stop_index.
+  """
+  start_date = datetime.strptime(start_date, '%Y-%m-%d')
+  end_date = datetime.strptime(end_date, '%Y-%m-%d')
+  days = (end_date - start_date).days
+  if (days < 0):
+    raise ValueError(f"The end date ({end_date:%Y-%m-%d}) must not be before the start date ({start_date:%Y-%m-%d}).")
+
+  stop_index = min(stop_index, days)
+  indices = np.arange(start_index, max(start_index, stop_index), dtype = np.int64)
+
+  if (days > 1):
+    # np.linspace of datetimes adds index * ((end - start) / (days - 1)) to the start, with the step
+    # rounded to microseconds, and sets the last point to end_date:
+    step = ((end_date - start_date) / (days - 1)) // timedelta(microseconds = 1)
+    dates = np.datetime64(start_date, 'us') + (indices * step).astype('timedelta64[us]')
+    dates[indices == (days - 1)] = np.datetime64(end_date, 'us')
+  else:
+    dates = np.full(len(indices), np.datetime64(start_date, 'us'))
+
+  return pd.DataFrame({'timestamp': dates.astype('datetime64[D]')}, index = pd.RangeIndex(start_index, start_index + len(indices)))
+
+def dataset_length (start_date, end_date):
+  """Return the number of rows of create_dataset(start_date, end_date) (the number of days between the dates)."""
+  return (datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')).days
+
 def include_cultivar_column (df, cultivar):
   """
   cultivar (str): Cultivar name
@@ -44,13 +105,8 @@ def include_cultivar_column (df, cultivar):
 
   return dataset
 
-def generate_random_values (column, total_values):
-  """
-  These are random numbers that will be generated to modify the feature selected by the user.
-  column (str): name of the feature to generate the random value
-  total_values (int): total number of values for the feature
-  """
-  var_characteristics = {
+# Characteristics of the numeric features in the experimental data:
+VAR_CHARACTERISTICS = {
 
     'PH': {'min': 47.6, 'max': 94.8, 'max_proba': 63.3, 'std': 9.0},
     'NLP': {'min': 20.2, 'max': 123.0, 'max_proba': 43.0, 'std': 20.1},
@@ -59,6 +115,18 @@ def generate_random_values (column, total_values):
     'IFP': {'min': 7.2, 'max': 26.4, 'max_proba': 16.8, 'std': 3.0},
     'MHG': {'min': 127.1, 'max': 216.0, 'max_proba': 156.7, 'std': 19.6} }
 
+# Numeric features generated for each simulation, in the order of generate_numeric_block:
+NUMERIC_COLUMNS = ['PH', 'NLP', 'NGL', 'NS', 'IFP', 'MHG']
+
+def generate_random_values (column, total_values, rng = None):
+  """
+  These are random numbers that will be generated to modify the feature selected by the user.
+  column (str): name of the feature to generate the random value
+  total_values (int): total number of values for the feature
+  rng: numpy random Generator (or seed). If None, a new unseeded Generator is used.
+  """
+  var_characteristics = VAR_CHARACTERISTICS
+
   if column in var_characteristics.keys():
     min = var_characteristics[column]['min']
     max = var_characteristics[column]['max']
@@ -76,7 +144,7 @@ def generate_random_values (column, total_values):
     size: int or tuple of ints, optional - Output shape. If the given shape is, e.g., (m, n, k), then m * n * k samples are drawn. If size is None (default), a single value is returned
     """
     
-    rng = np.random.default_rng() # Random generator
+    rng = np.random.default_rng(rng) # Random generator
     values = rng.normal(loc = max_proba, scale = std, size = total_values)
     # Correct values out of range
     values = np.where(values < min, min, values)
@@ -87,14 +155,16 @@ def generate_random_values (column, total_values):
   else:
     return None
 
-def generate_random_mask (total_values):
+def generate_random_mask (total_values, rng = None):
   """
   The mask will be used to decide when replace the value for a random value
   total_values (int): total number of values for the feature
+  rng: numpy random Generator (or seed). If None, a new unseeded Generator is used.
   """
   # Generate random values from 0 to 1
-  # https://numpy.org/doc/stable/reference/random/generated/numpy.random.random.html#numpy.random.random
-  random_values = np.random.random (size = total_values)
+  # https://numpy.org/doc/stable/reference/random/generated/numpy.random.Generator.random.html
+  rng = np.random.default_rng(rng) # Random generator
+  random_values = rng.random (size = total_values)
   # Generate an array of zeros with same size:
   mask = np.zeros(random_values.shape)
   # If the random_values have a probability >= 0.5, replace by one:
@@ -102,21 +172,15 @@ def generate_random_mask (total_values):
 
   return mask
 
-def generate_uniform_noise (setpoint, column, total_values):
+def generate_uniform_noise (setpoint, column, total_values, rng = None):
   """
   : setpoint (float): value defined by the user as setpoint
   For the values that will not be replaced by the random distribution, add an uniform noise:
   Create an uniform distribution from -1 to 1, and multiply for 0.1 to further reduce its influence, multiply by the std and sum to the variable
   Guarantee that the ranges are in accordance to the experimental data
+  : rng: numpy random Generator (or seed). If None, a new unseeded Generator is used.
   """
-  var_characteristics = {
-
-    'PH': {'min': 47.6, 'max': 94.8, 'max_proba': 63.3, 'std': 9.0},
-    'NLP': {'min': 20.2, 'max': 123.0, 'max_proba': 43.0, 'std': 20.1},
-    'NGL': {'min': 0.94, 'max': 14.86, 'max_proba': 1.71, 'std': 0.84},
-    'NS': {'min': 0.4, 'max': 9.0, 'max_proba': 3.7, 'std': 1.5},
-    'IFP': {'min': 7.2, 'max': 26.4, 'max_proba': 16.8, 'std': 3.0},
-    'MHG': {'min': 127.1, 'max': 216.0, 'max_proba': 156.7, 'std': 19.6} }
+  var_characteristics = VAR_CHARACTERISTICS
 
   if column in var_characteristics.keys():
     min = var_characteristics[column]['min']
@@ -137,7 +201,7 @@ def generate_uniform_noise (setpoint, column, total_values):
     setpoints[:] = setpoint
     
     # Create the random noise:
-    rng = np.random.default_rng() # Random generator
+    rng = np.random.default_rng(rng) # Random generator
     values = rng.uniform(-1, 1, total_values)
     values = values * 0.1 * std
     # Sum the noise with the setpoints
@@ -153,18 +217,20 @@ def generate_uniform_noise (setpoint, column, total_values):
   else:
     return None
 
-def generate_numeric_column (setpoint, column, total_values):
+def generate_numeric_column (setpoint, column, total_values, rng = None):
   """
   These are random numbers that will be generated to modify the feature selected by the user.
   Function is run each time for variable to assure that the random distributions are not the same.
   setpoint (float): numeric value defined by the user for the variable
   column (str): name of the feature to generate the random value
   total_values (int): total number of values for the feature
+  rng: numpy random Generator (or seed). If None, a new unseeded Generator is used.
   """
-  random_values = generate_random_values(column, total_values)
+  rng = np.random.default_rng(rng) # The same Generator is used for the three draws
+  random_values = generate_random_values(column, total_values, rng)
   # Setpoint values with noise:
-  setpoint_with_noise = generate_uniform_noise (setpoint, column, total_values)
-  mask = generate_random_mask (total_values)
+  setpoint_with_noise = generate_uniform_noise (setpoint, column, total_values, rng)
+  mask = generate_random_mask (total_values, rng)
 
   # Create an array for the setpoint:
   values = np.zeros(total_values)
@@ -173,34 +239,176 @@ def generate_numeric_column (setpoint, column, total_values):
 
   return values
 
-def apply_encoding(df):
+def generate_numeric_block (setpoints, total_values, rng = None):
+  """
+  Vectorized version of generate_numeric_column for all the numeric features at once.
+  The normal samples (random values), the uniform samples (noise around the setpoint) and the uniform samples
+  of the mask for the six features are drawn together, as one (total_values, 6, 3) block, with a single Generator.
+  setpoints (list): values defined by the user, in the order of NUMERIC_COLUMNS: PH, NLP, NGL, NS, IFP, MHG
+  total_values (int): total number of values for each feature
+  rng: numpy random Generator, seed or SeedSequence. Use the same seed to obtain bit-reproducible values.
+    If None, a new unseeded Generator is used.
+  Returns an array with shape (total_values, 6), with columns in the order of NUMERIC_COLUMNS.
+  """
+  rng = np.random.default_rng(rng) # Random generator
+
+  mins = np.array([VAR_CHARACTERISTICS[column]['min'] for column in NUMERIC_COLUMNS])
+  maxs = np.array([VAR_CHARACTERISTICS[column]['max'] for column in NUMERIC_COLUMNS])
+  max_probas = np.array([VAR_CHARACTERISTICS[column]['max_proba'] for column in NUMERIC_COLUMNS])
+  stds = np.array([VAR_CHARACTERISTICS[column]['std'] for column in NUMERIC_COLUMNS])
+
+  # Draws stored as 3 planes of shape (total_values, 6): draws.transpose(1, 2, 0) is the (total_values, 6, 3) block.
+  # Plane 0: standard normal samples; planes 1 and 2 (drawn in a single call): uniform samples from 0 to 1.
+  draws = np.empty((3, total_values, len(NUMERIC_COLUMNS)))
+  rng.standard_normal(out = draws[0])
+  rng.random(out = draws[1:])
+
+  # Normal distribution centered in the max probability, with values out of the range corrected:
+  random_values = np.clip(max_probas + stds * draws[0], mins, maxs)
+  # Setpoints with an uniform noise from -1 to 1, multiplied by 0.1 * std:
+  setpoint_with_noise = np.clip(np.asarray(setpoints, dtype = np.float64) + (2 * draws[1] - 1) * 0.1 * stds, mins, maxs)
+  # Where mask ==  1 (uniform >= 0.5), use setpoint; otherwise, use the correspondent random value
+  values = np.where(draws[2] >= 0.5, setpoint_with_noise, random_values)
+
+  return values
+
+# The 40 cultivars from the experiment, in the order of the categories of OneHot_encoding_list.pkl:
+CULTIVARS = ['74K75RSF CE', '77HO111I2X - GUAPORÉ', '79I81RSF IPRO', '82HO111 IPRO - HO COXIM IPRO', '82I78RSF IPRO',
+             '83IX84RSF I2X', '96R29 IPRO', '97Y97 IPRO', '98R30 CE', 'ADAPTA LTT 8402 IPRO', 'ATAQUE I2X',
+             'BRASMAX BÔNUS IPRO', 'BRASMAX OLIMPO IPRO', 'ELISA IPRO', 'EXPANDE LTT 8301 IPRO', 'FORTALECE L090183 RR',
+             'FORTALEZA IPRO', 'FTR 3179 IPRO', 'FTR 3190 IPRO', 'FTR 3868 IPRO', 'FTR 4280 IPRO', 'FTR 4288 IPRO',
+             'GNS7700 IPRO', 'GNS7900 IPRO - AMPLA', 'LAT 1330BT', 'LTT 7901 IPRO', 'LYNDA IPRO', 'M 8644 IPRO',
+             'MANU IPRO', 'MONSOY 8330I2X', 'MONSOY M8606I2X', 'NEO 760 CE', 'NEO 790 IPRO', 'NK 7777 IPRO',
+             'NK 8100 IPRO', 'NK 8770 IPRO', 'PAULA IPRO', 'SUZY IPRO', 'SYN2282IPRO', 'TMG 22X83I2X']
+
+# Cultivars encoded as One-Hot columns for the LSTM (the other cultivars correspond to all columns equal to zero):
+ENCODED_CULTIVARS = ['82I78RSF IPRO', '83IX84RSF I2X', '96R29 IPRO', '97Y97 IPRO', 'BRASMAX OLIMPO IPRO',
+                     'FORTALECE L090183 RR', 'FTR 3179 IPRO', 'GNS7900 IPRO - AMPLA', 'MONSOY 8330I2X',
+                     'NK 7777 IPRO', 'SUZY IPRO', 'TMG 22X83I2X']
+
+
+class CultivarEncoder:
+  """
+  Lookup-table One-Hot encoder for the column 'Cultivar'.
+  Each cultivar is mapped to an integer code (its position in the list of categories), and the
+  One-Hot block is obtained by gathering the rows of a (categories + 1, 12) indicator table, instead
+  of comparing the whole column with each of the 12 encoded cultivars.
+  - Cultivars from the list of categories that are not in ENCODED_CULTIVARS are the reference
+    categories of the LSTM: all the 12 columns are zero.
+  - Cultivars that are not in the list of categories are unknown for the models: a warning is
+    raised and they are also encoded with zeros, as the reference categories.
+  """
+
+  def __init__(self, categories = CULTIVARS, encoded_cultivars = ENCODED_CULTIVARS):
+    """
+    categories (list): names of all the cultivars known by the encoder
+    encoded_cultivars (list): cultivars that have a One-Hot column, in the order of the columns
+    """
+    self.categories = list(categories)
+    self.encoded_cultivars = list(encoded_cultivars)
+    self.codes = {cultivar: code for code, cultivar in enumerate(self.categories)}
+    # The last row of the table (code = len(categories)) is used for unknown cultivars:
+    self.unknown_code = len(self.categories)
+    self.table = np.zeros((len(self.categories) + 1, len(self.encoded_cultivars)), dtype = np.float32)
+    
+    for j, cultivar in enumerate(self.encoded_cultivars):
+      if cultivar in self.codes:
+        self.table[self.codes[cultivar], j] = 1
+
+  def get_code (self, cultivar):
+    """Return the integer code of a cultivar."""
+    code = self.codes.get(cultivar)
+
+    if (code is None):
+      import warnings
+      warnings.warn(f"Cultivar {cultivar} is not one of the {len(self.categories)} cultivars used for training the models. It will be encoded as a reference cultivar (all One-Hot columns equal to zero).")
+      code = self.unknown_code
+
+    return code
+
+  def transform (self, cultivars, out = None):
+    """
+    Return the (n, 12) One-Hot block for the cultivars.
+    cultivars: array-like or series with the cultivar of each row
+    out: optional array with shape (n, 12) to be filled. If None, a float32 array is created.
+    """
+    # Each distinct cultivar is looked up only once:
+    labels, unique_cultivars = pd.factorize(np.asarray(cultivars, dtype = object))
+    unique_codes = np.array([self.get_code(cultivar) for cultivar in unique_cultivars], dtype = np.int64)
+
+    if (out is None):
+      out = np.empty((len(labels), len(self.encoded_cultivars)), dtype = np.float32)
+
+    if (len(unique_codes) == 1):
+      # Single cultivar: the whole block is the same row, broadcast to all the days
+      out[:] = self.table[unique_codes[0]]
+    elif (len(unique_codes) > 1):
+      # Scatter the 1s by gathering the row of each code:
+      out[:] = self.table[unique_codes[labels]]
+
+    return out
+
+  def get_feature_names (self):
+    """Return the names of the One-Hot columns."""
+    return ['Cultivar_' + cultivar + '_OneHotEnc' for cultivar in self.encoded_cultivars]
+
+
+def load_cultivar_encoder (encoding_path):
+  """
+  Build the CultivarEncoder from the list of encodings stored by the ETL workflow.
+  encoding_path (str): path for the OneHot_encoding_list.pkl file
   """
-  df: dataframe with column 'Cultivar' to be encoded"""
+  import pickle
 
-  dataset = df.copy(deep = True)
-  dataset['Cultivar_82I78RSF IPRO_OneHotEnc'] = np.where(dataset['Cultivar'] == '82I78RSF IPRO', 1, 0)
-  dataset['Cultivar_83IX84RSF I2X_OneHotEnc'] = np.where(dataset['Cultivar'] == '83IX84RSF I2X', 1, 0)
-  dataset['Cultivar_96R29 IPRO_OneHotEnc'] = np.where(dataset['Cultivar'] == '96R29 IPRO', 1, 0)
-  dataset['Cultivar_97Y97 IPRO_OneHotEnc'] = np.where(dataset['Cultivar'] == '97Y97 IPRO', 1, 0)
-  dataset['Cultivar_BRASMAX OLIMPO IPRO_OneHotEnc'] = np.where(dataset['Cultivar'] == 'BRASMAX OLIMPO IPRO', 1, 0)
-  dataset['Cultivar_FORTALECE L090183 RR_OneHotEnc'] = np.where(dataset['Cultivar'] == 'FORTALECE L090183 RR', 1, 0)
-  dataset['Cultivar_FTR 3179 IPRO_OneHotEnc'] = np.where(dataset['Cultivar'] == 'FTR 3179 IPRO', 1, 0)
-  dataset['Cultivar_GNS7900 IPRO - AMPLA_OneHotEnc'] = np.where(dataset['Cultivar'] == 'GNS7900 IPRO - AMPLA', 1, 0)
-  dataset['Cultivar_MONSOY 8330I2X_OneHotEnc'] = np.where(dataset['Cultivar'] == 'MONSOY 8330I2X', 1, 0)
-  dataset['Cultivar_NK 7777 IPRO_OneHotEnc'] = np.where(dataset['Cultivar'] == 'NK 7777 IPRO', 1, 0)
-  dataset['Cultivar_SUZY IPRO_OneHotEnc'] = np.where(dataset['Cultivar'] == 'SUZY IPRO', 1, 0)
-  dataset['Cultivar_TMG 22X83I2X_OneHotEnc'] = np.where(dataset['Cultivar'] == 'TMG 22X83I2X', 1, 0)
+  with open(encoding_path, 'rb') as opened_file:
 
-  dataset = dataset.drop(columns = 'Cultivar')
+    encoding_list = pickle.load(opened_file)
 
-  return dataset
+  categories = CULTIVARS
+  for encoding_dict in encoding_list:
+    if (encoding_dict['column'] == 'Cultivar'):
+      categories = list(encoding_dict['OneHot_encoder']['categories'])
 
-def calculate_frequency_features(df):
+  return CultivarEncoder(categories = categories)
+
+def get_cultivar_encoder (encoding_path = None):
   """
-  df: dataframe with column 'timestamp' to be converted to frequency
+  Return the CultivarEncoder, built only once and reused from the process-wide registry.
+  encoding_path (str): path for the OneHot_encoding_list.pkl file. If None, ControlVars.encoding_path is used.
+    If the file is not available, the encoder is built from the list CULTIVARS.
   """
+  import os
+
+  if (encoding_path is None):
+    encoding_path = ControlVars.encoding_path
+
+  if ((encoding_path is not None) and os.path.exists(encoding_path)):
+    return get_model(encoding_path, loader = load_cultivar_encoder)
+  
+  else:
+    return default_cultivar_encoder
+
+
+# Encoder used when the encoding file is not available:
+default_cultivar_encoder = CultivarEncoder()
 
-  important_frequencies = [{'value': 0.3000, 'unit': 'year', 'col': 'f1'},
+def apply_encoding(df, encoding_path = None):
+  """
+  df: dataframe with column 'Cultivar' to be encoded
+  encoding_path (str): path for the OneHot_encoding_list.pkl file. If None, ControlVars.encoding_path is used."""
+
+  dataset = df.copy(deep = True)
+  encoder = get_cultivar_encoder(encoding_path)
+  encoded = encoder.transform(dataset['Cultivar']).astype(np.int64)
+  
+  dataset = dataset.drop(columns = 'Cultivar')
+  # Attach all the One-Hot columns at once:
+  dataset = pd.concat([dataset, pd.DataFrame(encoded, columns = encoder.get_feature_names(), index = dataset.index)], axis = 1)
+
+  return dataset
+
+# Frequencies (in year^-1) with the highest amplitudes in the Fourier transform of GY:
+IMPORTANT_FREQUENCIES = [{'value': 0.3000, 'unit': 'year', 'col': 'f1'},
                          {'value':0.4125, 'unit': 'year', 'col': 'f2'},
                          {'value': 0.4500, 'unit': 'year', 'col': 'f3'},
                          {'value':0.6000, 'unit': 'year', 'col': 'f4'},
@@ -209,7 +417,149 @@ def calculate_frequency_features(df):
                          {'value': 4.2000, 'unit': 'year', 'col': 'f7'},
                          {'value':6.0000, 'unit': 'year', 'col': 'f8'}
                          ]
-  # 0.300 per year is the 1st freq
+# 0.300 per year is the 1st freq
+
+# Names of the frequency features, in the order they are generated: f1_sin, f1_cos, f2_sin, f2_cos, ...
+FREQUENCY_COLUMNS = []
+for freq_dict in IMPORTANT_FREQUENCIES:
+  FREQUENCY_COLUMNS = FREQUENCY_COLUMNS + [freq_dict['col'] + "_sin", freq_dict['col'] + "_cos"]
+
+def compute_frequency_features(timestamp_s):
+  """
+  Calculate the sine and cosine transforms of the timestamps for all the important frequencies.
+  timestamp_s: array of POSIX timestamps (seconds since January 1, 1970) as floats
+  Returns an array with shape (len(timestamp_s), 16), with columns in the order of FREQUENCY_COLUMNS.
+  """
+  # All frequencies are in year^-1 = 1/year
+  # convert to seconds, considering a (365.2425)-day year:
+  factor = 60 * 60 * 24 * (365.2425)
+  # periods (1/frequency), in years:
+  periods = np.array([1/freq_dict['value'] for freq_dict in IMPORTANT_FREQUENCIES])
+  # Angular frequencies in rad/s. Since timestamp_s is already in seconds, the product is adimensional.
+  # X days correspond to X * 60 * 60 * 24 seconds, for instance, where X == value.
+  angular_frequencies = 2 * np.pi / (factor * periods)
+
+  # Outer product: one row per timestamp, one column per frequency - shape (n, 8):
+  phases = np.outer(timestamp_s, angular_frequencies)
+  # cos(2pi* t/T), where t is the total time in seconds since Jan 1, 1970
+  # T is the period, the inverse of the frequency. If the frequency is 2x a year,
+  # so the period = 1/2 year. If frequency is once a year, period = 1/1 = 1 year.
+  # Interleave sin and cos in a single (n, 16) block: f1_sin, f1_cos, f2_sin, f2_cos, ...
+  features = np.empty((len(phases), 2 * len(IMPORTANT_FREQUENCIES)))
+  features[:, 0::2] = np.sin(phases)
+  features[:, 1::2] = np.cos(phases)
+
+  return features
+
+
+class FrequencyFeatureTable:
+  """
+  Memoized date -> frequency features lookup.
+  The features depend only on the calendar date, so they are stored in an array indexed by the
+  day offset from the epoch (1970-01-01). The table grows lazily to cover the requested dates,
+  and obtaining the features of a dataset becomes a gather on this array.
+  """
+
+  def __init__(self, max_days = 36600):
+    """
+    max_days (int): maximum number of days stored in the table (36600 days ~ 100 years, ~4.7 MB).
+      When a request does not fit in this size, the table restarts from the requested range;
+      ranges longer than max_days are computed directly, without caching.
+    """
+    self.max_days = max_days
+    self.first_day = 0 # day offset (from the epoch) of the first row of the table
+    self.table = np.empty((0, len(FREQUENCY_COLUMNS)))
+    self.lock = threading.Lock()
+
+  def compute_days (self, first_day, last_day):
+    """Compute the features for all days from first_day to last_day (inclusive offsets from the epoch)."""
+    days = np.arange(first_day, last_day + 1, dtype = np.int64)
+    # 1 day = 86400 s
+    return compute_frequency_features((days * 86400).astype(np.float64))
+
+  def lookup (self, days):
+    """
+    Return the features for each day.
+    days: int64 array with the day offsets from the epoch (dates as datetime64[D] viewed as int64)
+    """
+    if (len(days) == 0):
+      return np.empty((0, len(FREQUENCY_COLUMNS)))
+
+    low, high = int(days.min()), int(days.max())
+
+    if ((high - low + 1) > self.max_days):
+      # Too long to be cached
+      return compute_frequency_features((days * 86400).astype(np.float64))
+
+    with self.lock:
+      first_day, table = self.first_day, self.table
+      last_day = first_day + len(table) - 1
+
+      if ((len(table) == 0) | (low < first_day) | (high > last_day)):
+        
+        if (len(table) == 0):
+          new_first, new_last = low, high
+        else:
+          new_first, new_last = min(low, first_day), max(high, last_day)
+
+        if ((new_last - new_first + 1) > self.max_days):
+          # Keep the table bounded: restart it from the requested range.
+          table = self.compute_days(low, high)
+          first_day = low
+        
+        else:
+          # Grow the table only with the missing days:
+          blocks = []
+          if (len(table) == 0):
+            blocks.append(self.compute_days(new_first, new_last))
+          else:
+            if (new_first < first_day):
+              blocks.append(self.compute_days(new_first, first_day - 1))
+            blocks.append(table)
+            if (new_last > last_day):
+              blocks.append(self.compute_days(last_day + 1, new_last))
+
+          table = np.concatenate(blocks, axis = 0)
+          first_day = new_first
+
+        self.first_day, self.table = first_day, table
+
+    return table[days - first_day]
+
+  def clear (self):
+    """Release the stored features."""
+    with self.lock:
+      self.first_day = 0
+      self.table = np.empty((0, len(FREQUENCY_COLUMNS)))
+
+
+# Table shared by all the simulations run in the process:
+frequency_feature_table = FrequencyFeatureTable()
+
+def get_frequency_features(timestamps):
+  """
+  Return the (n, 16) array of frequency features, with columns in the order of FREQUENCY_COLUMNS.
+  timestamps: datetime64 series or array
+  """
+  # The seconds are read directly from the int64 buffer of the datetime64 array, with no Python call per row:
+  timestamp_s = np.asarray(timestamps).astype('datetime64[s]').astype(np.int64)
+  # the time in seconds is not a useful model input.
+  # It may have daily and yearly periodicity, for instance.
+  # To deal with periodicity, you can get usable signals by using sine and cosine transforms
+  # to clear "Time of day" and "Time of year" signals:
+
+  if (np.all(timestamp_s % 86400 == 0)):
+    # Only calendar dates (no hours): gather the features from the shared table
+    features = frequency_feature_table.lookup(timestamp_s // 86400)
+  else:
+    features = compute_frequency_features(timestamp_s.astype(np.float64))
+
+  return features
+
+def calculate_frequency_features(df):
+  """
+  df: dataframe with column 'timestamp' to be converted to frequency
+  """
 
   # the Date Time column is very useful, but not in this string form.
   # Start by converting it to seconds:
@@ -227,39 +577,11 @@ def calculate_frequency_features(df):
   # Pandas Timestamp.timestamp() function return the time expressed as the number of seconds that have passed.
   # https://www.geeksforgeeks.org/python-pandas-timestamp-timestamp/
   # since January 1, 1970. That zero moment is known as the epoch.
-  timestamp_s = DATASET['timestamp'].map(pd.Timestamp.timestamp)
-  # the time in seconds is not a useful model input.
-  # It may have daily and yearly periodicity, for instance.
-  # To deal with periodicity, you can get usable signals by using sine and cosine transforms
-  # to clear "Time of day" and "Time of year" signals:
-
+  features = get_frequency_features(DATASET['timestamp'])
 
-  for freq_dict in important_frequencies:
-
-      value = 1/freq_dict['value']
-      # period.
-      column = freq_dict['col']
-      # All frequencies are in year^-1 = 1/year
-      # convert to seconds, considering a (365.2425)-day year:
-      factor = 60 * 60 * 24 * (365.2425)
-
-      if (value is not None):
-
-          column_name1 = column + "_sin"
-          column_name2 = column + "_cos"
-
-          # Convert to total of seconds and so use the frequency in Hertz to obtain the periodic functions.
-          # Since timestamp_s is already in seconds, it is necessary to make it adimensional.
-          # X days correspond to X * 60 * 60 * 24 seconds, for instance, where X == value.
-          DATASET[column_name1] = np.sin(timestamp_s * (2 * np.pi / (factor * value)))
-          DATASET[column_name2] = np.cos(timestamp_s * (2 * np.pi / (factor * value)))
-
-          # cos(2pi* t/T), where t is the total time in seconds since Jan 1, 1970
-          # T is the period, the inverse of the frequency. If the frequency is 2x a year,
-          # so the period = 1/2 year. If frequency is once a year, period = 1/1 = 1 year.
-
-  # Drop original timestamps
+  # Drop original timestamps and attach all the frequency features at once:
   DATASET = DATASET.drop(columns = 'timestamp')
+  DATASET = pd.concat([DATASET, pd.DataFrame(features, columns = FREQUENCY_COLUMNS, index = DATASET.index)], axis = 1)
 
   return DATASET
 
@@ -284,60 +606,169 @@ def obtain_cluster_feature(df, model_path):
   df: dataframe with columns to be clustered with the pretrained KMeans cluster
   model_path (str): path for the KMeans pkl file
   """
-  import pickle
-
   dataset = df.copy(deep = True)
+  # The centroids of the KMeans model are reused from the process-wide registry:
+  centroids = get_kmeans_centroids(model_path)
 
-  with open(model_path, 'rb') as opened_file:
-
-    model = pickle.load(opened_file)
-
-  X = np.array(dataset[['PH_log', 'IFP_log', 'NLP_log', 'NGL_log', 'NS_log', 'MHG_log']])
-  dataset['cluster'] = model.predict(X)
+  X = dataset[KMEANS_COLUMNS].to_numpy(dtype = np.float64)
+  # int32, as the labels returned from KMeans.predict:
+  dataset['cluster'] = assign_clusters(X, centroids).astype(np.int32)
 
   return dataset
 
+# Columns fed to the LSTM, in the order used for training:
+LSTM_COLUMNS = ['f1_sin', 'f1_cos', 'f2_sin',
+                'f2_cos', 'f3_sin', 'f3_cos', 'f4_sin', 'f4_cos', 'f5_sin', 'f5_cos',
+                'f6_sin', 'f6_cos', 'f7_sin', 'f7_cos', 'f8_sin', 'f8_cos', 'cluster',
+                'Cultivar_82I78RSF IPRO_OneHotEnc', 'Cultivar_83IX84RSF I2X_OneHotEnc', 'Cultivar_96R29 IPRO_OneHotEnc', 'Cultivar_97Y97 IPRO_OneHotEnc',
+                'Cultivar_BRASMAX OLIMPO IPRO_OneHotEnc', 'Cultivar_FORTALECE L090183 RR_OneHotEnc', 'Cultivar_FTR 3179 IPRO_OneHotEnc',
+                'Cultivar_GNS7900 IPRO - AMPLA_OneHotEnc', 'Cultivar_MONSOY 8330I2X_OneHotEnc', 'Cultivar_NK 7777 IPRO_OneHotEnc',
+                'Cultivar_SUZY IPRO_OneHotEnc', 'Cultivar_TMG 22X83I2X_OneHotEnc',
+                'PH_log', 'NLP_log', 'NGL_log', 'NS_log']
+
 def get_dataframe_for_lstm(df):
   """
   df: dataframe for feeding LSTM, with feature engineering steps performed
   """
   dataset = df.copy(deep = True)
-  dataset = dataset[['f1_sin', 'f1_cos', 'f2_sin',
-                    'f2_cos', 'f3_sin', 'f3_cos', 'f4_sin', 'f4_cos', 'f5_sin', 'f5_cos',
-                    'f6_sin', 'f6_cos', 'f7_sin', 'f7_cos', 'f8_sin', 'f8_cos', 'cluster',
-                    'Cultivar_82I78RSF IPRO_OneHotEnc', 'Cultivar_83IX84RSF I2X_OneHotEnc', 'Cultivar_96R29 IPRO_OneHotEnc', 'Cultivar_97Y97 IPRO_OneHotEnc',
-                    'Cultivar_BRASMAX OLIMPO IPRO_OneHotEnc', 'Cultivar_FORTALECE L090183 RR_OneHotEnc', 'Cultivar_FTR 3179 IPRO_OneHotEnc',
-                    'Cultivar_GNS7900 IPRO - AMPLA_OneHotEnc', 'Cultivar_MONSOY 8330I2X_OneHotEnc', 'Cultivar_NK 7777 IPRO_OneHotEnc',
-                    'Cultivar_SUZY IPRO_OneHotEnc', 'Cultivar_TMG 22X83I2X_OneHotEnc',
-                    'PH_log', 'NLP_log', 'NGL_log', 'NS_log']]
+  dataset = dataset[LSTM_COLUMNS]
 
   return dataset
 
+def load_kmeans (model_path):
+  """
+  model_path (str): path for the KMeans pkl file
+  """
+  import pickle
+
+  with open(model_path, 'rb') as opened_file:
+
+    model = pickle.load(opened_file)
+
+  return model
+
+# Features of the KMeans model, in the order used for training:
+KMEANS_COLUMNS = ['PH_log', 'IFP_log', 'NLP_log', 'NGL_log', 'NS_log', 'MHG_log']
+
+def default_cache_directory ():
+  """Directory of the files derived from the models: the environment variable CROPSIM_CACHE_DIR, or ~/.cache/crop_simulator."""
+  return os.environ.get('CROPSIM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'crop_simulator'))
+
+def model_file_hash (model_path):
+  """Return a short SHA-256 hash of the contents of the model file."""
+  digest = hashlib.sha256()
+  with open(model_path, 'rb') as opened_file:
+    for block in iter(lambda: opened_file.read(1 << 20), b''):
+      digest.update(block)
+
+  return digest.hexdigest()[:16]
+
+def load_kmeans_centroids (model_path, cache_directory = None):
+  """
+  Return the centroids of the KMeans model as a C-contiguous float64 (n_clusters, 6) array.
+  The centroids are saved in a .npy file named with the hash of the pkl file, so the model is
+  unpickled (importing scikit-learn) only the first time; later processes read the .npy file.
+  model_path (str): path for the KMeans pkl file
+  cache_directory (str): directory of the .npy file. If None, default_cache_directory() is used.
+  """
+  if (cache_directory is None):
+    cache_directory = default_cache_directory()
+
+  model_name = os.path.splitext(os.path.basename(model_path))[0]
+  cache_path = os.path.join(cache_directory, f"{model_name}-{model_file_hash(model_path)}-centroids.npy")
+  if os.path.exists(cache_path):
+    return np.ascontiguousarray(np.load(cache_path), dtype = np.float64)
+
+  centroids = np.ascontiguousarray(load_kmeans(model_path).cluster_centers_, dtype = np.float64)
+  if (centroids.ndim != 2) or (centroids.shape[1] != len(KMEANS_COLUMNS)):
+    raise ValueError(f"The KMeans model has centroids with shape {centroids.shape}; expected (n_clusters, {len(KMEANS_COLUMNS)}).")
+
+  try:
+    os.makedirs(cache_directory, exist_ok = True)
+    # Written to a temporary file first, so that other processes never read a partial file:
+    temporary_path = cache_path + f".{os.getpid()}.tmp.npy"
+    np.save(temporary_path, centroids)
+    os.replace(temporary_path, cache_path)
+  except OSError:
+    # Read-only cache directory: the centroids are only kept in memory
+    pass
+
+  return centroids
+
+def get_kmeans_centroids (model_path):
+  """Return the centroids of the KMeans model of model_path from the process-wide registry."""
+  return get_model(model_path, loader = load_kmeans_centroids, variant = 'centroids')
+
+def assign_clusters (X, centroids, block_size = 2048):
+  """
+  Nearest-centroid assignment, equivalent to KMeans.predict: for each row of X, the index of the
+  centroid with the smallest squared Euclidean distance (the first one, in case of a tie).
+  The distances are computed as |c|² - 2 x.c (|x|² is the same for all the centroids of a row), with
+  one matrix product per block of block_size rows, so the temporary (block_size, n_clusters) array
+  stays in the CPU cache for any number of rows.
+  X: float64 (n, 6) array with the columns of KMEANS_COLUMNS
+  centroids: (n_clusters, 6) array returned from get_kmeans_centroids
+  Returns the (n,) array of cluster labels (np.intp).
+  """
+  X = np.asarray(X, dtype = np.float64)
+  centroids_t = np.ascontiguousarray(centroids.T)
+  centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+  labels = np.empty(len(X), dtype = np.intp)
+  distances = np.empty((min(block_size, len(X)), len(centroids)))
+  for start in range(0, len(X), block_size):
+    X_block = X[start:(start + block_size)]
+    block_distances = distances[:len(X_block)]
+    np.dot(X_block, centroids_t, out = block_distances)
+    block_distances *= -2
+    block_distances += centroid_norms
+    np.argmin(block_distances, axis = 1, out = labels[start:(start + len(X_block))])
+
+  return labels
+
 def load_lstm (model_path):
   """"
   model_path(str): path of the .keras model file
   """
+  # TensorFlow is only imported when the model is really needed
+  import tensorflow as tf
 
   model = tf.keras.models.load_model(model_path)
   return model
 
-def get_lstm_preds (model_object, df_transformed):
+def print_prediction_message (language_pt = None):
+  """Print the message shown while the model predicts GY.
+  language_pt (bool): if None, ControlVars.language_pt is used.
+  """
+  if (language_pt is None):
+    language_pt = ControlVars.language_pt
+
+  if (language_pt):
+    print("Calculando produtividade de grãos (kg/ha) – determinada pela colheita da área útil da parcela e padronizada para um teor de umidade dos grãos de 13%...\n")
+  else:
+    print("Grain yield (GY, kg/ha) – determined by harvesting the useful area of the plot and standardized to a grain moisture level of 13%...\n")
+
+def get_lstm_preds (model_object, df_transformed, verbose = True, language_pt = None):
 
   """
-  df_transformed: dataframe that passed through the feature engineering pipeline and is read to obtain model predictions
+  df_transformed: dataframe that passed through the feature engineering pipeline and is read to obtain model predictions.
+    The (n, 33) array returned from transform.feature_eng_matrix is also accepted.
   model_object: LSTM model object
+  verbose (bool): if False, no message nor progress bar is printed.
+  language_pt (bool): language of the message. If None, ControlVars.language_pt is used.
   """
-  dataset = df_transformed.copy(deep = True)
-  X = np.array(dataset)
+  # The model does not modify its input, so no copy is needed:
+  X = np.asarray(df_transformed)
 
   # Get predictions for training, testing, and validation:
 
-  if (ControlVars.language_pt):
-    print("Calculando produtividade de grãos (kg/ha) – determinada pela colheita da área útil da parcela e padronizada para um teor de umidade dos grãos de 13%...\n")
+  if (verbose):
+    print_prediction_message(language_pt)
+    y_pred = np.array(model_object.predict(X))
+  
   else:
-    print("Grain yield (GY, kg/ha) – determined by harvesting the useful area of the plot and standardized to a grain moisture level of 13%...\n")
+    y_pred = np.array(model_object.predict(X, verbose = 0))
 
-  y_pred = np.array(model_object.predict(X))
   total_dimensions = len(y_pred.shape)
   last_dim = y_pred.shape[(total_dimensions - 1)]
   if (last_dim == 1): # remove last dimension
@@ -350,12 +781,42 @@ def get_lstm_preds (model_object, df_transformed):
 
   return y_pred
 
-def run_model (model_path, df_transformed):
+def deduplicate_rows (X):
   """
-  Run model pipeline
+  Find the repeated rows of a 2-D array (e.g. the stacked feature matrix of scenarios repeated in a batch).
+  Rows are compared by their bytes, so only exactly equal rows are merged.
+  Returns (unique_indices, inverse): X[unique_indices] are the distinct rows, in the order of their first
+  occurrence, and X[unique_indices][inverse] is equal to X. If no row is repeated, returns (None, None).
   """
-  model_object = load_lstm(model_path)
-  y_pred = get_lstm_preds(model_object, df_transformed)
+  X = np.ascontiguousarray(X)
+  if (len(X) < 2):
+    return None, None
+
+  # Each row is viewed as a single opaque value, so np.unique compares whole rows:
+  rows = X.reshape(len(X), -1).view(np.dtype((np.void, X.dtype.itemsize * int(np.prod(X.shape[1:]))))).ravel()
+  _, first_indices, inverse = np.unique(rows, return_index = True, return_inverse = True)
+  if (len(first_indices) == len(X)):
+    return None, None
+
+  # Renumber the distinct rows in the order of their first occurrence:
+  order = np.argsort(first_indices, kind = 'stable')
+  rank = np.empty_like(order)
+  rank[order] = np.arange(len(order))
+
+  return first_indices[order], rank[inverse.ravel()]
+
+def run_model (model_path, df_transformed, verbose = True, language_pt = None, backend = None):
+  """
+  Run model pipeline. The model is loaded only once and reused from the process-wide registry.
+  model_path (str): path of the model file: the LSTM (.keras), other bundled Keras model, or the XGBoost model (.json).
+  verbose (bool): if False, no message nor progress bar is printed.
+  language_pt (bool): language of the message. If None, ControlVars.language_pt is used.
+  backend: name of the inference backend, or InferenceBackend (see backends.py). If None, the backend
+    is inferred from the extension of model_path.
+  """
+  from .backends import get_backend
+
+  y_pred = get_backend(backend, model_path).run(model_path, df_transformed, verbose, language_pt)
 
   return y_pred
 
@@ -367,7 +828,6 @@ def calculate_NGP_linear_reg (NLP):
       : param NLP: array-like containing NLP data
   """
   NGP = np.array(NLP) * 2.0552345917675012 + 13.64549993083196
-  ControlVars.NGP = NGP
   return NGP
 
 def reverse_log_transform (y_pred):
@@ -388,32 +848,39 @@ def update_df (df, y_pred):
 
   return dataset
 
-def update_control_vars(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG):
+def update_control_vars(start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, seed = None, session = None):
   """Update control variables with user defined inputs.
   : params start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG: user defined parameters.
-  """
-  ControlVars.start_date = start_date
-  ControlVars.end_date = end_date
-  ControlVars.cultivar = cultivar
-  ControlVars.PH = PH
-  ControlVars.NLP = NLP
-  ControlVars.NGL = NGL
-  ControlVars.NS = NS
-  ControlVars.IFP = IFP
-  ControlVars.MHG = MHG
-
-def retrieve_vars_from_global_context ():
-  """Retrieve variables stored in global context"""
-  start_date = ControlVars.start_date
-  end_date = ControlVars.end_date
-  cultivar = ControlVars.cultivar
-  PH = ControlVars.PH
-  NLP = ControlVars.NLP
-  NGL = ControlVars.NGL
-  NS = ControlVars.NS
-  IFP = ControlVars.IFP
-  MHG = ControlVars.MHG
-  cluster_model_path = ControlVars.cluster_model_path
-  lstm_model_path = ControlVars.lstm_model_path
+  : param seed: seed for the random values of the simulation (None for non-reproducible values).
+  : param session: SimulationSession to update. If None, the global context (ControlVars) is updated.
+  """
+  session = get_session(session)
+  with session.lock:
+    session.seed = seed
+    session.start_date = start_date
+    session.end_date = end_date
+    session.cultivar = cultivar
+    session.PH = PH
+    session.NLP = NLP
+    session.NGL = NGL
+    session.NS = NS
+    session.IFP = IFP
+    session.MHG = MHG
+
+def retrieve_vars_from_global_context (session = None):
+  """Retrieve variables stored in global context (or in the SimulationSession session)"""
+  session = get_session(session)
+  with session.lock:
+    start_date = session.start_date
+    end_date = session.end_date
+    cultivar = session.cultivar
+    PH = session.PH
+    NLP = session.NLP
+    NGL = session.NGL
+    NS = session.NS
+    IFP = session.IFP
+    MHG = session.MHG
+    cluster_model_path = session.cluster_model_path
+    lstm_model_path = session.lstm_model_path
 
   return start_date, end_date, cultivar, PH, NLP, NGL, NS, IFP, MHG, cluster_model_path, lstm_model_path
@@ -0,0 +1,48 @@
+"""Parity of the compiled inference engines with the Keras model."""
+
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from crop_simulator.backends import (CompiledFunctionEngine, TFLiteEngine, convert_to_tflite, first_output,
+                                     get_backend)
+from crop_simulator.benchmarks import load_dataset_matrix
+from crop_simulator.utils import load_lstm
+
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_PATH = os.path.join(REPOSITORY_PATH, 'models_and_encodings', 'lstm.keras')
+BATCH_SIZE = 64
+TOLERANCE = 1e-4 # Maximum absolute difference of GY_log
+
+
+@pytest.fixture(scope = 'module')
+def features ():
+  X, y_log = load_dataset_matrix()
+  return X
+
+@pytest.fixture(scope = 'module')
+def tflite_engine (tmp_path_factory):
+  flatbuffer_path = str(tmp_path_factory.mktemp('tflite') / 'lstm.tflite')
+  convert_to_tflite(MODEL_PATH, flatbuffer_path, batch_size = BATCH_SIZE)
+  return TFLiteEngine(flatbuffer_path)
+
+@pytest.fixture(scope = 'module')
+def tf_function_engine ():
+  return CompiledFunctionEngine(load_lstm(MODEL_PATH))
+
+
+# 1 and 121 rows (a 4-month simulation) are padded to the fixed batch; 1000 rows end with a padded batch of 40 rows:
+@pytest.mark.parametrize('rows', [1, 121, BATCH_SIZE, 1000])
+@pytest.mark.parametrize('engine_fixture', ['tflite_engine', 'tf_function_engine'])
+def test_engine_matches_keras (request, features, engine_fixture, rows):
+  engine = request.getfixturevalue(engine_fixture)
+  X = features[:rows]
+  reference = np.asarray(get_backend('keras').run(MODEL_PATH, X), dtype = np.float64)
+  y_pred = np.asarray(first_output(engine.predict(X)), dtype = np.float64)
+
+  assert y_pred.shape == reference.shape
+  np.testing.assert_allclose(y_pred, reference, rtol = 0, atol = TOLERANCE)
@@ -0,0 +1,74 @@
+"""Incremental Excel export of the simulation tables."""
+
+import zipfile
+from xml.etree import ElementTree
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from crop_simulator.idswcopy import export_new_tables_as_excel
+
+
+VARIANT_TYPES_NAMESPACE = '{http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes}'
+
+
+def simulation_table (sheet, value):
+  df = pd.DataFrame({'data': pd.date_range('2022-12-01', periods = 5), 'GY': [float(value)] * 5, 'cultivar': ['SUZY & "IPRO"'] * 5})
+  return {'dataframe_obj_to_be_exported': df, 'excel_sheet_name': sheet}
+
+def export (directory, tables, persisted_sheets):
+  return export_new_tables_as_excel('simulations', tables, str(directory), persisted_sheets = persisted_sheets)
+
+
+def test_appends_keep_all_sheets (tmp_path, monkeypatch):
+  persisted_sheets = {}
+  tables = [simulation_table('SIM_1', 1), simulation_table('REP_1', 10)]
+  export(tmp_path, tables, persisted_sheets)
+
+  with monkeypatch.context() as context:
+    # The new sheets are added to the zip package, without loading the workbook:
+    context.setattr(openpyxl, 'load_workbook', None)
+    for index in (2, 3):
+      tables = tables + [simulation_table(f'SIM_{index}', index), simulation_table(f'REP_{index}', 10 * index)]
+      assert export(tmp_path, tables, persisted_sheets) == [f'SIM_{index}', f'REP_{index}']
+
+  file_path = tmp_path / 'simulations.xlsx'
+  sheet_names = ['SIM_1', 'REP_1', 'SIM_2', 'REP_2', 'SIM_3', 'REP_3']
+  workbook = openpyxl.load_workbook(file_path)
+  assert workbook.sheetnames == sheet_names
+  assert workbook['SIM_3']['A2'].number_format == 'YYYY-MM-DD'
+
+  sheets = pd.read_excel(file_path, sheet_name = None)
+  assert list(sheets) == sheet_names
+  for table in tables:
+    pd.testing.assert_frame_equal(sheets[table['excel_sheet_name']], table['dataframe_obj_to_be_exported'], check_dtype = False)
+
+  with zipfile.ZipFile(file_path) as package:
+    properties = ElementTree.fromstring(package.read('docProps/app.xml'))
+  assert [element.text for element in properties.iter(VARIANT_TYPES_NAMESPACE + 'lpstr')][1:] == sheet_names
+  assert [element.text for element in properties.iter(VARIANT_TYPES_NAMESPACE + 'i4')] == [str(len(sheet_names))]
+
+def test_export_keeps_foreign_sheets (tmp_path):
+  file_path = tmp_path / 'simulations.xlsx'
+  foreign_df = pd.DataFrame({'field': ['A', 'B'], 'area': [1.5, 2.0]})
+  foreign_df.to_excel(file_path, sheet_name = 'Foreign', index = False)
+
+  persisted_sheets = {}
+  export(tmp_path, [simulation_table('SIM_1', 1)], persisted_sheets)
+  export(tmp_path, [simulation_table('SIM_1', 1), simulation_table('SIM_2', 2)], persisted_sheets)
+
+  sheets = pd.read_excel(file_path, sheet_name = None)
+  assert list(sheets) == ['Foreign', 'SIM_1', 'SIM_2']
+  pd.testing.assert_frame_equal(sheets['Foreign'], foreign_df)
+
+@pytest.mark.parametrize('use_record', [True, False])
+def test_export_replaces_sheets_with_the_same_name (tmp_path, use_record):
+  persisted_sheets = {}
+  export(tmp_path, [simulation_table('SIM_1', 1)], persisted_sheets)
+  # Without the record (e.g. a new session), the sheet is exported again and replaces the old one:
+  export(tmp_path, [simulation_table('SIM_1', 2)], persisted_sheets if use_record else {})
+
+  sheets = pd.read_excel(tmp_path / 'simulations.xlsx', sheet_name = None)
+  assert list(sheets) == ['SIM_1']
+  assert sheets['SIM_1']['GY'].iloc[0] == (1.0 if use_record else 2.0)
@@ -0,0 +1,44 @@
+"""Parity of the nearest-centroid cluster assignment with the pickled scikit-learn KMeans."""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from crop_simulator.utils import (KMEANS_COLUMNS, VAR_CHARACTERISTICS, assign_clusters, get_kmeans_centroids,
+                                  load_kmeans, obtain_cluster_feature)
+
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_PATH = os.path.join(REPOSITORY_PATH, 'models_and_encodings', 'kmeans_model.pkl')
+DATASET_PATH = os.path.join(REPOSITORY_PATH, 'dataset.csv')
+RAW_COLUMNS = [column.replace('_log', '') for column in KMEANS_COLUMNS]
+
+
+@pytest.fixture(scope = 'module')
+def kmeans_model ():
+  pytest.importorskip('sklearn')
+  return load_kmeans(MODEL_PATH)
+
+@pytest.fixture(scope = 'module')
+def log_features ():
+  """Log features of dataset.csv followed by seeded random rows in the ranges of the experimental data."""
+  dataset = pd.read_csv(DATASET_PATH)
+  rng = np.random.default_rng(0)
+  random_values = np.column_stack([rng.uniform(VAR_CHARACTERISTICS[column]['min'], VAR_CHARACTERISTICS[column]['max'], 200000)
+                                   for column in RAW_COLUMNS])
+
+  return np.log(np.concatenate([dataset[RAW_COLUMNS].to_numpy(dtype = np.float64), random_values]))
+
+
+def test_assign_clusters_matches_kmeans_predict (kmeans_model, log_features):
+  labels = assign_clusters(log_features, get_kmeans_centroids(MODEL_PATH))
+  np.testing.assert_array_equal(labels, kmeans_model.predict(log_features))
+
+def test_obtain_cluster_feature_keeps_int32 (kmeans_model, log_features):
+  df = pd.DataFrame(log_features[:500], columns = KMEANS_COLUMNS)
+  clustered = obtain_cluster_feature(df, MODEL_PATH)
+
+  assert clustered['cluster'].dtype == np.int32
+  np.testing.assert_array_equal(clustered['cluster'].to_numpy(), kmeans_model.predict(log_features[:500]))
@@ -0,0 +1,55 @@
+"""Disk tier of the ResultCache."""
+
+import os
+
+import pandas as pd
+
+from crop_simulator.result_cache import ResultCache
+
+
+MODEL_HASHES = ('lstm_hash', 'kmeans_hash', 'encoder_hash')
+
+
+def simulated_df (value, rows = 100):
+  return pd.DataFrame({'timestamp': pd.date_range('2022-12-01', periods = rows), 'GY': [float(value)] * rows})
+
+
+def test_invalidate_keeps_unrelated_files (tmp_path):
+  unrelated_path = tmp_path / 'notes.pkl'
+  unrelated_path.write_bytes(b'user data')
+  cache = ResultCache(directory = str(tmp_path))
+  cache.put(('key_1', MODEL_HASHES), simulated_df(1))
+
+  cache.invalidate()
+
+  assert unrelated_path.read_bytes() == b'user data'
+  assert cache.stats()['disk_entries'] == 0
+  assert cache.get(('key_1', MODEL_HASHES)) is None
+
+def test_running_total_evicts_least_recently_used (tmp_path):
+  cache = ResultCache(max_entries = 0, directory = str(tmp_path))
+  cache.put(('key_0', MODEL_HASHES), simulated_df(0))
+  entry_bytes = cache.disk_bytes
+  cache.max_disk_bytes = 3 * entry_bytes
+
+  for index in range(1, 5):
+    cache.put((f'key_{index}', MODEL_HASHES), simulated_df(index))
+    stats = cache.stats()
+    assert stats['disk_bytes'] <= cache.max_disk_bytes
+    assert cache.disk_bytes == stats['disk_bytes']
+
+  assert cache.get(('key_0', MODEL_HASHES)) is None
+  pd.testing.assert_frame_equal(cache.get(('key_4', MODEL_HASHES)), simulated_df(4))
+
+def test_store_under_budget_does_not_list_files (tmp_path, monkeypatch):
+  cache = ResultCache(directory = str(tmp_path))
+  cache.put(('key_0', MODEL_HASHES), simulated_df(0))
+
+  listings = []
+  disk_files = cache.disk_files
+  monkeypatch.setattr(cache, 'disk_files', lambda: listings.append(1) or disk_files())
+  for index in range(1, 20):
+    cache.put((f'key_{index}', MODEL_HASHES), simulated_df(index))
+
+  assert listings == []
+  assert cache.disk_bytes == sum(size for mtime, size, path in disk_files())